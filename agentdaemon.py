@@ -0,0 +1,208 @@
+'''
+A simple resident daemon wrapper to run the speedtest agent test cycle on an
+internal schedule, rather than having cron start a fresh process every time
+'''
+from __future__ import print_function
+
+class AgentDaemon(object):
+    '''
+    A class to repeatedly run an agent test cycle on a fixed interval until
+    told to stop by a signal (SIGTERM/SIGINT)
+
+    cycle_func is called with the kind of cycle to run ('full' or 'ping') &
+    returns the cycle's results (if any). If we have a scheduler (a
+    CycleScheduler), it decides when each cycle runs & which kind, from the
+    results of the last. Cycles only run while holding run_lock (a RunLock),
+    if we have one. Schedule events (cycles run, cycles skipped because
+    another run held the lock, slots missed by an over-running cycle) are
+    passed to on_event(event, count) & the next scheduled cycle to
+    on_scheduled(time, kind).
+    '''
+
+    def __init__(self, cycle_func, interval, logger, debug=False, scheduler=None, run_lock=None,
+        on_event=None, on_scheduled=None):
+
+        import threading
+
+        self.cycle_func = cycle_func
+        self.interval = int(interval)
+        self.logger = logger
+        self.debug = debug
+
+        self.scheduler = scheduler
+        self.run_lock = run_lock
+        self.on_event = on_event
+        self.on_scheduled = on_scheduled
+
+        self.cycle_count = 0
+        self.stop_requested = False
+        self.run_requested = False
+
+        # used to wake the main loop early when we are asked to stop (or to
+        # run a cycle now)
+        self._wake_event = threading.Event()
+
+    def install_signal_handlers(self):
+        '''
+        Hook SIGTERM & SIGINT so that we finish the current cycle and exit
+        cleanly, rather than being killed mid-way through a test
+        '''
+        import signal
+
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+
+    def _handle_signal(self, signum, frame):
+
+        import sys
+
+        if self.stop_requested:
+            # second signal - user really wants us gone, don't wait for the
+            # current cycle to complete
+            sys.exit(1)
+
+        if self.debug:
+            print("Daemon: received signal " + str(signum) + ", stopping after current cycle")
+
+        self.stop()
+
+    def stop(self):
+        '''
+        Ask the daemon to stop at the next opportunity
+        '''
+        self.stop_requested = True
+        self._wake_event.set()
+
+    def wake(self):
+        '''
+        Run a cycle now, rather than waiting for the next one to be due (or
+        straight after the current cycle, if one is running)
+        '''
+        if self.debug:
+            print("Daemon: woken to run a cycle now")
+
+        self.run_requested = True
+        self._wake_event.set()
+
+    def next_run_time(self, now):
+        '''
+        Figure out when the next cycle is due. Cycles are aligned to multiples
+        of the interval (in the same way as a "*/5" cron entry would be) and
+        any slots missed due to an over-running cycle are skipped.
+        '''
+        return (int(now) // self.interval + 1) * self.interval
+
+    def next_run(self, now):
+        '''
+        The next cycle to run: (time, kind)
+        '''
+        if self.scheduler is None:
+            return (self.next_run_time(now), 'full')
+
+        return self.scheduler.next_run(now)
+
+    def record_event(self, event, count=1):
+
+        if self.on_event is not None and count > 0:
+            self.on_event(event, count)
+
+    def run_cycle(self, kind='full'):
+        '''
+        Run a single agent cycle, making sure that no failure within the cycle
+        can take out the daemon itself. Returns the cycle's results (None if
+        it didn't finish).
+        '''
+        if self.run_lock is not None and not self.run_lock.acquire():
+            self.logger.log_error("Daemon: another test cycle is still running, skipping this one")
+            self.record_event('overlap')
+            return None
+
+        self.cycle_count += 1
+
+        if self.debug:
+            print("Daemon: starting cycle " + str(self.cycle_count) + " (" + kind + ")")
+
+        self.record_event(kind)
+
+        try:
+            return self.cycle_func(kind)
+        except SystemExit as ex:
+            # the test cycle bails out with sys.exit() on unrecoverable
+            # network issues - that only ends this cycle for the daemon
+            if self.debug:
+                print("Daemon: cycle exited early (" + str(ex) + ")")
+        except Exception as ex:
+            self.logger.log_error("Daemon: unexpected error during test cycle: " + str(ex))
+        finally:
+            if self.run_lock is not None:
+                self.run_lock.release()
+
+        return None
+
+    def wait_until(self, run_time):
+        '''
+        Sleep until run_time, but wake early if we are asked to stop (or to
+        run a cycle now)
+        '''
+        import time
+
+        wait_time = run_time - time.time()
+
+        if self.debug:
+            print("Daemon: next cycle in " + str(int(wait_time)) + " secs")
+
+        self._wake_event.wait(max(wait_time, 0))
+        self._wake_event.clear()
+
+    def run(self):
+        '''
+        Main daemon loop - run a cycle straight away (or after our scheduler's
+        offset), then as scheduled until we are stopped
+        '''
+        import time
+
+        self.logger.log_error("Daemon: starting (interval = " + str(self.interval) + " secs)")
+
+        kind = 'full'
+        due = time.time()
+
+        if self.scheduler is not None:
+            due = self.scheduler.first_run_time(due)
+            self.wait_until(due)
+
+        while not self.stop_requested:
+
+            # (woken to run a cycle now - always a full one)
+            if self.run_requested:
+                (due, kind) = (time.time(), 'full')
+
+            # (the wake-up is used up by this cycle - don't let it cut short
+            # our next wait too)
+            self.run_requested = False
+            self._wake_event.clear()
+
+            records = self.run_cycle(kind)
+
+            now = time.time()
+
+            # slots that passed while the cycle was running are skipped
+            self.record_event('missed', int((now - due) // self.interval))
+
+            if self.scheduler is not None:
+                self.scheduler.update(kind, records, due)
+
+            if self.stop_requested:
+                break
+
+            # (woken while the cycle was running)
+            if self.run_requested:
+                continue
+
+            (due, kind) = self.next_run(now)
+
+            if self.on_scheduled is not None:
+                self.on_scheduled(due, kind)
+
+            self.wait_until(due)
+
+        self.logger.log_error("Daemon: stopped after " + str(self.cycle_count) + " cycles")
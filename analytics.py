@@ -0,0 +1,430 @@
+#!/usr/bin/python
+'''
+Offline analysis of the results in one or more agent DB files (e.g. a
+collection of speedtest.db files pulled from a fleet of probes). Results
+are loaded into NumPy arrays in bulk & analysed with vectorized operations:
+
+ - download/upload percentiles per BSSID & per frequency band
+ - correlation of signal level with download rate
+ - time of day heatmap of download rates
+ - degradation windows (runs of results well below a probe's usual rate)
+ - RTT percentiles & loss per ping target
+
+Needs NumPy (pip install numpy). To run:
+
+    python analytics.py probe1/speedtest.db probe2/speedtest.db ...
+'''
+from __future__ import print_function
+
+# numeric columns of speedtest_data that we load
+NUMERIC_COLUMNS = ['timestamp', 'download_rate', 'upload_rate', 'ping_time',
+    'signal_level', 'freq', 'bit_rate']
+
+# ping target columns (host, loss & RTT for each of the 3 ping tests)
+PING_COLUMNS = [('ping_host' + str(number), 'percent_loss' + str(number), 'rtt_avg' + str(number)) for number in range(1, 4)]
+
+# (band name, lowest freq GHz) - in ascending order
+BANDS = [('2.4GHz', 2.4), ('5GHz', 5.15), ('6GHz', 5.925)]
+
+PERCENTILES = [5, 50, 95]
+
+DAY_NAMES = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+def load_db(db_file):
+    '''
+    Read the results of a DB file: (numeric rows, bssids, interfaces, ping
+    rows) - ping rows are empty if the DB pre-dates per target ping columns &
+    interfaces are None if it pre-dates the interface column. Returns False
+    (with a warning) if the file isn't an agent DB.
+
+    The DB is opened read-only, so that a mistyped path isn't left behind as
+    a new, empty DB.
+    '''
+    import os
+    import sqlite3
+    import sys
+
+    if not os.path.isfile(db_file):
+        sys.stderr.write("Skipping " + db_file + ": no such file\n")
+        return False
+
+    try:
+        try:
+            from urllib.request import pathname2url
+        except ImportError:
+            from urllib import pathname2url
+
+        try:
+            db_conn = sqlite3.connect('file:' + pathname2url(os.path.abspath(db_file)) + '?mode=ro', uri=True)
+        except TypeError:
+            # (no URI filenames on python 2 - but we know the file exists)
+            db_conn = sqlite3.connect(db_file)
+
+        try:
+            columns = [row[1] for row in db_conn.execute("pragma table_info(speedtest_data)").fetchall()]
+
+            if not columns:
+                sys.stderr.write("Skipping " + db_file + ": no speedtest_data table\n")
+                return False
+
+            select_columns = NUMERIC_COLUMNS + ['bssid', 'interface' if 'interface' in columns else 'null']
+
+            ping_results = PING_COLUMNS[0][0] in columns
+
+            if ping_results:
+                for ping_columns in PING_COLUMNS:
+                    select_columns.extend(ping_columns)
+
+            results = db_conn.execute("select " + ", ".join(select_columns) + " from speedtest_data order by timestamp").fetchall()
+        finally:
+            db_conn.close()
+    except sqlite3.DatabaseError as ex:
+        sys.stderr.write("Skipping " + db_file + ": " + str(ex) + "\n")
+        return False
+
+    width = len(NUMERIC_COLUMNS)
+
+    rows = [result[:width] for result in results]
+    bssids = [result[width] for result in results]
+    interfaces = [result[width + 1] for result in results]
+
+    ping_rows = []
+
+    if ping_results:
+        for ping_number in range(len(PING_COLUMNS)):
+            start = width + 2 + ping_number * 3
+
+            ping_rows.extend([result[start:start + 3] for result in results if result[start] is not None])
+
+    return (rows, bssids, interfaces, ping_rows)
+
+def to_float_array(rows, width):
+    '''
+    Rows of DB values as a 2D float array (NULLs & anything non-numeric, like
+    the "NA" of older DBs, become NaN)
+    '''
+    import numpy
+
+    if not rows:
+        return numpy.empty((0, width))
+
+    values = numpy.array(rows, dtype=object)
+
+    # numbers stored as text by older schemas are converted with the rest
+    converted = numpy.empty(values.shape)
+
+    for column in range(width):
+        try:
+            converted[:, column] = numpy.where(values[:, column] == None, numpy.nan, values[:, column]).astype(float)
+        except (TypeError, ValueError):
+            converted[:, column] = [float(value) if is_number(value) else numpy.nan for value in values[:, column]]
+
+    return converted
+
+def is_number(value):
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+class ResultSet(object):
+    '''
+    The results of a set of DB files as column arrays (one element per
+    result). source holds the index (in db_files) of the DB file each result
+    came from - files that aren't agent DBs are skipped & left out of
+    db_files.
+    '''
+
+    def __init__(self, db_files):
+
+        import numpy
+
+        numeric = []
+        bssids = []
+        interfaces = []
+        sources = []
+        ping_rows = []
+
+        self.db_files = []
+
+        for db_file in db_files:
+            db_results = load_db(db_file)
+
+            if not db_results:
+                continue
+
+            (db_rows, db_bssids, db_interfaces, db_ping_rows) = db_results
+
+            index = len(self.db_files)
+            self.db_files.append(db_file)
+
+            numeric.append(to_float_array(db_rows, len(NUMERIC_COLUMNS)))
+            bssids.extend(db_bssids)
+            interfaces.extend(db_interfaces)
+            sources.append(numpy.full(len(db_rows), index, dtype=int))
+            ping_rows.extend(db_ping_rows)
+
+        numeric = numpy.vstack(numeric) if numeric else numpy.empty((0, len(NUMERIC_COLUMNS)))
+
+        for (index, column) in enumerate(NUMERIC_COLUMNS):
+            setattr(self, column, numeric[:, index])
+
+        self.source = numpy.concatenate(sources) if sources else numpy.empty(0, dtype=int)
+        self.bssid = numpy.array([bssid or 'NA' for bssid in bssids], dtype=object)
+        self.interface = numpy.array([interface or 'NA' for interface in interfaces], dtype=object)
+
+        self.ping_host = numpy.array([row[0] for row in ping_rows], dtype=object)
+        ping_values = to_float_array([row[1:] for row in ping_rows], 2)
+        self.ping_loss = ping_values[:, 0]
+        self.ping_rtt = ping_values[:, 1]
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def band(self):
+        '''
+        Frequency band name of each result ("NA" if not known)
+        '''
+        import numpy
+
+        band = numpy.full(len(self), 'NA', dtype=object)
+
+        for (name, lowest) in BANDS:
+            band[self.freq >= lowest] = name
+
+        return band
+
+def group_percentiles(keys, values, percentiles=PERCENTILES):
+    '''
+    Percentiles of values for each distinct key: [(key, count, [percentile
+    values])], most results first (NaN values are ignored)
+    '''
+    import numpy
+
+    valid = ~numpy.isnan(values)
+    keys = keys[valid]
+    values = values[valid]
+
+    if not len(values):
+        return []
+
+    (unique_keys, inverse, counts) = numpy.unique(keys.astype(str), return_inverse=True, return_counts=True)
+
+    # sort values by group, then split in to one array per group
+    order = numpy.argsort(inverse, kind='stable')
+    groups = numpy.split(values[order], numpy.cumsum(counts)[:-1])
+
+    results = [(unique_keys[index], counts[index], numpy.percentile(groups[index], percentiles))
+        for index in range(len(unique_keys))]
+
+    results.sort(key=lambda result: -result[1])
+
+    return results
+
+def signal_correlation(results):
+    '''
+    Correlation of signal level with download rate: (results used, Pearson
+    r, Mbps per dB of signal) - None if there are too few results
+    '''
+    import numpy
+
+    valid = ~numpy.isnan(results.signal_level) & ~numpy.isnan(results.download_rate)
+
+    if valid.sum() < 3 or numpy.ptp(results.signal_level[valid]) == 0:
+        return None
+
+    signal = results.signal_level[valid]
+    download = results.download_rate[valid]
+
+    r = numpy.corrcoef(signal, download)[0, 1]
+    slope = numpy.polyfit(signal, download, 1)[0]
+
+    return (int(valid.sum()), r, slope)
+
+def time_of_day_heatmap(results, utc_offset):
+    '''
+    Mean download rate for each day of the week (rows, Monday first) & hour
+    of the day (columns), in local time (utc_offset secs) - NaN where there
+    are no results
+    '''
+    import numpy
+
+    valid = ~numpy.isnan(results.download_rate) & ~numpy.isnan(results.timestamp)
+
+    local_time = results.timestamp[valid].astype(numpy.int64) + utc_offset
+
+    hour = (local_time // 3600) % 24
+    # (1970-01-01 was a Thursday)
+    weekday = (local_time // 86400 + 3) % 7
+
+    cell = weekday * 24 + hour
+
+    totals = numpy.bincount(cell, weights=results.download_rate[valid], minlength=7 * 24)
+    counts = numpy.bincount(cell, minlength=7 * 24)
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        heatmap = totals / counts
+
+    return heatmap.reshape(7, 24)
+
+def degradation_windows(results, threshold=0.5, min_results=3):
+    '''
+    Runs of at least min_results consecutive results from the same probe
+    with a download rate below threshold x that probe's median rate:
+    [(source, start time, end time, results, mean rate, probe median)]
+    '''
+    import numpy
+
+    valid = ~numpy.isnan(results.download_rate) & ~numpy.isnan(results.timestamp)
+
+    source = results.source[valid]
+    timestamp = results.timestamp[valid]
+    download = results.download_rate[valid]
+
+    if not len(download):
+        return []
+
+    order = numpy.lexsort((timestamp, source))
+    (source, timestamp, download) = (source[order], timestamp[order], download[order])
+
+    medians = numpy.zeros(source.max() + 1)
+
+    for index in numpy.unique(source):
+        medians[index] = numpy.median(download[source == index])
+
+    below = download < threshold * medians[source]
+
+    # a run starts wherever "below" switches on or the probe changes
+    new_run = numpy.ones(len(below), dtype=bool)
+    new_run[1:] = (below[1:] != below[:-1]) | (source[1:] != source[:-1])
+
+    run_starts = numpy.flatnonzero(new_run)
+    run_ends = numpy.append(run_starts[1:], len(below))
+
+    windows = []
+
+    for (start, end) in zip(run_starts, run_ends):
+        if below[start] and end - start >= min_results:
+            windows.append((source[start], timestamp[start], timestamp[end - 1], end - start,
+                download[start:end].mean(), medians[source[start]]))
+
+    return windows
+
+def format_values(values):
+    return " ".join(['%8.1f' % value for value in values])
+
+def report(results, utc_offset, threshold=0.5, min_results=3, max_rows=20):
+    '''
+    Our analysis as a list of report lines
+    '''
+    import datetime
+    import numpy
+
+    lines = []
+
+    def when(timestamp):
+        return datetime.datetime.utcfromtimestamp(timestamp + utc_offset).strftime("%Y-%m-%d %H:%M")
+
+    valid_time = results.timestamp[~numpy.isnan(results.timestamp)]
+
+    lines.append("Results: " + str(len(results)) + " from " + str(len(results.db_files)) + " DB files" +
+        (" (" + when(valid_time.min()) + " to " + when(valid_time.max()) + ")" if len(valid_time) else ""))
+
+    percentile_header = " ".join(['%8s' % ('p' + str(pct)) for pct in PERCENTILES])
+
+    groupings = [("BSSID", results.bssid), ("Band", results.band())]
+
+    # (probes testing from several interfaces, e.g. a wired baseline)
+    if len(set(results.interface)) > 1:
+        groupings.insert(0, ("Interface", results.interface))
+
+    for (title, keys) in groupings:
+        for (name, values) in [("download", results.download_rate), ("upload", results.upload_rate)]:
+            groups = group_percentiles(keys, values)
+
+            lines.append("")
+            lines.append("%-20s %7s %s   (%s Mbps)" % (title, 'count', percentile_header, name))
+
+            for (key, count, percentiles) in groups[:max_rows]:
+                lines.append("%-20s %7d %s" % (key, count, format_values(percentiles)))
+
+            if len(groups) > max_rows:
+                lines.append("(" + str(len(groups) - max_rows) + " more)")
+
+    lines.append("")
+
+    correlation = signal_correlation(results)
+
+    if correlation is None:
+        lines.append("Signal vs download: not enough results")
+    else:
+        lines.append("Signal vs download: r = %.2f over %d results (%.2f Mbps per dB)" % (correlation[1], correlation[0], correlation[2]))
+
+    if len(results.ping_host):
+        lines.append("")
+        lines.append("%-20s %7s %s %8s   (RTT ms)" % ('Ping target', 'count', percentile_header, 'loss %'))
+
+        for (host, count, percentiles) in group_percentiles(results.ping_host, results.ping_rtt)[:max_rows]:
+            loss = results.ping_loss[(results.ping_host == host) & ~numpy.isnan(results.ping_loss)]
+            lines.append("%-20s %7d %s %8.1f" % (host, count, format_values(percentiles), loss.mean() if len(loss) else numpy.nan))
+
+    lines.append("")
+    lines.append("Mean download (Mbps) by local time of day:")
+    lines.append("     " + "".join(['%5d' % hour for hour in range(24)]))
+
+    heatmap = time_of_day_heatmap(results, utc_offset)
+
+    for (day, row) in enumerate(heatmap):
+        lines.append(DAY_NAMES[day] + "  " + "".join(['%5s' % ('-' if numpy.isnan(value) else '%.0f' % value) for value in row]))
+
+    windows = degradation_windows(results, threshold, min_results)
+
+    lines.append("")
+    lines.append("Degradation windows (download < " + '%.0f' % (threshold * 100) + "% of probe median for " +
+        str(min_results) + "+ results): " + str(len(windows)))
+
+    for (source, start, end, count, mean, median) in windows[:max_rows]:
+        lines.append("  %s  %s to %s  %3d results  %8.1f Mbps (median %.1f)" % (results.db_files[source],
+            when(start), when(end), count, mean, median))
+
+    if len(windows) > max_rows:
+        lines.append("  (" + str(len(windows) - max_rows) + " more)")
+
+    return lines
+
+def main():
+
+    import argparse
+    import glob
+    import time
+
+    parser = argparse.ArgumentParser(description="Analyse the results in speedtest agent DB files")
+    parser.add_argument('db_files', nargs='+', help="agent DB files (wildcards allowed)")
+    parser.add_argument('--threshold', type=float, default=0.5,
+        help="degradation: download rate below this fraction of the probe's median")
+    parser.add_argument('--min-results', type=int, default=3,
+        help="degradation: min consecutive results below threshold")
+    parser.add_argument('--max-rows', type=int, default=20, help="max rows per report table")
+    parser.add_argument('--utc', action='store_true', help="report times in UTC rather than local time")
+    args = parser.parse_args()
+
+    try:
+        import numpy
+    except ImportError:
+        parser.error("NumPy is needed for analytics (pip install numpy)")
+
+    db_files = []
+
+    for pattern in args.db_files:
+        db_files.extend(sorted(glob.glob(pattern)) or [pattern])
+
+    # (DST is ignored - the current offset is used throughout)
+    utc_offset = 0 if args.utc else -(time.altzone if time.localtime().tm_isdst > 0 else time.timezone)
+
+    results = ResultSet(db_files)
+
+    print("\n".join(report(results, utc_offset, args.threshold, args.min_results, args.max_rows)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,872 @@
+#!/usr/bin/python
+'''
+A collector service for results from a fleet of probes: probes POST
+batches of results to it with the http result sink (see resultsinks.py),
+rather than each writing to its own Google sheet:
+
+    POST /ingest   gzipped JSON: {"hostname": ..., "location": ...,
+                   "results": [{..., "result_key": ...}, ...]}
+
+Batches from all probes are queued & written by a single writer thread,
+which commits everything that is waiting in one transaction (so a burst of
+posts from hundreds of probes is a handful of bulk inserts, not hundreds
+of commits). A post is only acknowledged once its results are committed.
+Results already stored (a probe retrying a post that did make it) are
+discarded by their result_key.
+
+Each result is also added to hourly rollups per probe (count, min, max,
+mean & approximate p50/p95 - see rollups.py) that the queries read:
+
+    GET /probes                         probes seen, with result counts
+    GET /summary?metric=download&group=location&days=7
+                                        metric summaries per probe,
+                                        location, hour, day or overall
+    GET /health
+
+To run the collector, or a load test of N simulated probes against a
+local instance (or a running collector, with --url):
+
+    python collector.py --db collector.db --port 8086
+    python collector.py --load-test 200 --posts 5 --batch 12
+'''
+from __future__ import print_function
+
+# result fields stored in their own (numeric) columns
+NUMERIC_COLUMNS = ['ping_time', 'download_rate', 'upload_rate', 'freq', 'bit_rate',
+    'signal_level', 'lan_tcp_down', 'lan_tcp_up', 'lan_udp_rate', 'lan_udp_loss',
+    'lan_udp_jitter', 'percent_loss1', 'rtt_avg1', 'percent_loss2', 'rtt_avg2',
+    'percent_loss3', 'rtt_avg3']
+
+# result fields stored in their own (text) columns
+TEXT_COLUMNS = ['interface', 'ssid', 'bssid', 'ip_addr', 'server_name', 'ping_host1',
+    'ping_host2', 'ping_host3']
+
+# result fields that are columns of the results table (any other fields
+# are kept together as JSON)
+KEY_FIELDS = ['hostname', 'location', 'result_key', 'timestamp']
+
+COLLECTOR_SCHEMA = [
+    "create table if not exists fleet_results (id integer primary key autoincrement, "
+        "hostname text not null, location text, result_key text not null, timestamp integer, "
+        "received integer, " + ", ".join([column + " real" for column in NUMERIC_COLUMNS]) + ", " +
+        ", ".join([column + " text" for column in TEXT_COLUMNS]) + ", extra text)",
+    "create unique index if not exists fleet_results_key on fleet_results (hostname, result_key)",
+    "create index if not exists fleet_results_time on fleet_results (timestamp)",
+    "create table if not exists fleet_probes (hostname text primary key, location text, "
+        "first_seen integer, last_seen integer, results integer)",
+    "create table if not exists fleet_rollup_hourly (period_start integer, hostname text, "
+        "location text, metric text, count integer, min real, max real, sum real, histogram text, "
+        "primary key (period_start, hostname, location, metric))",
+]
+
+# groups that summaries can be broken down by
+SUMMARY_GROUPS = ['hostname', 'location', 'hour', 'day', 'all']
+
+# most result keys we look up in a single query (SQLite's default limit on
+# query parameters is 999)
+KEY_CHUNK = 500
+
+def column_value(value, numeric):
+    '''
+    A result field as stored in its column: numbers as floats, "NA" (or
+    anything else that isn't a number) as NULL
+    '''
+    if value is None or value == "NA":
+        return None
+
+    if not numeric:
+        return str(value)
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def encode_batch(hostname, location, records):
+    '''
+    A batch of results as posted by the http result sink (gzipped JSON)
+    '''
+    import gzip
+    import io
+    import json
+
+    data = io.BytesIO()
+
+    with gzip.GzipFile(fileobj=data, mode='wb') as gzip_file:
+        gzip_file.write(json.dumps({'hostname': hostname, 'location': location,
+            'results': records}).encode('utf-8'))
+
+    return data.getvalue()
+
+def decode_batch(body, gzipped, max_bytes):
+    '''
+    Decode a posted batch: (hostname, location, results). Raises ValueError
+    if it isn't a valid batch (or decompresses to more than max_bytes).
+    '''
+    import gzip
+    import io
+    import json
+
+    if gzipped:
+        try:
+            body = gzip.GzipFile(fileobj=io.BytesIO(body)).read(max_bytes + 1)
+        except (IOError, OSError, EOFError) as ex:
+            raise ValueError("Bad gzip data: " + str(ex))
+
+        if len(body) > max_bytes:
+            raise ValueError("Batch is too large")
+
+    try:
+        batch = json.loads(body.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError) as ex:
+        raise ValueError("Bad JSON: " + str(ex))
+
+    if not isinstance(batch, dict) or not batch.get('hostname') or not isinstance(batch.get('results'), list):
+        raise ValueError("A batch needs a hostname & a list of results")
+
+    for record in batch['results']:
+        if not isinstance(record, dict) or not record.get('result_key'):
+            raise ValueError("Each result needs a result_key")
+
+    return (str(batch['hostname']), str(batch.get('location') or ''), batch['results'])
+
+class CollectorStore(object):
+    '''
+    A class to store posted batches of results in the collector DB. Batches
+    are queued by submit() & written by a writer thread (started with
+    start()), which has the only write connection to the DB.
+
+    At most max_queue batches wait to be written - past that, submit()
+    turns batches away (the probes retry them later). Raw results are kept
+    for keep_days (0 = forever), rollups forever.
+    '''
+
+    def __init__(self, db_file, debug=False, max_queue=1000, max_write=5000, keep_days=30):
+
+        try:
+            import Queue as queue
+        except ImportError:
+            import queue
+
+        self.db_file = db_file
+        self.debug = debug
+        self.max_write = int(max_write)
+        self.keep_days = float(keep_days)
+
+        self.queue = queue.Queue(int(max_queue))
+        self.thread = None
+
+        # (totals since we started)
+        self.stats = {'batches': 0, 'results': 0, 'duplicates': 0, 'commits': 0, 'rejected': 0}
+
+        self.last_cleanup = 0
+
+    def connect(self):
+
+        import sqlite3
+
+        db_conn = sqlite3.connect(self.db_file, timeout=30)
+
+        # (readers don't block the writer, or each other)
+        db_conn.execute("pragma journal_mode=wal")
+
+        return db_conn
+
+    def create_tables(self, db_conn):
+
+        with db_conn:
+            for statement in COLLECTOR_SCHEMA:
+                db_conn.execute(statement)
+
+    def start(self):
+
+        import threading
+
+        db_conn = self.connect()
+        self.create_tables(db_conn)
+        db_conn.close()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Write any batches still queued, then stop our writer thread
+        '''
+        if self.thread is None:
+            return
+
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def submit(self, hostname, location, records, timeout=30):
+        '''
+        Queue a batch of results & wait for it to be written. Returns
+        (results stored, duplicates discarded), or None if the batch could
+        not be written (queue full, write failed or timed out).
+        '''
+        import threading
+
+        try:
+            import Queue as queue
+        except ImportError:
+            import queue
+
+        batch = {'hostname': hostname, 'location': location, 'records': records,
+            'done': threading.Event(), 'result': None}
+
+        try:
+            self.queue.put(batch, False)
+        except queue.Full:
+            self.stats['rejected'] += 1
+            return None
+
+        if not batch['done'].wait(timeout):
+            return None
+
+        return batch['result']
+
+    def run(self):
+
+        import sys
+        import time
+
+        try:
+            import Queue as queue
+        except ImportError:
+            import queue
+
+        db_conn = self.connect()
+        stopping = False
+
+        while not stopping:
+            try:
+                batch = self.queue.get(True, 60)
+            except queue.Empty:
+                batch = False
+
+            batches = []
+            record_count = 0
+
+            # take everything else that is waiting (up to max_write results)
+            while batch is not False:
+                if batch is None:
+                    stopping = True
+                else:
+                    batches.append(batch)
+                    record_count += len(batch['records'])
+
+                if stopping or record_count >= self.max_write:
+                    break
+
+                try:
+                    batch = self.queue.get_nowait()
+                except queue.Empty:
+                    batch = False
+
+            if batches:
+                try:
+                    results = self.write_batches(db_conn, batches)
+                except Exception as ex:
+                    sys.stderr.write("Db execute error when trying to store results: " + str(ex) + "\n")
+                    results = [None] * len(batches)
+
+                for (batch, result) in zip(batches, results):
+                    batch['result'] = result
+                    batch['done'].set()
+
+            if self.keep_days > 0 and time.time() - self.last_cleanup > 3600:
+                self.cleanup(db_conn)
+
+        db_conn.close()
+
+    def write_batches(self, db_conn, batches):
+        '''
+        Store batches of results in one transaction. Returns a (stored,
+        duplicates) count for each batch.
+        '''
+        import time
+
+        now = int(time.time())
+        counts = []
+        rows = []
+        rollups = {}
+        probes = {}
+
+        # result keys of this write so far, by hostname
+        pending = {}
+
+        with db_conn:
+            for batch in batches:
+                (hostname, location) = (batch['hostname'], batch['location'])
+
+                records = self.new_records(db_conn, hostname, batch['records'],
+                    pending.setdefault(hostname, set()))
+
+                for record in records:
+                    rows.append(self.result_row(hostname, location, record, now))
+                    self.add_rollup_values(rollups, hostname, location, record)
+
+                counts.append((len(records), len(batch['records']) - len(records)))
+
+                probe = probes.setdefault(hostname, {'location': location, 'results': 0})
+                probe['location'] = location
+                probe['results'] += len(records)
+
+            columns = KEY_FIELDS + ['received'] + NUMERIC_COLUMNS + TEXT_COLUMNS + ['extra']
+
+            db_conn.executemany("insert into fleet_results (" + ", ".join(columns) + ") values (" +
+                ",".join(["?"] * len(columns)) + ")", rows)
+
+            self.update_rollups(db_conn, rollups)
+
+            for (hostname, probe) in probes.items():
+                db_conn.execute("insert or ignore into fleet_probes (hostname, location, first_seen, last_seen, results) values (?,?,?,?,0)",
+                    (hostname, probe['location'], now, now))
+                db_conn.execute("update fleet_probes set location = ?, last_seen = ?, results = results + ? where hostname = ?",
+                    (probe['location'], now, probe['results'], hostname))
+
+        self.stats['batches'] += len(batches)
+        self.stats['results'] += sum([stored for (stored, duplicates) in counts])
+        self.stats['duplicates'] += sum([duplicates for (stored, duplicates) in counts])
+        self.stats['commits'] += 1
+
+        if self.debug:
+            print("Collector: stored " + str(len(rows)) + " results from " + str(len(batches)) + " batches")
+
+        return counts
+
+    def new_records(self, db_conn, hostname, records, seen):
+        '''
+        The records of a batch that we don't already have (by result_key) -
+        seen is the set of the probe's keys already in this write, which
+        the new records' keys are added to
+        '''
+        keys = list(set([str(record['result_key']) for record in records]) - seen)
+
+        for start in range(0, len(keys), KEY_CHUNK):
+            chunk = keys[start:start + KEY_CHUNK]
+
+            seen.update([row[0] for row in db_conn.execute("select result_key from fleet_results where hostname = ? and result_key in (" +
+                ",".join(["?"] * len(chunk)) + ")", [hostname] + chunk)])
+
+        new_records = []
+
+        for record in records:
+            result_key = str(record['result_key'])
+
+            # (also drops repeats within the batch)
+            if result_key not in seen:
+                seen.add(result_key)
+                new_records.append(record)
+
+        return new_records
+
+    def result_row(self, hostname, location, record, received):
+        ''' A result as a row of the fleet_results table '''
+        import json
+
+        columns = set(KEY_FIELDS + NUMERIC_COLUMNS + TEXT_COLUMNS)
+        extra = dict([(name, value) for (name, value) in record.items() if name not in columns])
+
+        return ((hostname, location, str(record['result_key']), column_value(record.get('timestamp'), True),
+            received) +
+            tuple([column_value(record.get(column), True) for column in NUMERIC_COLUMNS]) +
+            tuple([column_value(record.get(column), False) for column in TEXT_COLUMNS]) +
+            (json.dumps(extra, sort_keys=True),))
+
+    def add_rollup_values(self, rollups, hostname, location, record):
+        '''
+        Add a result's values to the in-memory rollups of a write (so that
+        each rollup row is read & written once per write, however many
+        results it gets)
+        '''
+        import time
+        from rollups import hist_bucket, rollup_values
+
+        try:
+            timestamp = int(float(record.get('timestamp')))
+        except (TypeError, ValueError):
+            timestamp = int(time.time())
+
+        period_start = timestamp - timestamp % 3600
+
+        for (metric, value) in rollup_values(record).items():
+            rollup = rollups.setdefault((period_start, hostname, location, metric),
+                {'count': 0, 'min': value, 'max': value, 'sum': 0.0, 'histogram': {}})
+
+            rollup['count'] += 1
+            rollup['min'] = min(rollup['min'], value)
+            rollup['max'] = max(rollup['max'], value)
+            rollup['sum'] += value
+
+            bucket = hist_bucket(value)
+            rollup['histogram'][bucket] = rollup['histogram'].get(bucket, 0) + 1
+
+    def update_rollups(self, db_conn, rollups):
+        ''' Merge the rollups of a write into the fleet_rollup_hourly table '''
+        import json
+        from rollups import hist_merge
+
+        for (key, rollup) in rollups.items():
+            row = db_conn.execute("select count, min, max, sum, histogram from fleet_rollup_hourly " +
+                "where period_start = ? and hostname = ? and location = ? and metric = ?", key).fetchone()
+
+            if row is not None:
+                rollup['count'] += row[0]
+                rollup['min'] = min(rollup['min'], row[1])
+                rollup['max'] = max(rollup['max'], row[2])
+                rollup['sum'] += row[3]
+                hist_merge(rollup['histogram'], json.loads(row[4]))
+
+            db_conn.execute("insert or replace into fleet_rollup_hourly (period_start, hostname, location, metric, count, min, max, sum, histogram) values (?,?,?,?,?,?,?,?,?)",
+                key + (rollup['count'], rollup['min'], rollup['max'], rollup['sum'],
+                json.dumps(rollup['histogram'], sort_keys=True)))
+
+    def cleanup(self, db_conn):
+        ''' Remove raw results older than keep_days '''
+        import sys
+        import time
+
+        self.last_cleanup = time.time()
+
+        try:
+            with db_conn:
+                db_conn.execute("delete from fleet_results where received < ?",
+                    (int(time.time() - self.keep_days * 86400),))
+        except Exception as ex:
+            sys.stderr.write("Db execute error when trying to remove old results: " + str(ex) + "\n")
+
+    def query_probes(self):
+        '''
+        The probes we have results from: a list of {hostname, location,
+        first_seen, last_seen, results}
+        '''
+        db_conn = self.connect()
+
+        try:
+            columns = ['hostname', 'location', 'first_seen', 'last_seen', 'results']
+
+            return [dict(zip(columns, row)) for row in db_conn.execute("select " + ", ".join(columns) +
+                " from fleet_probes order by hostname")]
+        finally:
+            db_conn.close()
+
+    def query_summary(self, metric, group='all', start=0, end=None, hostname=None, location=None):
+        '''
+        Summaries of a metric (see rollups.py for metric names) from start
+        to end (timestamps, rounded to hours), grouped by one of
+        SUMMARY_GROUPS. Returns a list of {group, count, min, max, mean,
+        p50, p95}, in group order.
+        '''
+        import time
+        from rollups import summarize
+
+        if group not in SUMMARY_GROUPS:
+            raise ValueError("group must be one of " + ", ".join(SUMMARY_GROUPS))
+
+        if end is None:
+            end = time.time()
+
+        query = "select period_start, hostname, location, count, min, max, sum, histogram from fleet_rollup_hourly where metric = ? and period_start >= ? and period_start < ?"
+        args = [metric, int(start) - int(start) % 3600, end]
+
+        if hostname is not None:
+            query += " and hostname = ?"
+            args.append(hostname)
+
+        if location is not None:
+            query += " and location = ?"
+            args.append(location)
+
+        groups = {}
+
+        db_conn = self.connect()
+
+        try:
+            for row in db_conn.execute(query, args):
+                (period_start, row_hostname, row_location) = row[:3]
+
+                key = {'hostname': row_hostname, 'location': row_location, 'hour': period_start,
+                    'day': period_start - period_start % 86400, 'all': 'all'}[group]
+
+                groups.setdefault(key, []).append(row[3:])
+        finally:
+            db_conn.close()
+
+        summaries = []
+
+        for key in sorted(groups.keys()):
+            summary = summarize(groups[key])
+            summary['group'] = key
+            summaries.append(summary)
+
+        return summaries
+
+    def count_results(self):
+        ''' Number of raw results stored '''
+        db_conn = self.connect()
+
+        try:
+            return db_conn.execute("select count(*) from fleet_results").fetchone()[0]
+        finally:
+            db_conn.close()
+
+class CollectorServer(object):
+    '''
+    A class to serve the collector's HTTP API (see the top of this file)
+    from a CollectorStore. Posted batches bigger than max_bytes (before or
+    after decompression) are refused.
+    '''
+
+    def __init__(self, store, bind_addr='', port=8086, debug=False, max_bytes=8 * 1024 * 1024):
+
+        self.store = store
+        self.bind_addr = bind_addr
+        self.port = int(port)
+        self.debug = debug
+        self.max_bytes = int(max_bytes)
+
+        self.server = None
+        self.thread = None
+
+    def ingest(self, body, gzipped):
+        '''
+        Store a posted batch: (HTTP status, response)
+        '''
+        try:
+            (hostname, location, records) = decode_batch(body, gzipped, self.max_bytes)
+        except ValueError as ex:
+            return (400, {'error': str(ex)})
+
+        result = self.store.submit(hostname, location, records)
+
+        if result is None:
+            return (503, {'error': "Unable to store results now - try again later"})
+
+        return (200, {'stored': result[0], 'duplicates': result[1]})
+
+    def query(self, path, params):
+        '''
+        Answer a query: (HTTP status, response)
+        '''
+        import time
+
+        def param(name, default=None):
+            return params.get(name, [default])[0]
+
+        if path == '/health':
+            return (200, dict(self.store.stats, queued=self.store.queue.qsize()))
+
+        if path == '/probes':
+            return (200, self.store.query_probes())
+
+        if path == '/summary':
+            try:
+                days = float(param('days', 7))
+                summaries = self.store.query_summary(param('metric', 'download'), param('group', 'all'),
+                    time.time() - days * 86400, None, param('hostname'), param('location'))
+            except ValueError as ex:
+                return (400, {'error': str(ex)})
+
+            return (200, summaries)
+
+        return (404, {'error': "Not found"})
+
+    def start(self):
+        '''
+        Start serving in a background thread. Returns the port we are
+        listening on (useful if port 0 was requested).
+        '''
+        import json
+        import threading
+
+        try:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+            from SocketServer import ThreadingMixIn
+            from urlparse import urlparse, parse_qs
+        except ImportError:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            from socketserver import ThreadingMixIn
+            from urllib.parse import urlparse, parse_qs
+
+        collector = self
+
+        class CollectorHandler(BaseHTTPRequestHandler):
+
+            def send_json(self, status, response):
+
+                body = json.dumps(response).encode('utf-8')
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+
+                url = urlparse(self.path)
+
+                self.send_json(*collector.query(url.path, parse_qs(url.query)))
+
+            def do_POST(self):
+
+                if urlparse(self.path).path not in ('/ingest', '/'):
+                    self.send_json(404, {'error': "Not found"})
+                    return
+
+                try:
+                    length = int(self.headers.get('Content-Length'))
+                except (TypeError, ValueError):
+                    self.send_json(411, {'error': "Content-Length required"})
+                    return
+
+                if length > collector.max_bytes:
+                    self.send_json(413, {'error': "Batch is too large"})
+                    return
+
+                gzipped = 'gzip' in (self.headers.get('Content-Encoding') or '')
+
+                self.send_json(*collector.ingest(self.rfile.read(length), gzipped))
+
+            def log_message(self, format, *args):
+                if collector.debug:
+                    print("Collector: " + self.address_string() + " " + (format % args))
+
+        class CollectorHTTPServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+            request_queue_size = 128
+
+        self.server = CollectorHTTPServer((self.bind_addr, self.port), CollectorHandler)
+        self.port = self.server.server_address[1]
+
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        if self.debug:
+            print("Collector: listening on port " + str(self.port))
+
+        return self.port
+
+    def stop(self):
+
+        if self.server is None:
+            return
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+        self.server = None
+
+def simulated_records(hostname, count, rng, start_time):
+    '''
+    count results from a simulated probe, as its http sink would post them
+    '''
+    import uuid
+
+    records = []
+
+    for index in range(count):
+        signal_level = rng.randint(-80, -40)
+
+        records.append({'timestamp': int(start_time + index * 300), 'hostname': hostname,
+            'location': '', 'interface': 'wlan0', 'ssid': 'fleet', 'bssid': 'AA:BB:CC:DD:EE:%02X' % rng.randint(0, 255),
+            'freq': '5.18', 'bit_rate': '%.1f' % rng.uniform(54, 866), 'signal_level': str(signal_level),
+            'ip_addr': '10.0.0.2', 'server_name': 'speedtest.example:8080', 'ping_time': rng.randint(5, 60),
+            'download_rate': '%.2f' % rng.uniform(10, 400), 'upload_rate': '%.2f' % rng.uniform(5, 100),
+            'ping_host1': '8.8.8.8', 'percent_loss1': '0', 'rtt_avg1': '%.3f' % rng.uniform(5, 40),
+            'ping_host2': 'NA', 'percent_loss2': 'NA', 'rtt_avg2': 'NA', 'result_key': uuid.uuid4().hex})
+
+    return records
+
+def post_batch(url, body, timeout=30):
+    '''
+    POST an encoded batch to a collector: (HTTP status, secs taken)
+    '''
+    import time
+
+    try:
+        from urllib2 import Request, urlopen, HTTPError
+    except ImportError:
+        from urllib.request import Request, urlopen
+        from urllib.error import HTTPError
+
+    request = Request(url, body, {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+
+    start = time.time()
+
+    try:
+        response = urlopen(request, timeout=timeout)
+        status = response.getcode()
+        response.close()
+    except HTTPError as ex:
+        status = ex.code
+    except Exception:
+        status = None
+
+    return (status, time.time() - start)
+
+def run_load_test(url, probes, posts, batch_size, concurrency=50, retry_rate=0.1, seed=None):
+    '''
+    Simulate probes each posting batches of results to a collector, from
+    concurrency threads. A share (retry_rate) of posts are sent twice, as a
+    probe would after a lost response. Returns the load test stats.
+    '''
+    import random
+    import threading
+    import time
+
+    rng = random.Random(seed)
+    start_time = time.time() - posts * batch_size * 300
+
+    # (each probe's posts go in order, probes are interleaved)
+    jobs = []
+
+    for post_number in range(posts):
+        for probe_number in range(probes):
+            hostname = 'probe-%04d' % probe_number
+            location = 'site-%02d' % (probe_number % 10)
+
+            records = simulated_records(hostname, batch_size, rng,
+                start_time + post_number * batch_size * 300)
+
+            body = encode_batch(hostname, location, records)
+
+            jobs.append(body)
+
+            if rng.random() < retry_rate:
+                jobs.append(body)
+
+    stats = {'probes': probes, 'results': probes * posts * batch_size, 'posts': len(jobs),
+        'failed': 0, 'latencies': []}
+
+    lock = threading.Lock()
+    jobs.reverse()
+
+    def worker():
+        while True:
+            with lock:
+                if not jobs:
+                    return
+                body = jobs.pop()
+
+            (status, secs) = post_batch(url, body)
+
+            with lock:
+                stats['latencies'].append(secs)
+
+                if status is None or not 200 <= status < 300:
+                    stats['failed'] += 1
+
+    threads = [threading.Thread(target=worker) for thread_number in range(min(concurrency, len(jobs)))]
+
+    started = time.time()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    stats['secs'] = time.time() - started
+
+    return stats
+
+def print_load_test(stats, stored=None):
+
+    latencies = sorted(stats['latencies'])
+
+    def percentile(pct):
+        return latencies[min(int(pct / 100.0 * len(latencies)), len(latencies) - 1)] * 1000
+
+    print("Probes:          " + str(stats['probes']))
+    print("Posts:           %d (%d failed)" % (stats['posts'], stats['failed']))
+    print("Results:         %d in %.2f secs (%.0f results/sec)" % (stats['results'], stats['secs'],
+        stats['results'] / stats['secs']))
+
+    if latencies:
+        print("Post latency:    p50 %.1f ms, p95 %.1f ms, max %.1f ms" % (percentile(50), percentile(95),
+            latencies[-1] * 1000))
+
+    if stored is not None:
+        print("Stored:          %d (%s)" % (stored, "OK" if stored == stats['results'] else "MISMATCH"))
+
+def main():
+
+    import argparse
+    import os
+    import shutil
+    import tempfile
+    import time
+
+    parser = argparse.ArgumentParser(description="Collect results from a fleet of speedtest agents")
+    parser.add_argument('--db', help="collector DB file (default: collector.db, or a temporary DB for a local load test)")
+    parser.add_argument('-b', '--bind', default='', help="address to listen on (default: all)")
+    parser.add_argument('-p', '--port', type=int, default=8086, help="port to listen on")
+    parser.add_argument('--keep-days', type=float, default=30, help="days to keep raw results (0 = forever)")
+    parser.add_argument('--load-test', type=int, metavar='PROBES', help="simulate this many probes posting results")
+    parser.add_argument('--url', help="load test this collector, rather than a local instance")
+    parser.add_argument('--posts', type=int, default=5, help="load test: posts per probe")
+    parser.add_argument('--batch', type=int, default=12, help="load test: results per post")
+    parser.add_argument('--concurrency', type=int, default=50, help="load test: simultaneous posts")
+    parser.add_argument('-d', '--debug', action='store_true', help="print debug messages")
+    args = parser.parse_args()
+
+    if not args.load_test:
+        store = CollectorStore(args.db or 'collector.db', args.debug, keep_days=args.keep_days)
+        store.start()
+
+        server = CollectorServer(store, args.bind, args.port, args.debug)
+        server.start()
+
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+        server.stop()
+        store.stop()
+        return
+
+    if args.url:
+        print_load_test(run_load_test(args.url, args.load_test, args.posts, args.batch, args.concurrency))
+        return
+
+    temp_dir = None
+
+    if args.db:
+        db_file = args.db
+    else:
+        temp_dir = tempfile.mkdtemp()
+        db_file = os.path.join(temp_dir, 'collector.db')
+
+    try:
+        store = CollectorStore(db_file, args.debug, keep_days=0)
+        store.start()
+
+        server = CollectorServer(store, '127.0.0.1', 0, args.debug)
+        port = server.start()
+
+        stats = run_load_test('http://127.0.0.1:' + str(port) + '/ingest', args.load_test, args.posts,
+            args.batch, args.concurrency)
+
+        server.stop()
+        store.stop()
+
+        # (a fresh DB should have exactly the results sent)
+        print_load_test(stats, store.count_results() if temp_dir else None)
+        print("Commits:         %d (%d duplicate results discarded)" % (store.stats['commits'],
+            store.stats['duplicates']))
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir)
+
+if __name__ == "__main__":
+    main()
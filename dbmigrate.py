@@ -0,0 +1,406 @@
+'''
+Versioned schema migrations for the agent's local SQLite DB. The schema
+version of a DB is held in its "user_version" pragma & any migrations newer
+than that version are applied (each in its own transaction) at start-up.
+'''
+from __future__ import print_function
+
+def copy_cached_results_to_outbox(db_conn):
+    '''
+    Move results waiting in the old cached_results table in to the outbox
+    '''
+    import json
+    import time
+    import uuid
+
+    cursor = db_conn.execute("select timestamp, ping_time, download_rate, upload_rate, ssid, bssid, freq, bit_rate, signal_level, ip_address, location, speedtest_server,ping_host1,pkts_tx1,percent_loss1,rtt_avg1,ping_host2,pkts_tx2,percent_loss2,rtt_avg2,ping_host3,pkts_tx3,percent_loss3,rtt_avg3 from cached_results order by id")
+
+    for row in cursor.fetchall():
+        db_conn.execute("insert into outbox (result_key, created, row_data) values (?,?,?)",
+            (uuid.uuid4().hex, int(time.time()), json.dumps(list(row))))
+
+def build_rollups(db_conn):
+    '''
+    Roll up the results already in speedtest_data (see rollups.py)
+    '''
+    from rollups import backfill_rollups
+
+    backfill_rollups(db_conn)
+
+# Each migration is (version, description, [sql statements or functions that
+# are passed the DB connection])
+MIGRATIONS = [
+
+    (1, "Initial schema", [
+        """create table if not exists speedtest_data (
+        id integer primary key autoincrement,
+        timestamp char(12) not null,
+        cleartext_date char (30) not null,
+        ping_time char(5) not null,
+        download_rate char(10) not null,
+        upload_rate char(10) not null,
+        ssid char(64) not null,
+        bssid char(17) not null,
+        freq char(6) not null,
+        bit_rate char(5) not null,
+        signal_level char(4) not null,
+        ip_address char(16) not null)""",
+
+        """create table if not exists error_logs (
+        id integer primary key autoincrement,
+        timestamp char(12) not null,
+        cleartext_date char (30) not null,
+        error_msg text not null)""",
+
+        """create table if not exists cached_results (
+        id integer primary key autoincrement,
+        timestamp char(12) not null,
+        ping_time char(5) not null,
+        download_rate char(10) not null,
+        upload_rate char(10) not null,
+        ssid char(64) not null,
+        bssid char(17) not null,
+        freq char(6) not null,
+        bit_rate char(5) not null,
+        signal_level char(4) not null,
+        ip_address char(16) not null,
+        location text not null,
+        speedtest_server char(60) not null,
+        ping_host1 char(60),
+        pkts_tx1 char(10),
+        percent_loss1 char(10),
+        rtt_avg1 char(10),
+        ping_host2 char(60),
+        pkts_tx2 char(10),
+        percent_loss2 char(10),
+        rtt_avg2 char(10),
+        ping_host3 char(60),
+        pkts_tx3 char(10),
+        percent_loss3 char(10),
+        rtt_avg3 char(10))""",
+    ]),
+
+    # Numeric values become INTEGER/REAL (with "NA" stored as NULL in
+    # speedtest_data) and timestamps are indexed so that retention queries
+    # can use range predicates rather than scanning the whole table
+    (2, "Typed columns & timestamp/bssid indexes", [
+        """create table speedtest_data_new (
+        id integer primary key autoincrement,
+        timestamp integer not null,
+        cleartext_date text not null,
+        ping_time real,
+        download_rate real,
+        upload_rate real,
+        ssid text,
+        bssid text,
+        freq real,
+        bit_rate real,
+        signal_level integer,
+        ip_address text)""",
+
+        """insert into speedtest_data_new select id, cast(timestamp as integer),
+        cleartext_date, cast(nullif(ping_time, 'NA') as real),
+        cast(nullif(download_rate, 'NA') as real), cast(nullif(upload_rate, 'NA') as real),
+        ssid, bssid, cast(nullif(freq, 'NA') as real), cast(nullif(bit_rate, 'NA') as real),
+        cast(nullif(signal_level, 'NA') as integer), ip_address from speedtest_data""",
+
+        "drop table speedtest_data",
+        "alter table speedtest_data_new rename to speedtest_data",
+        "create index speedtest_data_timestamp_idx on speedtest_data (timestamp)",
+        "create index speedtest_data_bssid_idx on speedtest_data (bssid, timestamp)",
+
+        """create table error_logs_new (
+        id integer primary key autoincrement,
+        timestamp integer not null,
+        cleartext_date text not null,
+        error_msg text not null)""",
+
+        """insert into error_logs_new select id, cast(timestamp as integer),
+        cleartext_date, error_msg from error_logs""",
+
+        "drop table error_logs",
+        "alter table error_logs_new rename to error_logs",
+        "create index error_logs_timestamp_idx on error_logs (timestamp)",
+
+        # cached rows are replayed to the sheet as-is, so "NA" values are
+        # kept (column affinity leaves non-numeric values as text)
+        """create table cached_results_new (
+        id integer primary key autoincrement,
+        timestamp text not null,
+        ping_time real,
+        download_rate real,
+        upload_rate real,
+        ssid text,
+        bssid text,
+        freq real,
+        bit_rate real,
+        signal_level integer,
+        ip_address text,
+        location text,
+        speedtest_server text,
+        ping_host1 text,
+        pkts_tx1 integer,
+        percent_loss1 real,
+        rtt_avg1 real,
+        ping_host2 text,
+        pkts_tx2 integer,
+        percent_loss2 real,
+        rtt_avg2 real,
+        ping_host3 text,
+        pkts_tx3 integer,
+        percent_loss3 real,
+        rtt_avg3 real)""",
+
+        "insert into cached_results_new select * from cached_results",
+        "drop table cached_results",
+        "alter table cached_results_new rename to cached_results",
+    ]),
+
+    # results waiting for upload are held in an outbox (JSON encoded sheet
+    # row, with a unique result key) until their upload is acknowledged
+    (3, "Upload outbox replaces cached_results", [
+        """create table outbox (
+        id integer primary key autoincrement,
+        result_key text not null unique,
+        created integer not null,
+        row_data text not null,
+        attempts integer not null default 0,
+        last_attempt integer,
+        last_target text,
+        next_attempt integer not null default 0,
+        last_error text)""",
+
+        "create index outbox_created_idx on outbox (created)",
+
+        copy_cached_results_to_outbox,
+
+        "drop table cached_results",
+    ]),
+
+    # the outbox holds a separate queue for each result sink (existing rows
+    # are results waiting for the Google sheet)
+    (4, "Per-sink outbox queues", [
+        """create table outbox_new (
+        id integer primary key autoincrement,
+        sink text not null,
+        result_key text not null,
+        created integer not null,
+        payload text not null,
+        attempts integer not null default 0,
+        last_attempt integer,
+        last_target text,
+        next_attempt integer not null default 0,
+        last_error text,
+        unique (sink, result_key))""",
+
+        """insert into outbox_new select id, 'gsheet', result_key, created, row_data,
+        attempts, last_attempt, last_target, next_attempt, last_error from outbox""",
+
+        "drop table outbox",
+        "alter table outbox_new rename to outbox",
+        "create index outbox_sink_idx on outbox (sink, next_attempt)",
+        "create index outbox_created_idx on outbox (created)",
+    ]),
+
+    # daily totals of Google API calls (see sheetsapi.py) - latency & wait
+    # times in secs
+    (5, "Google API call stats", [
+        """create table api_call_stats (
+        day text not null,
+        call text not null,
+        calls integer not null default 0,
+        errors integer not null default 0,
+        retries integer not null default 0,
+        throttled integer not null default 0,
+        latency_total real not null default 0,
+        latency_max real not null default 0,
+        wait_total real not null default 0,
+        primary key (day, call))""",
+    ]),
+
+    # LAN throughput results from our own reflector (see reflector.py)
+    (6, "Reflector throughput results", [
+        "alter table speedtest_data add column lan_tcp_down real",
+        "alter table speedtest_data add column lan_tcp_up real",
+        "alter table speedtest_data add column lan_udp_rate real",
+        "alter table speedtest_data add column lan_udp_loss real",
+        "alter table speedtest_data add column lan_udp_jitter real",
+    ]),
+
+    # time taken by each phase of a test cycle (see phasetimer.py) - one row
+    # per phase, duration in secs
+    (7, "Cycle phase timings", [
+        """create table cycle_phases (
+        id integer primary key autoincrement,
+        cycle_start integer not null,
+        seq integer not null,
+        phase text not null,
+        duration real not null)""",
+
+        "create index cycle_phases_cycle_start_idx on cycle_phases (cycle_start)",
+    ]),
+
+    # hourly & daily rollups of results per SSID/BSSID (see rollups.py) -
+    # histogram is a JSON encoded {bucket: count}
+    (8, "Hourly & daily result rollups", [
+        """create table rollup_hourly (
+        period_start integer not null,
+        ssid text not null,
+        bssid text not null,
+        metric text not null,
+        count integer not null,
+        min real not null,
+        max real not null,
+        sum real not null,
+        histogram text not null,
+        primary key (period_start, ssid, bssid, metric))""",
+
+        """create table rollup_daily (
+        period_start integer not null,
+        ssid text not null,
+        bssid text not null,
+        metric text not null,
+        count integer not null,
+        min real not null,
+        max real not null,
+        sum real not null,
+        histogram text not null,
+        primary key (period_start, ssid, bssid, metric))""",
+
+        "create index rollup_hourly_metric_idx on rollup_hourly (metric, period_start)",
+        "create index rollup_daily_metric_idx on rollup_daily (metric, period_start)",
+
+        build_rollups,
+    ]),
+
+    # ping test results (per target) alongside the other results
+    (9, "Ping target results", [
+        "alter table speedtest_data add column ping_host1 text",
+        "alter table speedtest_data add column percent_loss1 real",
+        "alter table speedtest_data add column rtt_avg1 real",
+        "alter table speedtest_data add column ping_host2 text",
+        "alter table speedtest_data add column percent_loss2 real",
+        "alter table speedtest_data add column rtt_avg2 real",
+        "alter table speedtest_data add column ping_host3 text",
+        "alter table speedtest_data add column percent_loss3 real",
+        "alter table speedtest_data add column rtt_avg3 real",
+    ]),
+
+    # wireless telemetry sampled during each test cycle (see telemetry.py) -
+    # series is the zlib compressed float32 samples of each of series_fields
+    (10, "Wireless telemetry runs", [
+        """create table telemetry_runs (
+        id integer primary key autoincrement,
+        cycle_start integer not null,
+        rate real not null,
+        samples integer not null,
+        duration real not null,
+        signal_min real,
+        signal_mean real,
+        signal_max real,
+        noise_min real,
+        noise_mean real,
+        noise_max real,
+        tx_bitrate_min real,
+        tx_bitrate_mean real,
+        tx_bitrate_max real,
+        rx_mbps_min real,
+        rx_mbps_mean real,
+        rx_mbps_max real,
+        tx_mbps_min real,
+        tx_mbps_mean real,
+        tx_mbps_max real,
+        retry_delta real,
+        beacon_delta real,
+        series_fields text,
+        series blob)""",
+
+        "create index telemetry_runs_cycle_start_idx on telemetry_runs (cycle_start)",
+    ]),
+
+    # wireless link events (roams, disconnects, IP changes...) as they
+    # happen (see linkevents.py)
+    (11, "Link events", [
+        """create table link_events (
+        id integer primary key autoincrement,
+        timestamp integer not null,
+        if_name text not null,
+        event text not null,
+        bssid text,
+        prev_bssid text,
+        ip_addr text,
+        detail text)""",
+
+        "create index link_events_timestamp_idx on link_events (timestamp)",
+    ]),
+
+    # interface each result was tested from (probes can test from several)
+    (12, "Result interface", [
+        "alter table speedtest_data add column interface text",
+    ]),
+
+    # counts of test cycles run, skipped (another run was still going) &
+    # missed (an earlier cycle overran them) - see scheduler.py
+    (13, "Schedule stats", [
+        """create table schedule_stats (
+        event text primary key,
+        count integer not null default 0,
+        last_timestamp integer not null default 0)""",
+    ]),
+]
+
+def get_schema_version(db_conn):
+    ''' Current schema version of a DB '''
+    return db_conn.execute("pragma user_version").fetchone()[0]
+
+def migrate_db(db_file, logger, debug=False):
+    '''
+    Bring a DB up to the latest schema version, migrating an existing DB in
+    place (or creating the schema in a new one). Returns the schema version
+    of the DB, or False if a migration failed (that migration is rolled back).
+    '''
+    import sqlite3
+
+    try:
+        # we manage transactions ourselves, so that each migration (including
+        # its DDL statements) is applied or rolled back as a whole
+        db_conn = sqlite3.connect(db_file, isolation_level=None)
+    except Exception as ex:
+        logger.log_error("Db connection error when trying to migrate schema: " + str(ex))
+        return False
+
+    schema_version = get_schema_version(db_conn)
+
+    for (version, description, statements) in MIGRATIONS:
+
+        if version <= schema_version:
+            continue
+
+        if debug:
+            print("Applying DB migration " + str(version) + ": " + description)
+
+        try:
+            db_conn.execute("begin immediate")
+
+            for statement in statements:
+                if callable(statement):
+                    statement(db_conn)
+                else:
+                    db_conn.execute(statement)
+
+            db_conn.execute("pragma user_version = " + str(int(version)))
+            db_conn.execute("commit")
+        except Exception as ex:
+            db_conn.execute("rollback")
+            db_conn.close()
+            logger.log_error("DB migration " + str(version) + " (" + description + ") failed: " + str(ex))
+            return False
+
+        schema_version = version
+
+        if debug:
+            print("Applied DB migration " + str(version) + ": " + description)
+
+    db_conn.close()
+
+    return schema_version
@@ -1,55 +1,243 @@
-
 class Gsheet(object):
 
     '''
     A class to read and manipulate a Google sheet for the WLANPerfAgent
+
+    If a cache_file is supplied, the Google access token, spreadsheet key and
+    worksheet details are cached on disk between runs, so that we don't have
+    to go through token exchange & spreadsheet discovery on every run. Cached
+    spreadsheet details are re-discovered after cache_ttl secs, or when Google
+    tells us they are no longer valid (401/404).
+
+    All API calls go through a SheetsApi object (rate limiting, retries &
+    call stats) - pass in a shared one, or one is created for us.
     '''
 
-    def __init__(self, json_keyfile, spreadsheet_name, logger_obj, debug=False):
+    def __init__(self, json_keyfile, spreadsheet_name, logger_obj, debug=False, cache_file=None, cache_ttl=3600, api=None):
     
         import subprocess
         import time
+        from sheetsapi import SheetsApi
         
         self.json_keyfile = json_keyfile
         self.spreadsheet_name = spreadsheet_name
         self.debug = debug
         self.logger_obj = logger_obj
+
+        self.cache_file = cache_file
+        self.cache_ttl = cache_ttl
+
+        self.client = False
+        self.credentials = False
+
+        if api is None:
+            api = SheetsApi(logger_obj, debug)
+
+        self.api = api
+
+        self.cache = self.load_cache()
+
+        # worksheet objects we have opened, by title
+        self.worksheets = {}
         
-        # open the spreadsheet and return object
+        # open the spreadsheet and return object (no use to anyone if we
+        # can't, even if we have its worksheet list cached)
         self.spreadsheet = self.open_gspread_spreadsheet(self.spreadsheet_name, self.json_keyfile)
+
+        if not self.spreadsheet:
+            raise Exception("Unable to open Google spreadsheet: " + str(self.spreadsheet_name))
         
         # create the worksheet title list
-        self._worksheet_list = self.spreadsheet.worksheets()
-        
-        self.worksheet_titles = []
-        for sheet_instance in self._worksheet_list:
-            self.worksheet_titles.append(sheet_instance.title)
+        self.load_worksheet_titles()
+
+        self.save_cache()
         
         self.todays_worksheet_name = time.strftime("%d-%b-%Y")
 
+    def load_cache(self):
+        '''
+        Read our cached token & spreadsheet details. Cached spreadsheet details
+        are ignored if they have expired, or are for a different spreadsheet.
+        '''
+        import json
+        import time
+
+        if not self.cache_file:
+            return {}
+
+        try:
+            with open(self.cache_file) as cache_file_obj:
+                cache = json.load(cache_file_obj)
+        except Exception as ex:
+            if self.debug:
+                print("No usable Google sheet cache: " + str(ex))
+            return {}
+
+        if cache.get('spreadsheet_name') != self.spreadsheet_name or cache.get('json_keyfile') != self.json_keyfile:
+            return {}
+
+        if cache.get('cached_at', 0) + self.cache_ttl < time.time():
+            if self.debug:
+                print("Google sheet cache is stale - spreadsheet will be re-discovered")
+
+            # token is still good until it expires
+            return {'access_token': cache.get('access_token'), 'token_expiry': cache.get('token_expiry', 0)}
+
+        return cache
+
+    def save_cache(self):
+        '''
+        Write our token & spreadsheet details to the cache file (only readable
+        by us, as it contains an access token)
+        '''
+        import json
+        import os
+        import time
+
+        if not self.cache_file or not self.spreadsheet:
+            return False
+
+        self.cache['spreadsheet_name'] = self.spreadsheet_name
+        self.cache['json_keyfile'] = self.json_keyfile
+        self.cache.setdefault('cached_at', int(time.time()))
+
+        self.update_cached_token()
+
+        try:
+            cache_fd = os.open(self.cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(cache_fd, 'w') as cache_file_obj:
+                json.dump(self.cache, cache_file_obj)
+        except Exception as ex:
+            self.logger_obj.log_error("Error writing Google sheet cache: " + str(ex))
+            return False
+
+        return True
+
+    def update_cached_token(self):
+        '''
+        Copy the current access token from our credentials in to the cache
+        '''
+        import calendar
+
+        if self.credentials and self.credentials.access_token and self.credentials.token_expiry:
+            self.cache['access_token'] = self.credentials.access_token
+            self.cache['token_expiry'] = calendar.timegm(self.credentials.token_expiry.utctimetuple())
+
+    def invalidate_cache(self):
+        '''
+        Throw away everything we have cached (token & spreadsheet details)
+        '''
+        import os
+
+        if self.debug:
+            print("Invalidating Google sheet cache")
+
+        self.cache = {}
+        self.worksheets = {}
+
+        if self.cache_file and os.path.exists(self.cache_file):
+            try:
+                os.remove(self.cache_file)
+            except Exception as ex:
+                self.logger_obj.log_error("Error removing Google sheet cache: " + str(ex))
+
+    def handle_api_error(self, ex):
+        '''
+        Check a failed Google API call - if it tells us our token or cached
+        spreadsheet details are no longer valid, invalidate the cache so that
+        they are re-discovered next time. Returns True if cache invalidated.
+        '''
+        from sheetsapi import api_error_status
+
+        status = api_error_status(ex)
+
+        # a deleted worksheet shows up as a range that can't be parsed
+        if status in (401, 404) or (status == 400 and 'Unable to parse range' in str(ex)):
+            self.invalidate_cache()
+            return True
+
+        return False
         
     def open_gspread_spreadsheet(self, spreadsheet_name, json_keyfile):
     
+        import datetime
+        import time
         import gspread
         from oauth2client.service_account import ServiceAccountCredentials
 
         try:
             scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
             credentials = ServiceAccountCredentials.from_json_keyfile_name(json_keyfile, scope)
+
+            # re-use our cached access token if it has a while left to run
+            if self.cache.get('access_token') and self.cache.get('token_expiry', 0) > time.time() + 60:
+                credentials.access_token = self.cache['access_token']
+                credentials.token_expiry = datetime.datetime.utcfromtimestamp(self.cache['token_expiry'])
+
+                if self.debug:
+                    print("Using cached Google access token")
+
             client = gspread.authorize(credentials)
-            spreadsheet = client.open(spreadsheet_name)
+
+            # hang on to these so that a long-lived object can re-use them
+            self.credentials = credentials
+            self.client = client
+
+            if self.cache.get('spreadsheet_key'):
+                try:
+                    return self.api.call('open_by_key', client.open_by_key, self.cache['spreadsheet_key'])
+                except Exception as ex:
+                    if not self.handle_api_error(ex):
+                        raise
+
+                    # cached details no longer valid - start again from scratch
+                    return self.open_gspread_spreadsheet(spreadsheet_name, json_keyfile)
+
+            spreadsheet = self.api.call('open', client.open, spreadsheet_name)
+
+            self.cache['spreadsheet_key'] = spreadsheet.id
+
             return spreadsheet
         except Exception as ex:
             self.logger_obj.log_error("Error opening Google spreadsheet: " + str(ex))
             return False
 
+    def load_worksheet_titles(self):
+        '''
+        Build our list of worksheet titles, from the cache if we can
+        '''
+        if 'worksheets' not in self.cache:
+            self._worksheet_list = self.api.call('worksheets', self.spreadsheet.worksheets)
+
+            self.cache['worksheets'] = {}
+            for sheet_instance in self._worksheet_list:
+                self.cache['worksheets'][sheet_instance.title] = sheet_instance.id
+                self.worksheets[sheet_instance.title] = sheet_instance
+        elif self.debug:
+            print("Using cached worksheet list")
+
+        self.worksheet_titles = list(self.cache['worksheets'].keys())
+
     def open_gspread_worksheet(self, worksheet_name):
 
+        # (each worksheet is only looked up once by a long-lived object)
+        if worksheet_name in self.worksheets:
+            return self.worksheets[worksheet_name]
+
         try:
             spreadsheet = self.spreadsheet
-            worksheet = spreadsheet.worksheet(worksheet_name)
+            worksheet_id = self.cache.get('worksheets', {}).get(worksheet_name)
+
+            # if we know the worksheet id, look it up by that (gspread 5+)
+            if worksheet_id is not None and hasattr(spreadsheet, 'get_worksheet_by_id'):
+                worksheet = self.api.call('get_worksheet_by_id', spreadsheet.get_worksheet_by_id, worksheet_id)
+            else:
+                worksheet = self.api.call('worksheet', spreadsheet.worksheet, worksheet_name)
+
+            self.worksheets[worksheet_name] = worksheet
             return worksheet
         except Exception as ex:
+            self.handle_api_error(ex)
             self.logger_obj.log_error("Error opening Google worksheet: " + str(ex))
             return False
 
@@ -63,22 +251,45 @@ class Gsheet(object):
     def create_worksheet_if_needed(self):
     
         import time
+        from phasetimer import PHASE_FIELDS
 
         # create new sheet is todays worksheet no present
         if not self.worksheet_exists(self.todays_worksheet_name):
         
             try:
-                worksheet = self.spreadsheet.add_worksheet(self.todays_worksheet_name, 600, 26)
+                worksheet = self.api.call('add_worksheet', self.spreadsheet.add_worksheet, self.todays_worksheet_name, 600, 45,
+                    idempotent=False)
             except Exception as ex:
                 self.logger_obj.log_error("Error adding new worksheet: " + str(ex))
+
+                # (the worksheet may have been added before the error came
+                # back - re-read the list so that we don't try to add it again)
+                self.cache.pop('worksheets', None)
+
+                try:
+                    self.load_worksheet_titles()
+                    self.save_cache()
+                except Exception as error:
+                    self.handle_api_error(error)
+
                 return False
+
+            # keep our title list current so we don't try to add it again
+            self.worksheet_titles.append(self.todays_worksheet_name)
+            self.cache.setdefault('worksheets', {})[self.todays_worksheet_name] = worksheet.id
+            self.worksheets[self.todays_worksheet_name] = worksheet
+            self.save_cache()
             
-            col_headers = ["timestamp","ping_time (ms)","download_rate (mbps)","upload_rate (mbps)", "ssid","bssid","freq","bit_rate","signal_level","ip_address","location","speedtest_server","ping_host1","pkts_tx1","percent_loss1","rtt_avg1","ping_host2","pkts_tx2","percent_loss2","rtt_avg2","ping_host3","pkts_tx3","percent_loss3","rtt_avg3"]
+            col_headers = ["timestamp","ping_time (ms)","download_rate (mbps)","upload_rate (mbps)", "ssid","bssid","freq","bit_rate","signal_level","ip_address","location","speedtest_server","ping_host1","pkts_tx1","percent_loss1","rtt_avg1","ping_host2","pkts_tx2","percent_loss2","rtt_avg2","ping_host3","pkts_tx3","percent_loss3","rtt_avg3","result_id","lan_tcp_down (mbps)","lan_tcp_up (mbps)","lan_udp_rate (mbps)","lan_udp_loss (%)","lan_udp_jitter (ms)","interface"]
+
+            # (filled in if phase timing upload is on)
+            col_headers += [field + " (s)" for field in PHASE_FIELDS]
             
             try:
-                append_result = worksheet.append_row(col_headers)
+                append_result = self.api.call('append_row', worksheet.append_row, col_headers, idempotent=False)
             except Exception as ex:
                 self.logger_obj.log_error("Error adding col headers to new sheet: " + str(ex))
+                append_result = False
 
             
             if self.debug:
@@ -92,6 +303,91 @@ class Gsheet(object):
         else:
             return False  
 
+    def append_rows(self, worksheet, rows, chunk_size=500):
+        '''
+        Append a list of rows to a worksheet with a single values-append API
+        call (per chunk_size rows), rather than one append_row call per row.
+
+        Returns a list with the append result (API response dict, or False if
+        the append failed) for each chunk, in order - stops at the first
+        failed chunk.
+        '''
+        append_results = []
+
+        for chunk_start in range(0, len(rows), chunk_size):
+
+            chunk = [list(row) for row in rows[chunk_start:chunk_start + chunk_size]]
+
+            try:
+                append_result = self.api.call('values_append', worksheet.spreadsheet.values_append, "'" + worksheet.title + "'!A1",
+                    {'valueInputOption': 'RAW', 'insertDataOption': 'INSERT_ROWS'}, {'values': chunk}, idempotent=False)
+            except Exception as ex:
+                self.handle_api_error(ex)
+                append_result = str(ex)
+
+            if self.debug:
+                print("Result of spreadsheet batch append operation (" + str(len(chunk)) + " rows): " + str(append_result))
+
+            if type(append_result) is not dict:
+                self.logger_obj.log_error("Batch append operation appears to have failed (should be dict: " + str(append_result))
+                append_results.append(False)
+                break
+
+            append_results.append(append_result)
+
+        return append_results
+
+    def trim_worksheet_rows(self, worksheet, row_count):
+        '''
+        Delete the first row_count rows of a worksheet with a single batch
+        update API call (rather than one delete_row call per row)
+        '''
+        trim_request = {'requests': [{'deleteDimension': {'range': {
+            'sheetId': worksheet.id, 'dimension': 'ROWS', 'startIndex': 0, 'endIndex': row_count}}}]}
+
+        try:
+            trim_result = self.api.call('batch_update', worksheet.spreadsheet.batch_update, trim_request, idempotent=False)
+        except Exception as ex:
+            self.handle_api_error(ex)
+            self.logger_obj.log_error("Error trimming rows from worksheet: " + str(ex))
+            return False
+
+        if self.debug:
+            print("Result of worksheet trim operation (" + str(row_count) + " rows): " + str(trim_result))
+
+        return True
+
+    def refresh(self):
+        '''
+        Prepare a long-lived Gsheet object (e.g. held by the agent daemon) for
+        another test cycle: renew the access token if it has expired and roll
+        over to a new worksheet name if the day has changed. This avoids a full
+        re-authorization and worksheet listing on every cycle.
+        '''
+        import time
+
+        # (never opened our spreadsheet - no use re-using us)
+        if not self.spreadsheet:
+            return False
+
+        try:
+            if self.credentials and self.credentials.access_token_expired:
+                if self.debug:
+                    print("Google access token expired - renewing")
+                self.api.call('login', self.client.login)
+                self.save_cache()
+        except Exception as ex:
+            self.logger_obj.log_error("Error renewing Google access token: " + str(ex))
+            return False
+
+        # cache invalidated or stale - let our owner start again from scratch
+        if self.cache_file and 'spreadsheet_key' not in self.load_cache():
+            return False
+
+        self.todays_worksheet_name = time.strftime("%d-%b-%Y")
+
+        return True
+
     def get_todays_worksheet_name(self):
         return self.todays_worksheet_name
     
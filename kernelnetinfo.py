@@ -0,0 +1,317 @@
+'''
+Classes to read wireless, IP & route information for a network interface
+directly from kernel interfaces (/proc, sysfs & wireless extension ioctls),
+rather than scraping the output of iwconfig, ifconfig & route
+'''
+from __future__ import print_function
+
+# wireless extension & socket ioctls (see linux/wireless.h & linux/sockios.h)
+SIOCGIFADDR = 0x8915
+SIOCGIWFREQ = 0x8B05
+SIOCGIWAP = 0x8B15
+SIOCGIWESSID = 0x8B1B
+SIOCGIWRATE = 0x8B21
+
+IW_ESSID_MAX_SIZE = 32
+
+# route flags (linux/route.h)
+RTF_UP = 0x0001
+RTF_GATEWAY = 0x0002
+
+def decode_bssid(data):
+    '''
+    BSSID from SIOCGIWAP sockaddr data. Returns "NA" if not associated (the
+    same addresses that iwconfig reports as "Not-Associated")
+    '''
+    mac = bytearray(data)[2:8]
+
+    if len(mac) < 6 or mac in (bytearray(6), bytearray(b'\x44' * 6), bytearray(b'\xff' * 6)):
+        return "NA"
+
+    return ":".join(["%02X" % octet for octet in mac])
+
+def decode_freq(data):
+    '''
+    Frequency (GHz, formatted as iwconfig does) from SIOCGIWFREQ iw_freq data
+    '''
+    import struct
+
+    (mantissa, exponent, index, flags) = struct.unpack('=ihBB', data[:8])
+
+    freq = mantissa * (10 ** exponent)
+
+    # small values are a channel number rather than a frequency
+    if freq < 1000:
+        return "NA"
+
+    return '%g' % (freq / 1e9)
+
+def decode_bit_rate(data):
+    '''
+    Bit rate (Mb/s, formatted as iwconfig does) from SIOCGIWRATE iw_param data
+    '''
+    import struct
+
+    (value, fixed, disabled, flags) = struct.unpack('=iBBH', data[:8])
+
+    if value <= 0 or disabled:
+        return "NA"
+
+    return '%g' % (value / 1e6)
+
+def decode_ip_addr(data):
+    '''
+    IPv4 address from SIOCGIFADDR sockaddr_in data
+    '''
+    import socket
+
+    return socket.inet_ntoa(data[4:8])
+
+def parse_proc_net_wireless(content, if_name):
+    '''
+    Parse /proc/net/wireless for an interface, returning a dictionary of:
+    status, link, level, noise, nwid, crypt, frag, retry, misc, beacon
+    (or None if the interface is not listed, i.e. is not wireless)
+    '''
+    fields = ['status', 'link', 'level', 'noise', 'nwid', 'crypt', 'frag',
+        'retry', 'misc', 'beacon']
+
+    for line in content.splitlines():
+        if ':' not in line:
+            continue
+
+        (name, values) = line.split(':', 1)
+
+        if name.strip() != if_name:
+            continue
+
+        # quality values have a trailing "." if they have been updated
+        values = [value.rstrip('.') for value in values.split()]
+
+        return dict(zip(fields, values))
+
+    return None
+
+def parse_proc_net_route(content, if_name):
+    '''
+    Find the default gateway for an interface from /proc/net/route. Returns
+    the gateway address, or None if no default route via the interface.
+    '''
+    import socket
+    import struct
+
+    for line in content.splitlines()[1:]:
+        columns = line.split()
+
+        if len(columns) < 4 or columns[0] != if_name:
+            continue
+
+        (destination, gateway, flags) = (columns[1], columns[2], int(columns[3], 16))
+
+        if destination == '00000000' and flags & RTF_UP and flags & RTF_GATEWAY:
+            return socket.inet_ntoa(struct.pack('<L', int(gateway, 16)))
+
+    return None
+
+class KernelNetInfo(object):
+    '''
+    A class to read the state of a network interface from the kernel
+    '''
+
+    def __init__(self, if_name, proc_root='/proc', sys_root='/sys', debug=False):
+
+        self.if_name = if_name
+        self.proc_root = proc_root
+        self.sys_root = sys_root
+        self.debug = debug
+
+    def read_file(self, path):
+        '''
+        Read a /proc or /sys file (path relative to the proc/sys roots, e.g.
+        "proc/net/route")
+        '''
+        import os
+
+        (root_name, rel_path) = path.split('/', 1)
+        root = self.proc_root if root_name == 'proc' else self.sys_root
+
+        with open(os.path.join(root, rel_path)) as file_obj:
+            return file_obj.read()
+
+    def read_ioctl(self, name):
+        '''
+        Run a wireless extension/socket ioctl for our interface & return the
+        raw result data. name is one of: essid, ap, freq, rate, ifaddr.
+
+        Raises IOError/OSError if the ioctl fails (e.g. no such device, or no
+        address assigned)
+        '''
+        import array
+        import fcntl
+        import socket
+        import struct
+
+        if_name = self.if_name.encode('ascii')
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        try:
+            if name == 'essid':
+                # essid is written to a buffer we pass a pointer to
+                essid_buf = array.array('B', bytearray(IW_ESSID_MAX_SIZE + 1))
+                (buf_addr, buf_len) = essid_buf.buffer_info()
+                request = struct.pack('16sPHH', if_name, buf_addr, buf_len, 0)
+                request += b'\0' * (32 - len(request))
+
+                result = fcntl.ioctl(sock.fileno(), SIOCGIWESSID, request)
+                length = struct.unpack('H', result[16 + struct.calcsize('P'):][:2])[0]
+
+                return bytes(bytearray(essid_buf)[:length])
+
+            ioctls = {'ap': SIOCGIWAP, 'freq': SIOCGIWFREQ, 'rate': SIOCGIWRATE,
+                'ifaddr': SIOCGIFADDR}
+
+            request = struct.pack('16s24s', if_name, b'\0' * 24)
+            result = fcntl.ioctl(sock.fileno(), ioctls[name], request)
+
+            return result[16:32]
+        finally:
+            sock.close()
+
+    def is_wireless(self):
+        ''' Is our interface a wireless interface? '''
+        return self.get_wireless_stats() is not None
+
+    def get_wireless_stats(self):
+        ''' Link quality, signal, noise & discarded packet stats '''
+        import errno
+
+        try:
+            content = self.read_file('proc/net/wireless')
+        except (IOError, OSError) as ex:
+            # no /proc/net/wireless at all if there are no wireless devices
+            if ex.errno == errno.ENOENT:
+                return None
+            raise
+
+        return parse_proc_net_wireless(content, self.if_name)
+
+    def get_operstate(self):
+        ''' Interface operational state (e.g. up, down, dormant) '''
+        return self.read_file('sys/class/net/' + self.if_name + '/operstate').strip()
+
+    def get_ssid(self):
+        essid = self.read_ioctl('essid').rstrip(b'\0')
+        if not essid:
+            return "NA"
+
+        # keep to the native string type (as the CLI backend returns)
+        if isinstance(essid, str):
+            return essid
+        return essid.decode('utf-8', 'replace')
+
+    def get_bssid(self):
+        return decode_bssid(self.read_ioctl('ap'))
+
+    def get_freq(self):
+        return decode_freq(self.read_ioctl('freq'))
+
+    def get_bit_rate(self):
+        return decode_bit_rate(self.read_ioctl('rate'))
+
+    def get_ip_addr(self):
+        ''' Interface IPv4 address, "NA" if none assigned '''
+        import errno
+
+        try:
+            return decode_ip_addr(self.read_ioctl('ifaddr'))
+        except (IOError, OSError) as ex:
+            if ex.errno == errno.EADDRNOTAVAIL:
+                return "NA"
+            raise
+
+    def get_def_gw(self):
+        ''' Default gateway via our interface (None if no default route) '''
+        return parse_proc_net_route(self.read_file('proc/net/route'), self.if_name)
+
+    def get_interface_counter(self, name):
+        ''' An interface statistics counter (e.g. rx_bytes, tx_bytes) '''
+        return int(self.read_file('sys/class/net/' + self.if_name + '/statistics/' + name))
+
+    def save_fixture(self, fixture_dir):
+        '''
+        Save the current kernel state of our interface to a fixture directory
+        that can be replayed off-device with FixtureNetInfo
+        '''
+        import binascii
+        import os
+
+        for path in ['proc/net/wireless', 'proc/net/route', 'sys/class/net/' + self.if_name + '/operstate',
+            'sys/class/net/' + self.if_name + '/statistics/rx_bytes', 'sys/class/net/' + self.if_name + '/statistics/tx_bytes']:
+            file_name = os.path.join(fixture_dir, path)
+
+            try:
+                content = self.read_file(path)
+            except (IOError, OSError):
+                continue
+
+            if not os.path.isdir(os.path.dirname(file_name)):
+                os.makedirs(os.path.dirname(file_name))
+
+            with open(file_name, 'w') as file_obj:
+                file_obj.write(content)
+
+        ioctl_dir = os.path.join(fixture_dir, 'ioctl', self.if_name)
+
+        if not os.path.isdir(ioctl_dir):
+            os.makedirs(ioctl_dir)
+
+        for name in ['essid', 'ap', 'freq', 'rate', 'ifaddr']:
+            try:
+                data = binascii.hexlify(self.read_ioctl(name)).decode('ascii')
+            except (IOError, OSError) as ex:
+                data = 'errno:' + str(ex.errno)
+
+            with open(os.path.join(ioctl_dir, name), 'w') as file_obj:
+                file_obj.write(data + '\n')
+
+class FixtureNetInfo(KernelNetInfo):
+    '''
+    Replay interface state saved with KernelNetInfo.save_fixture (used to
+    test & benchmark off-device). Layout of the fixture directory:
+
+        proc/net/wireless
+        proc/net/route
+        sys/class/net/<if_name>/operstate
+        sys/class/net/<if_name>/statistics/{rx_bytes,tx_bytes}
+        ioctl/<if_name>/{essid,ap,freq,rate,ifaddr}  (hex data or "errno:<n>")
+    '''
+
+    def __init__(self, if_name, fixture_dir, debug=False):
+
+        import os
+
+        KernelNetInfo.__init__(self, if_name, os.path.join(fixture_dir, 'proc'),
+            os.path.join(fixture_dir, 'sys'), debug)
+
+        self.fixture_dir = fixture_dir
+
+    def read_ioctl(self, name):
+
+        import binascii
+        import os
+
+        ioctl_file = os.path.join(self.fixture_dir, 'ioctl', self.if_name, name)
+
+        if not os.path.exists(ioctl_file):
+            # no such device
+            raise IOError(19, "No such device")
+
+        with open(ioctl_file) as file_obj:
+            data = file_obj.read().strip()
+
+        if data.startswith('errno:'):
+            errno_value = int(data.split(':')[1])
+            raise IOError(errno_value, os.strerror(errno_value))
+
+        return binascii.unhexlify(data)
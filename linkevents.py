@@ -0,0 +1,739 @@
+#!/usr/bin/python
+'''
+Listen for wireless link events from the kernel as they happen: roams,
+disconnects, IP address changes & the interface going down - rather than
+only noticing them at the next test cycle. Events are timestamped & stored
+in the link_events table of the local DB, and a connection that stays down
+for more than a few secs triggers recovery straight away.
+
+Events come from netlink: nl80211 (connect/roam/disconnect) if the driver
+is a cfg80211 one, otherwise the wireless extensions events carried by
+rtnetlink; rtnetlink also gives us link state & address changes.
+
+Raw events can be recorded on a probe & replayed off-device (see
+FixtureEventSource):
+
+    python linkevents.py --record wlan0 > events.txt
+    python linkevents.py --replay events.txt --if wlan0
+'''
+from __future__ import print_function
+
+# netlink protocols & groups
+NETLINK_ROUTE = 0
+NETLINK_GENERIC = 16
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+SOL_NETLINK = 270
+NETLINK_ADD_MEMBERSHIP = 1
+
+# netlink message types & flags
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 1
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+
+# rtnetlink attributes
+IFLA_IFNAME = 3
+IFLA_WIRELESS = 11
+IFLA_OPERSTATE = 16
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+# interface operational states (IF_OPER_*)
+OPERSTATES = ['unknown', 'notpresent', 'down', 'lowerlayerdown', 'testing', 'dormant', 'up']
+
+# wireless extensions event: new access point (all zeros if disassociated)
+SIOCGIWAP = 0x8B15
+
+# generic netlink controller
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+CTRL_ATTR_MCAST_GROUPS = 7
+CTRL_ATTR_MCAST_GRP_NAME = 1
+CTRL_ATTR_MCAST_GRP_ID = 2
+
+# nl80211 commands & attributes
+NL80211_CMD_CONNECT = 46
+NL80211_CMD_ROAM = 47
+NL80211_CMD_DISCONNECT = 48
+NL80211_ATTR_IFINDEX = 3
+NL80211_ATTR_MAC = 6
+NL80211_ATTR_REASON_CODE = 54
+NL80211_ATTR_DISCONNECTED_BY_AP = 71
+NL80211_ATTR_STATUS_CODE = 72
+
+# events that mean our connection is down (& the event that clears each)
+DOWN_EVENTS = {'disconnect': 'connect', 'ip_lost': 'ip_change', 'link_down': 'link_up'}
+
+def netlink_align(length):
+    return (length + 3) & ~3
+
+def parse_messages(data):
+    '''
+    Split netlink data in to messages: [(type, flags, payload)]
+    '''
+    import struct
+
+    messages = []
+    offset = 0
+
+    while offset + 16 <= len(data):
+        (length, msg_type, flags, seq, pid) = struct.unpack_from('=IHHII', data, offset)
+
+        if length < 16 or offset + length > len(data):
+            break
+
+        messages.append((msg_type, flags, data[offset + 16:offset + length]))
+        offset += netlink_align(length)
+
+    return messages
+
+def parse_attrs(data, offset=0):
+    '''
+    Netlink attributes: {type: data} (nested attributes are left as data)
+    '''
+    import struct
+
+    attrs = {}
+
+    while offset + 4 <= len(data):
+        (length, attr_type) = struct.unpack_from('=HH', data, offset)
+
+        if length < 4:
+            break
+
+        # (without the nested & byte order flags)
+        attrs[attr_type & 0x3fff] = data[offset + 4:offset + length]
+        offset += netlink_align(length)
+
+    return attrs
+
+def pack_attr(attr_type, data):
+
+    import struct
+
+    length = 4 + len(data)
+
+    return struct.pack('=HH', length, attr_type) + data + b'\0' * (netlink_align(length) - length)
+
+def pack_message(msg_type, payload, flags=0, seq=0):
+
+    import struct
+
+    return struct.pack('=IHHII', 16 + len(payload), msg_type, flags, seq, 0) + payload
+
+def format_mac(data):
+    ''' MAC address, formatted as kernelnetinfo does '''
+    return ":".join(["%02X" % octet for octet in bytearray(data[:6])])
+
+def attr_string(data):
+    return data.split(b'\0')[0].decode('utf-8', 'replace')
+
+def decode_wext_events(data):
+    '''
+    New access points from wireless extensions events (IFLA_WIRELESS): a
+    list of BSSIDs (None if disassociated)
+    '''
+    import struct
+
+    bssids = []
+    offset = 0
+
+    while offset + 4 <= len(data):
+        (length, cmd) = struct.unpack_from('=HH', data, offset)
+
+        if length < 4:
+            break
+
+        # (event header, then a sockaddr: family & the MAC)
+        if cmd == SIOCGIWAP and length >= 12:
+            bssid = format_mac(data[offset + 6:offset + 12])
+            bssids.append(None if bssid == '00:00:00:00:00:00' else bssid)
+
+        offset += length
+
+    return bssids
+
+def decode_route_message(msg_type, payload, if_name, if_index):
+    '''
+    Decode an rtnetlink message about our interface: a list of raw events
+    (kind, value) - kind is one of operstate, bssid or address/address_lost
+    '''
+    import socket
+    import struct
+
+    events = []
+
+    if msg_type in (RTM_NEWLINK, RTM_DELLINK) and len(payload) >= 16:
+        (family, link_type, index, flags, change) = struct.unpack_from('=BxHiII', payload)
+        attrs = parse_attrs(payload, 16)
+
+        if IFLA_IFNAME in attrs:
+            if attr_string(attrs[IFLA_IFNAME]) != if_name:
+                return events
+        elif index != if_index:
+            return events
+
+        if msg_type == RTM_DELLINK:
+            events.append(('operstate', 'notpresent'))
+            return events
+
+        if IFLA_WIRELESS in attrs:
+            for bssid in decode_wext_events(attrs[IFLA_WIRELESS]):
+                events.append(('bssid', bssid))
+
+        if IFLA_OPERSTATE in attrs:
+            operstate = bytearray(attrs[IFLA_OPERSTATE])[0]
+            events.append(('operstate', OPERSTATES[operstate] if operstate < len(OPERSTATES) else 'unknown'))
+
+    elif msg_type in (RTM_NEWADDR, RTM_DELADDR) and len(payload) >= 8:
+        (family, prefix_len, flags, scope, index) = struct.unpack_from('=BBBBI', payload)
+
+        if index != if_index or family != socket.AF_INET:
+            return events
+
+        attrs = parse_attrs(payload, 8)
+        address = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+
+        if address:
+            address = socket.inet_ntoa(address[:4])
+            events.append(('address' if msg_type == RTM_NEWADDR else 'address_lost', address))
+
+    return events
+
+def decode_nl80211_message(payload, if_index):
+    '''
+    Decode an nl80211 multicast message about our interface: a list of raw
+    events (kind, value) - kind is connect, roam or disconnect, value a
+    (bssid, detail) tuple
+    '''
+    import struct
+
+    if len(payload) < 4:
+        return []
+
+    cmd = bytearray(payload)[0]
+    attrs = parse_attrs(payload, 4)
+
+    if NL80211_ATTR_IFINDEX in attrs and struct.unpack_from('=I', attrs[NL80211_ATTR_IFINDEX])[0] != if_index:
+        return []
+
+    bssid = format_mac(attrs[NL80211_ATTR_MAC]) if NL80211_ATTR_MAC in attrs else None
+
+    if cmd == NL80211_CMD_CONNECT:
+        status = struct.unpack_from('=H', attrs[NL80211_ATTR_STATUS_CODE])[0] if NL80211_ATTR_STATUS_CODE in attrs else 0
+
+        if status:
+            return [('connect_failed', (bssid, 'status ' + str(status)))]
+
+        return [('connect', (bssid, ''))]
+
+    if cmd == NL80211_CMD_ROAM:
+        return [('roam', (bssid, ''))]
+
+    if cmd == NL80211_CMD_DISCONNECT:
+        detail = ''
+
+        if NL80211_ATTR_REASON_CODE in attrs:
+            detail = 'reason ' + str(struct.unpack_from('=H', attrs[NL80211_ATTR_REASON_CODE])[0])
+
+        if NL80211_ATTR_DISCONNECTED_BY_AP in attrs:
+            detail = (detail + ', by AP').lstrip(', ')
+
+        return [('disconnect', (None, detail))]
+
+    return []
+
+def read_if_index(if_name, sys_root='/sys'):
+    ''' Kernel interface index of an interface '''
+    with open(sys_root + '/class/net/' + if_name + '/ifindex') as ifindex_file:
+        return int(ifindex_file.read().strip())
+
+class NetlinkEventSource(object):
+    '''
+    Raw link events from the kernel: an rtnetlink socket (link & IPv4
+    address changes) & an nl80211 multicast socket (connect/roam/disconnect),
+    if we have nl80211
+    '''
+
+    def __init__(self, if_name, debug=False):
+
+        import socket
+
+        self.if_name = if_name
+        self.if_index = read_if_index(if_name)
+        self.debug = debug
+
+        self.sockets = {}
+
+        route_socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        route_socket.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+        self.sockets['route'] = route_socket
+
+        nl80211_socket = self.open_nl80211()
+
+        if nl80211_socket is not None:
+            self.sockets['nl80211'] = nl80211_socket
+        elif self.debug:
+            print("Link events: no nl80211, using wireless extensions events")
+
+    def open_nl80211(self):
+        '''
+        A generic netlink socket joined to nl80211's "mlme" multicast group
+        (None if there is no nl80211)
+        '''
+        import socket
+        import struct
+
+        genl_socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
+        genl_socket.bind((0, 0))
+        genl_socket.settimeout(2)
+
+        try:
+            genl_socket.send(pack_message(GENL_ID_CTRL, struct.pack('=BBH', CTRL_CMD_GETFAMILY, 1, 0) +
+                pack_attr(CTRL_ATTR_FAMILY_NAME, b'nl80211\0'), NLM_F_REQUEST, 1))
+
+            group_id = None
+
+            for (msg_type, flags, payload) in parse_messages(genl_socket.recv(65536)):
+                if msg_type != GENL_ID_CTRL:
+                    continue
+
+                groups = parse_attrs(parse_attrs(payload, 4).get(CTRL_ATTR_MCAST_GROUPS, b''))
+
+                for group in groups.values():
+                    group_attrs = parse_attrs(group)
+
+                    if attr_string(group_attrs.get(CTRL_ATTR_MCAST_GRP_NAME, b'')) == 'mlme':
+                        group_id = struct.unpack_from('=I', group_attrs[CTRL_ATTR_MCAST_GRP_ID])[0]
+
+            if group_id is None:
+                genl_socket.close()
+                return None
+
+            genl_socket.setsockopt(SOL_NETLINK, NETLINK_ADD_MEMBERSHIP, group_id)
+            genl_socket.settimeout(None)
+
+        except (socket.error, socket.timeout):
+            genl_socket.close()
+            return None
+
+        return genl_socket
+
+    def read(self, timeout):
+        '''
+        Wait up to timeout secs for raw events: [(time, protocol, netlink data)]
+        '''
+        import select
+        import time
+
+        (ready, unused, unused) = select.select(list(self.sockets.values()), [], [], timeout)
+
+        messages = []
+
+        for (protocol, sock) in self.sockets.items():
+            if sock in ready:
+                messages.append((time.time(), protocol, sock.recv(65536)))
+
+        return messages
+
+    def close(self):
+        for sock in self.sockets.values():
+            sock.close()
+
+class FixtureEventSource(object):
+    '''
+    Replay raw events recorded with "linkevents.py --record". The file has
+    an "ifindex <n>" line (the interface index when recorded), then a line
+    for each event: secs since recording started, protocol (route/nl80211)
+    & the netlink data (hex). Events are replayed at the recorded times
+    (scaled by speed), starting now.
+    '''
+
+    def __init__(self, fixture_file, speed=1.0):
+
+        import binascii
+        import time
+
+        self.if_index = None
+        self.events = []
+
+        with open(fixture_file) as fixture_file_obj:
+            for line in fixture_file_obj:
+                fields = line.split()
+
+                if not fields or fields[0].startswith('#'):
+                    continue
+
+                if fields[0] == 'ifindex':
+                    self.if_index = int(fields[1])
+                else:
+                    self.events.append((float(fields[0]) / speed, fields[1], binascii.unhexlify(fields[2])))
+
+        self.started_at = time.time()
+        self.next_event = 0
+
+    def finished(self):
+        return self.next_event >= len(self.events)
+
+    def read(self, timeout):
+
+        import time
+
+        if self.finished():
+            time.sleep(timeout)
+            return []
+
+        wait_time = self.started_at + self.events[self.next_event][0] - time.time()
+
+        if wait_time > timeout:
+            time.sleep(timeout)
+            return []
+
+        time.sleep(max(wait_time, 0))
+
+        (offset, protocol, data) = self.events[self.next_event]
+        self.next_event += 1
+
+        return [(self.started_at + offset, protocol, data)]
+
+    def close(self):
+        pass
+
+class LinkEventListener(object):
+    '''
+    A class to turn raw link events from a source (NetlinkEventSource or
+    FixtureEventSource) in to link events for our interface, in a
+    background thread. Each event is stored in the link_events table of
+    db_file (if given) & passed to on_event(event).
+
+    Events: connect, connect_failed, roam, disconnect, ip_change, ip_lost,
+    link_up, link_down & recovery - recovery is when a disconnect, IP loss
+    or link down hasn't cleared after recovery_delay secs, at which point
+    on_recovery() is called (at most once every recovery_holdoff secs).
+    '''
+
+    def __init__(self, source, if_name, logger=None, debug=False, db_file=None, on_event=None,
+        on_recovery=None, recovery_delay=10, recovery_holdoff=120, bssid=None, ip_addr=None):
+
+        import threading
+
+        self.source = source
+        self.if_name = if_name
+        self.logger = logger
+        self.debug = debug
+        self.db_file = db_file
+        self.on_event = on_event
+        self.on_recovery = on_recovery
+        self.recovery_delay = float(recovery_delay)
+        self.recovery_holdoff = float(recovery_holdoff)
+
+        # what we know of our connection
+        self.bssid = bssid
+        self.ip_addr = ip_addr
+        self.operstate = None
+
+        # down events that haven't cleared yet & when we recover if they don't
+        self.down_events = set()
+        self.recovery_due = None
+        self.last_recovery = None
+
+        self.event_count = 0
+        self.db_conn = None
+
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def current_bssid(self):
+        ''' BSSID we are associated to (None if disconnected) '''
+        return None if 'disconnect' in self.down_events else self.bssid
+
+    def handle_raw_event(self, event_time, kind, value):
+        '''
+        Update our view of the connection from a raw event - returns a link
+        event (dict) if it changed anything
+        '''
+        event = None
+
+        if kind in ('connect', 'roam', 'bssid'):
+            if kind == 'bssid':
+                (bssid, detail) = (value, 'wext')
+            else:
+                (bssid, detail) = value
+
+            if bssid is None:
+                kind = 'disconnect'
+            elif kind == 'roam' or (self.bssid is not None and bssid != self.bssid):
+                kind = 'roam'
+            else:
+                kind = 'connect'
+
+            if kind == 'disconnect':
+                if 'disconnect' not in self.down_events:
+                    event = {'event': 'disconnect', 'bssid': None, 'prev_bssid': self.bssid, 'detail': detail}
+            elif bssid != self.bssid or 'disconnect' in self.down_events:
+                event = {'event': kind, 'bssid': bssid, 'prev_bssid': self.bssid, 'detail': detail}
+
+            if bssid is not None:
+                self.bssid = bssid
+
+        elif kind == 'disconnect':
+            (bssid, detail) = value
+
+            if 'disconnect' not in self.down_events:
+                event = {'event': 'disconnect', 'bssid': None, 'prev_bssid': self.bssid, 'detail': detail}
+
+        elif kind == 'connect_failed':
+            (bssid, detail) = value
+            event = {'event': 'connect_failed', 'bssid': bssid, 'prev_bssid': self.bssid, 'detail': detail}
+
+        elif kind == 'address':
+            if value != self.ip_addr or 'ip_lost' in self.down_events:
+                event = {'event': 'ip_change', 'bssid': self.current_bssid(), 'detail': 'was ' + str(self.ip_addr)}
+                self.ip_addr = value
+
+        elif kind == 'address_lost':
+            if value == self.ip_addr and 'ip_lost' not in self.down_events:
+                event = {'event': 'ip_lost', 'bssid': self.current_bssid(), 'detail': value}
+                self.ip_addr = None
+
+        elif kind == 'operstate':
+            was_up = self.operstate in (None, 'up', 'unknown', 'dormant')
+
+            if value in ('down', 'lowerlayerdown', 'notpresent') and was_up:
+                event = {'event': 'link_down', 'bssid': self.current_bssid(), 'detail': value}
+            elif value == 'up' and 'link_down' in self.down_events:
+                event = {'event': 'link_up', 'bssid': self.current_bssid(), 'detail': value}
+
+            self.operstate = value
+
+        if event is None:
+            return None
+
+        event['time'] = event_time
+        event.setdefault('prev_bssid', None)
+        event['ip_addr'] = self.ip_addr
+
+        # keep track of whether our connection is down
+        if event['event'] in DOWN_EVENTS:
+            self.down_events.add(event['event'])
+        else:
+            for (down_event, clear_event) in DOWN_EVENTS.items():
+                if event['event'] == clear_event or (event['event'] == 'roam' and down_event == 'disconnect'):
+                    self.down_events.discard(down_event)
+
+        if self.down_events:
+            if self.recovery_due is None:
+                self.recovery_due = event_time + self.recovery_delay
+        else:
+            self.recovery_due = None
+
+        return event
+
+    def handle_message(self, event_time, protocol, data):
+        '''
+        Handle raw netlink data from our source - returns a list of link events
+        '''
+        raw_events = []
+
+        for (msg_type, flags, payload) in parse_messages(data):
+            if msg_type in (NLMSG_ERROR, NLMSG_DONE):
+                continue
+
+            if protocol == 'nl80211':
+                raw_events.extend(decode_nl80211_message(payload, self.source.if_index))
+            else:
+                raw_events.extend(decode_route_message(msg_type, payload, self.if_name, self.source.if_index))
+
+        events = []
+
+        for (kind, value) in raw_events:
+            event = self.handle_raw_event(event_time, kind, value)
+
+            if event is not None:
+                events.append(event)
+
+        return events
+
+    def check_recovery(self, now):
+        '''
+        Time to recover? Returns a recovery event if so.
+        '''
+        if self.recovery_due is None or now < self.recovery_due:
+            return None
+
+        if self.last_recovery is not None and now < self.last_recovery + self.recovery_holdoff:
+            self.recovery_due = self.last_recovery + self.recovery_holdoff
+            return None
+
+        self.recovery_due = None
+        self.last_recovery = now
+
+        return {'time': now, 'event': 'recovery', 'bssid': self.current_bssid(), 'prev_bssid': None,
+            'ip_addr': self.ip_addr, 'detail': ','.join(sorted(self.down_events))}
+
+    def save_event(self, event):
+
+        import sqlite3
+
+        if self.db_file is None:
+            return
+
+        try:
+            # (our own connection - this runs in our thread)
+            if self.db_conn is None:
+                self.db_conn = sqlite3.connect(self.db_file, timeout=30)
+
+            with self.db_conn:
+                self.db_conn.execute("insert into link_events (timestamp, if_name, event, bssid, prev_bssid, ip_addr, detail) values (?,?,?,?,?,?,?)",
+                    (int(event['time']), self.if_name, event['event'], event['bssid'], event['prev_bssid'], event['ip_addr'], event['detail']))
+        except Exception as ex:
+            if self.logger:
+                self.logger.log_error("Db execute error when trying to save link event: " + str(ex))
+
+    def dispatch(self, event):
+
+        self.event_count += 1
+
+        if self.debug:
+            print("Link event: " + event['event'] + " bssid=" + str(event['bssid']) + " prev_bssid=" +
+                str(event['prev_bssid']) + " ip=" + str(event['ip_addr']) + " " + str(event['detail']))
+
+        self.save_event(event)
+
+        if self.on_event:
+            self.on_event(event)
+
+        if event['event'] == 'recovery':
+            if self.logger:
+                self.logger.log_error("Link events: connection still down after " + str(int(self.recovery_delay)) +
+                    " secs (" + event['detail'] + "), recovering")
+            if self.on_recovery:
+                self.on_recovery()
+
+    def run(self):
+
+        import time
+
+        while not self.stop_event.is_set():
+            timeout = 1.0
+
+            if self.recovery_due is not None:
+                timeout = min(max(self.recovery_due - time.time(), 0), timeout)
+
+            try:
+                for (event_time, protocol, data) in self.source.read(timeout):
+                    for event in self.handle_message(event_time, protocol, data):
+                        self.dispatch(event)
+
+                event = self.check_recovery(time.time())
+
+                if event is not None:
+                    self.dispatch(event)
+
+            except Exception as ex:
+                if self.logger:
+                    self.logger.log_error("Link events: error handling event: " + str(ex))
+
+                # (don't spin on a broken source)
+                self.stop_event.wait(timeout)
+
+        if self.db_conn is not None:
+            self.db_conn.close()
+            self.db_conn = None
+
+    def start(self):
+
+        import threading
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+
+        self.stop_event.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        self.source.close()
+
+def main():
+
+    import argparse
+    import binascii
+    import time
+
+    parser = argparse.ArgumentParser(description="Listen for wireless link events (roams, disconnects, IP changes)")
+    parser.add_argument('--if', dest='if_name', default='wlan0', help="wireless interface")
+    parser.add_argument('--listen', action='store_true', help="listen for link events (Ctrl-C to stop)")
+    parser.add_argument('--db', help="store link events in this agent DB file")
+    parser.add_argument('--bounce', action='store_true', help="bounce the interface if the connection stays down (--listen)")
+    parser.add_argument('--recovery-delay', type=float, default=10, help="secs a connection must stay down before recovering")
+    parser.add_argument('--record', metavar='IF_NAME', help="record raw events from this interface (to stdout)")
+    parser.add_argument('--replay', metavar='FILE', help="replay recorded raw events")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed (--replay)")
+    parser.add_argument('-d', '--debug', action='store_true')
+    args = parser.parse_args()
+
+    if args.record:
+        source = NetlinkEventSource(args.record, args.debug)
+        started_at = time.time()
+
+        print("# link events recorded from " + args.record + " (" + ", ".join(sorted(source.sockets.keys())) + ")")
+        print("ifindex " + str(source.if_index))
+
+        try:
+            while True:
+                for (event_time, protocol, data) in source.read(1.0):
+                    print("%.3f %s %s" % (event_time - started_at, protocol, binascii.hexlify(data).decode('ascii')))
+        except KeyboardInterrupt:
+            return
+
+    if args.replay:
+        source = FixtureEventSource(args.replay, args.speed)
+    elif args.listen:
+        source = NetlinkEventSource(args.if_name, args.debug)
+    else:
+        parser.error("one of --listen, --record or --replay is needed")
+
+    logger = None
+    on_recovery = None
+
+    if args.db:
+        from simplelogger import SimpleLogger
+        logger = SimpleLogger(args.db, args.debug)
+
+    if args.bounce:
+        from wirelessadapter import WirelessAdapter
+
+        if logger is None:
+            parser.error("--bounce needs --db (for the error log)")
+
+        on_recovery = WirelessAdapter(args.if_name, logger, debug=args.debug).bounce_wlan_interface
+
+    listener = LinkEventListener(source, args.if_name, logger, True, args.db, on_recovery=on_recovery,
+        recovery_delay=args.recovery_delay)
+
+    listener.start()
+
+    try:
+        while not (args.replay and source.finished() and listener.recovery_due is None):
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+
+    listener.stop()
+
+    if logger is not None:
+        logger.close()
+
+if __name__ == "__main__":
+    main()
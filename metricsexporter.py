@@ -0,0 +1,354 @@
+'''
+A lightweight Prometheus/OpenMetrics exporter for the agent's latest
+results. The metrics page is rebuilt from in-memory state at the end of
+each test cycle, so a scrape never touches the local DB or the network.
+
+Only useful in daemon mode (a one-shot run from cron exits straight away).
+'''
+from __future__ import print_function
+
+# (result field, metric name, help text) of the gauges set from each result
+RESULT_GAUGES = [
+    ('download_rate', 'wlanpi_download_mbps', "Speedtest download rate (Mbps)"),
+    ('upload_rate', 'wlanpi_upload_mbps', "Speedtest upload rate (Mbps)"),
+    ('ping_time', 'wlanpi_speedtest_ping_ms', "Speedtest server latency (ms)"),
+    ('signal_level', 'wlanpi_signal_dbm', "Wireless signal level (dBm)"),
+    ('bit_rate', 'wlanpi_bit_rate_mbps', "Wireless bit rate (Mbps)"),
+    ('freq', 'wlanpi_freq_ghz', "Wireless channel frequency (GHz)"),
+    ('lan_tcp_down', 'wlanpi_lan_tcp_down_mbps', "Reflector TCP download goodput (Mbps)"),
+    ('lan_tcp_up', 'wlanpi_lan_tcp_up_mbps', "Reflector TCP upload goodput (Mbps)"),
+    ('lan_udp_rate', 'wlanpi_lan_udp_rate_mbps', "Reflector UDP throughput (Mbps)"),
+    ('lan_udp_loss', 'wlanpi_lan_udp_loss_percent', "Reflector UDP packet loss (%)"),
+    ('lan_udp_jitter', 'wlanpi_lan_udp_jitter_ms', "Reflector UDP jitter (ms)"),
+]
+
+# (ping result field, metric name, help text) of the per ping target gauges
+PING_GAUGES = [
+    ('rtt_avg', 'wlanpi_ping_rtt_avg_ms', "Ping average round trip time (ms)"),
+    ('rtt_min', 'wlanpi_ping_rtt_min_ms', "Ping minimum round trip time (ms)"),
+    ('rtt_max', 'wlanpi_ping_rtt_max_ms', "Ping maximum round trip time (ms)"),
+    ('percent_loss', 'wlanpi_ping_loss_percent', "Ping packet loss (%)"),
+]
+
+# (table, metric name, help text) of the counters read from the local DB -
+# these are the number of rows ever added to each table (from its
+# autoincrement sequence), so they keep counting up as old rows are removed
+DB_COUNTERS = [
+    ('speedtest_data', 'wlanpi_results_stored', "Results stored in the local DB"),
+    ('error_logs', 'wlanpi_errors_logged', "Error messages logged"),
+    ('outbox', 'wlanpi_outbox_queued', "Results queued for delivery to result sinks"),
+]
+
+def metric_value(value):
+    '''
+    Numeric value of a result field - None if it is "NA" (or not numeric)
+    '''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def format_labels(labels):
+
+    if not labels:
+        return ''
+
+    escaped = []
+
+    for (name, value) in sorted(labels.items()):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(name + '="' + value + '"')
+
+    return '{' + ','.join(escaped) + '}'
+
+class MetricsExporter(object):
+    '''
+    A class to serve the agent's metrics over HTTP (GET /metrics). Call the
+    update_*() methods as a cycle progresses - the page served is rebuilt
+    by update_cycle() at the end of each cycle.
+    '''
+
+    def __init__(self, bind_addr='', port=9110, logger=None, debug=False):
+
+        import threading
+
+        self.bind_addr = bind_addr
+        self.port = int(port)
+        self.logger = logger
+        self.debug = debug
+
+        self.server = None
+        self.thread = None
+
+        self.lock = threading.Lock()
+
+        # metric name: (type, help, {label tuple: value})
+        self.metrics = {}
+
+        # result sinks we have seen (so that empty outboxes show as 0)
+        self.sink_names = set()
+
+        # rendered pages, in Prometheus text & OpenMetrics formats
+        self.pages = {'text': b'', 'openmetrics': b'# EOF\n'}
+
+    def set(self, name, metric_type, help_text, value, labels=None):
+
+        samples = self.metrics.setdefault(name, (metric_type, help_text, {}))[2]
+        samples[tuple(sorted((labels or {}).items()))] = value
+
+    def inc(self, name, help_text, amount=1, labels=None):
+
+        samples = self.metrics.setdefault(name, ('counter', help_text, {}))[2]
+        key = tuple(sorted((labels or {}).items()))
+        samples[key] = samples.get(key, 0) + amount
+
+    def clear(self, name, labels):
+        '''
+        Drop the samples of a metric that have all of labels
+        '''
+        if name not in self.metrics:
+            return
+
+        samples = self.metrics[name][2]
+
+        for key in list(samples.keys()):
+            if set(labels.items()) <= set(key):
+                del samples[key]
+
+        if not samples:
+            self.metrics.pop(name)
+
+    def update_result(self, record):
+        '''
+        Set our gauges from the latest result of its interface (fields with
+        no value are dropped, rather than left at their last value)
+        '''
+        interface = {'interface': record.get('interface', '')}
+
+        with self.lock:
+            for (field, name, help_text) in RESULT_GAUGES:
+                self.clear(name, interface)
+
+                value = metric_value(record.get(field))
+
+                if value is not None:
+                    self.set(name, 'gauge', help_text, value, interface)
+
+            for (field, name, help_text) in PING_GAUGES:
+                self.clear(name, interface)
+
+                for ping_number in range(1, 4):
+                    target = record.get('ping_host' + str(ping_number), "NA")
+                    value = metric_value(record.get(field + str(ping_number)))
+
+                    if target != "NA" and value is not None:
+                        self.set(name, 'gauge', help_text, value, dict(interface, target=target))
+
+            # (only the labels of the latest result)
+            self.clear('wlanpi_agent_info', interface)
+
+            self.set('wlanpi_agent_info', 'gauge', "Probe details of the latest result", 1, dict(interface,
+                hostname=record.get('hostname', ''), location=record.get('location', ''),
+                ssid=record.get('ssid', ''), bssid=record.get('bssid', ''),
+                server=record.get('server_name', '')))
+
+            if 'timestamp' in record:
+                self.set('wlanpi_last_result_timestamp_seconds', 'gauge',
+                    "Time of the latest result (secs since the epoch)", record['timestamp'], interface)
+
+    def update_sinks(self, status):
+        '''
+        Count result sink deliveries from a SinkPipeline.publish() status
+        '''
+        outcomes = {True: 'sent', False: 'failed', None: 'pending'}
+
+        with self.lock:
+            self.sink_names.update(status.keys())
+
+            for (sink_name, sink_status) in status.items():
+                self.inc('wlanpi_sink_deliveries', "Result sink delivery attempts by outcome",
+                    labels={'sink': sink_name, 'status': outcomes[sink_status]})
+
+    def update_schedule(self, scheduler, run_time, kind):
+        '''
+        Set our schedule gauges from a CycleScheduler & the next cycle it
+        has scheduled (run_time, kind) & rebuild the metrics page
+        '''
+        with self.lock:
+            self.metrics.pop('wlanpi_next_cycle_timestamp_seconds', None)
+
+            self.set('wlanpi_next_cycle_timestamp_seconds', 'gauge', "Time the next test cycle is due (secs since the epoch)",
+                run_time, {'kind': kind})
+            self.set('wlanpi_schedule_interval_seconds', 'gauge', "Current interval between full test cycles (secs)",
+                scheduler.full_interval)
+            self.set('wlanpi_link_degraded', 'gauge', "Ping loss or RTT is degraded (ping-only cycles are run in between full cycles)",
+                1 if scheduler.degraded else 0)
+
+            self.pages = {'text': self.render(False), 'openmetrics': self.render(True)}
+
+    def read_db_counts(self, db_conn):
+        '''
+        Read our counters & outbox depths from the local DB - returns a list of
+        (name, type, help, value, labels)
+        '''
+        counts = []
+
+        sequences = dict(db_conn.execute("select name, seq from sqlite_sequence").fetchall())
+
+        for (table, name, help_text) in DB_COUNTERS:
+            counts.append((name, 'counter', help_text, sequences.get(table, 0), None))
+
+        depths = dict([(sink_name, 0) for sink_name in self.sink_names])
+        depths.update(dict(db_conn.execute("select sink, count(*) from outbox group by sink").fetchall()))
+
+        for (sink_name, depth) in depths.items():
+            counts.append(('wlanpi_outbox_depth', 'gauge', "Results waiting for delivery to a result sink",
+                depth, {'sink': sink_name}))
+
+        # (cycles run, skipped & missed - see scheduler.py)
+        for (event, count) in db_conn.execute("select event, count from schedule_stats").fetchall():
+            counts.append(('wlanpi_schedule_events', 'counter', "Test cycles run (full/ping), skipped as another run was still going (overlap) or missed by an over-running cycle",
+                count, {'event': event}))
+
+        return counts
+
+    def update_cycle(self, db_conn, phase_durations):
+        '''
+        End of a test cycle: refresh our counters from the local DB & the
+        cycle phase timings, then rebuild the metrics page
+        '''
+        from phasetimer import INTERFACE_SEPARATOR
+
+        try:
+            counts = self.read_db_counts(db_conn)
+        except Exception as ex:
+            if self.logger:
+                self.logger.log_error("Db execute error when trying to read exporter counts: " + str(ex))
+            counts = None
+
+        with self.lock:
+            if counts is not None:
+                self.metrics.pop('wlanpi_outbox_depth', None)
+
+                for (name, metric_type, help_text, value, labels) in counts:
+                    self.set(name, metric_type, help_text, value, labels)
+
+            self.metrics.pop('wlanpi_cycle_phase_seconds', None)
+
+            for (phase, duration) in phase_durations.items():
+                # (phases timed per interface are labelled with it)
+                (phase, _, interface) = phase.partition(INTERFACE_SEPARATOR)
+                labels = {'phase': phase}
+
+                if interface:
+                    labels['interface'] = interface
+
+                self.set('wlanpi_cycle_phase_seconds', 'gauge', "Time taken by each phase of the latest test cycle (secs)",
+                    duration, labels)
+
+            self.inc('wlanpi_cycles', "Test cycles run")
+
+            self.pages = {'text': self.render(False), 'openmetrics': self.render(True)}
+
+    def render(self, openmetrics):
+        '''
+        Our metrics in Prometheus text format (or OpenMetrics)
+        '''
+        lines = []
+
+        for name in sorted(self.metrics.keys()):
+            (metric_type, help_text, samples) = self.metrics[name]
+
+            sample_name = name
+
+            if metric_type == 'counter':
+                sample_name = name + '_total'
+
+                # Prometheus text format names counter families with the
+                # _total suffix, OpenMetrics without
+                if not openmetrics:
+                    name = sample_name
+
+            lines.append('# HELP ' + name + ' ' + help_text)
+            lines.append('# TYPE ' + name + ' ' + metric_type)
+
+            for (labels, value) in sorted(samples.items()):
+                lines.append(sample_name + format_labels(dict(labels)) + ' ' + repr(float(value)))
+
+        if openmetrics:
+            lines.append('# EOF')
+
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def page(self, accept=''):
+        '''
+        The current metrics page: (content type, body)
+        '''
+        with self.lock:
+            if 'application/openmetrics-text' in (accept or ''):
+                return ('application/openmetrics-text; version=1.0.0; charset=utf-8', self.pages['openmetrics'])
+
+            return ('text/plain; version=0.0.4; charset=utf-8', self.pages['text'])
+
+    def start(self):
+        '''
+        Start serving in a background thread. Returns the port we are
+        listening on (useful if port 0 was requested).
+        '''
+        import threading
+
+        try:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+            from SocketServer import ThreadingMixIn
+        except ImportError:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            from socketserver import ThreadingMixIn
+
+        exporter = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+
+                (content_type, body) = exporter.page(self.headers.get('Accept'))
+
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                if exporter.debug:
+                    print("Exporter: " + self.address_string() + " " + (format % args))
+
+        class MetricsServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = MetricsServer((self.bind_addr, self.port), MetricsHandler)
+        self.port = self.server.server_address[1]
+
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        if self.debug:
+            print("Exporter: serving metrics on port " + str(self.port))
+
+        return self.port
+
+    def stop(self):
+
+        if self.server is None:
+            return
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+        self.server = None
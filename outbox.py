@@ -0,0 +1,143 @@
+'''
+A durable outbox for results waiting to be uploaded. Every result is stored
+in the local DB before we try to upload it & is only removed once the upload
+has been acknowledged, so nothing is lost if the upload (or the agent) fails.
+'''
+from __future__ import print_function
+
+class Outbox(object):
+    '''
+    A class to queue results for upload in the outbox table of our local DB
+
+    Each result is given a unique result key (idempotency key) that is
+    uploaded with it, so that a retried upload can check whether an earlier
+    attempt actually made it & avoid creating duplicate rows.
+
+    max_rows/max_age_days limit how much is kept during a long outage (0 =
+    no limit). Failed uploads are retried with an exponential backoff.
+
+    Each result sink (see resultsinks.py) has its own queue in the outbox
+    table, selected by sink name.
+    '''
+
+    def __init__(self, db_conn, logger, max_rows=0, max_age_days=0, debug=False,
+        retry_base=60, retry_max=3600, sink='gsheet'):
+
+        self.db_conn = db_conn
+        self.sink = sink
+        self.logger = logger
+        self.max_rows = int(max_rows)
+        self.max_age_days = float(max_age_days)
+        self.debug = debug
+
+        # retry backoff (secs)
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+
+    def enqueue(self, payload, result_key=None):
+        '''
+        Add a result (any JSON serialisable payload, e.g. a list of sheet row
+        values) to the outbox & apply our size & age budget. Returns the
+        result key.
+        '''
+        import json
+        import time
+        import uuid
+
+        if result_key is None:
+            result_key = uuid.uuid4().hex
+
+        try:
+            self.db_conn.execute("insert into outbox (sink, result_key, created, payload) values (?,?,?,?)",
+                (self.sink, result_key, int(time.time()), json.dumps(payload)))
+            self.db_conn.commit()
+        except Exception as error:
+            self.logger.log_error("Db execute error when trying to add result to outbox: " + str(error))
+            return False
+
+        self.trim()
+
+        return result_key
+
+    def trim(self):
+        '''
+        Drop the oldest results if we are over our size or age budget
+        '''
+        import time
+
+        dropped = 0
+
+        try:
+            if self.max_age_days > 0:
+                cursor = self.db_conn.execute("delete from outbox where sink = ? and created < ?",
+                    (self.sink, int(time.time() - self.max_age_days * 86400)))
+                dropped += cursor.rowcount
+
+            if self.max_rows > 0:
+                cursor = self.db_conn.execute("delete from outbox where sink = ? and id < (select id from outbox where sink = ? order by id desc limit 1 offset ?)",
+                    (self.sink, self.sink, self.max_rows - 1))
+                dropped += cursor.rowcount
+
+            self.db_conn.commit()
+        except Exception as error:
+            self.logger.log_error("Db execute error when trying to trim outbox: " + str(error))
+            return False
+
+        if dropped > 0:
+            self.logger.log_error("Outbox (" + self.sink + ") over budget - dropped " + str(dropped) + " oldest results")
+
+        return dropped
+
+    def pending(self, limit=500):
+        '''
+        Results due for upload (oldest first) as a list of dictionaries:
+        id, result_key, payload, attempts, last_target
+        '''
+        import json
+        import time
+
+        cursor = self.db_conn.execute("select id, result_key, payload, attempts, last_target from outbox where sink = ? and next_attempt <= ? order by id limit ?",
+            (self.sink, int(time.time()), int(limit)))
+
+        return [{'id': row[0], 'result_key': row[1], 'payload': json.loads(row[2]),
+            'attempts': row[3], 'last_target': row[4]} for row in cursor.fetchall()]
+
+    def depth(self):
+        ''' Number of results waiting in the outbox '''
+        return self.db_conn.execute("select count(*) from outbox where sink = ?", (self.sink,)).fetchone()[0]
+
+    def mark_attempt(self, ids, target):
+        '''
+        Record that we are about to try uploading results to a target (e.g.
+        worksheet name) - done before the upload, so that if we never hear back
+        we know to check the target for them on the next attempt
+        '''
+        import time
+
+        self.db_conn.execute("update outbox set attempts = attempts + 1, last_attempt = ?, last_target = ? where id in (" +
+            ",".join(["?"] * len(ids)) + ")", [int(time.time()), target] + list(ids))
+        self.db_conn.commit()
+
+    def ack(self, ids):
+        '''
+        Results have been accepted - remove them from the outbox
+        '''
+        if not ids:
+            return
+
+        self.db_conn.execute("delete from outbox where id in (" + ",".join(["?"] * len(ids)) + ")", list(ids))
+        self.db_conn.commit()
+
+    def nack(self, ids, error):
+        '''
+        Upload of results failed - schedule a retry with exponential backoff
+        (based on the number of attempts made so far)
+        '''
+        import time
+
+        if not ids:
+            return
+
+        self.db_conn.execute("update outbox set last_error = ?, next_attempt = ? + min(?, ? * (1 << min(attempts - 1, 16))) where id in (" +
+            ",".join(["?"] * len(ids)) + ")", [str(error), int(time.time()), self.retry_max, self.retry_base] + list(ids))
+        self.db_conn.commit()
@@ -0,0 +1,144 @@
+'''
+Lightweight timing of the phases of a test cycle (adapter checks, DNS,
+Google sheet setup, speedtest, pings, result upload...), so that we can see
+where the time goes when a cycle runs long & trend agent overhead against
+time spent measuring.
+'''
+from __future__ import print_function
+
+# phases timed before the result is built - these can be sent with the
+# result as extra "phase_<name>" fields (in this order), the rest are only
+# kept in the local DB
+RESULT_PHASES = ['adapter', 'dns', 'gsheet', 'config', 'server_select',
+    'download', 'upload', 'reflector', 'ping']
+
+# result fields holding the phase timings (secs) - phase_total is the sum of
+# all phases timed so far
+PHASE_FIELDS = ['phase_' + name for name in RESULT_PHASES] + ['phase_total']
+
+# separates a phase name from the interface it was timed for, when a cycle
+# tests from several interfaces (e.g. "download:eth0")
+INTERFACE_SEPARATOR = ':'
+
+class PhaseTimer(object):
+    '''
+    A class to time the phases of a cycle:
+
+        with timer.phase('download'):
+            ...
+
+    Phases are recorded in the order they finish. A phase that is timed more
+    than once in a cycle has its durations added together.
+
+    Phases run once per interface are timed for that interface:
+
+        with timer.phase('download', 'eth0'):
+            ...
+
+    & recorded as "download:eth0".
+    '''
+
+    def __init__(self, debug=False):
+
+        import time
+
+        self.debug = debug
+        self.started_at = int(time.time())
+
+        # (phase name, secs) in order
+        self.phases = []
+
+    def phase(self, name, interface=None):
+        '''
+        Context manager to time a phase (the time is recorded even if the
+        phase fails, or exits the agent) - for an interface, if supplied
+        '''
+        import contextlib
+        import timeit
+
+        if interface:
+            name = name + INTERFACE_SEPARATOR + interface
+
+        @contextlib.contextmanager
+        def timed_phase():
+            start_time = timeit.default_timer()
+
+            try:
+                yield
+            finally:
+                self.add(name, timeit.default_timer() - start_time)
+
+        return timed_phase()
+
+    def add(self, name, duration):
+
+        for (index, (phase_name, phase_duration)) in enumerate(self.phases):
+            if phase_name == name:
+                self.phases[index] = (name, phase_duration + duration)
+                return
+
+        self.phases.append((name, duration))
+
+    def durations(self):
+        return dict(self.phases)
+
+    def total(self, interface=None):
+        '''
+        Total time of all phases - just those shared by all interfaces & the
+        interface's own, if an interface is supplied
+        '''
+        if interface is None:
+            return sum([duration for (name, duration) in self.phases])
+
+        return sum([duration for (name, duration) in self.phases
+            if INTERFACE_SEPARATOR not in name or name.split(INTERFACE_SEPARATOR, 1)[1] == interface])
+
+    def result_fields(self, interface=None):
+        '''
+        Phase timings as result fields (see PHASE_FIELDS) - "NA" for phases
+        that didn't run. For the result of an interface, if supplied (the
+        phases timed for other interfaces are left out).
+        '''
+        durations = self.durations()
+
+        fields = {}
+
+        for name in RESULT_PHASES:
+            if interface and name + INTERFACE_SEPARATOR + interface in durations:
+                fields['phase_' + name] = '%.3f' % durations[name + INTERFACE_SEPARATOR + interface]
+            elif name in durations:
+                fields['phase_' + name] = '%.3f' % durations[name]
+            else:
+                fields['phase_' + name] = "NA"
+
+        fields['phase_total'] = '%.3f' % self.total(interface)
+
+        return fields
+
+    def report(self):
+        '''
+        Print the phase timings (debug output)
+        '''
+        total = self.total()
+
+        print("Cycle phase timings:")
+
+        for (name, duration) in self.phases:
+            print("  %-16s %8.3f secs %5.1f%%" % (name, duration, duration * 100 / total if total else 0))
+
+        print("  %-16s %8.3f secs" % ('total', total))
+
+    def save(self, db_conn, logger):
+        '''
+        Store the phase timings in the cycle_phases table
+        '''
+        rows = [(self.started_at, seq, name, duration) for (seq, (name, duration)) in enumerate(self.phases)]
+
+        try:
+            with db_conn:
+                db_conn.executemany("insert into cycle_phases (cycle_start, seq, phase, duration) values (?,?,?,?)", rows)
+        except Exception as ex:
+            logger.log_error("Db execute error when trying to save cycle phase timings: " + str(ex))
+            return False
+
+        return True
@@ -4,15 +4,71 @@ result characteristics
 '''
 from __future__ import print_function
 
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+# same payload size as the ping command (56 data bytes)
+ICMP_PAYLOAD_SIZE = 56
+
+def icmp_checksum(data):
+    '''
+    Standard internet checksum (RFC 1071) of an ICMP packet
+    '''
+    data = bytearray(data)
+
+    if len(data) % 2:
+        data.append(0)
+
+    total = 0
+    for i in range(0, len(data), 2):
+        total += (data[i] << 8) + data[i + 1]
+
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+
+    return ~total & 0xffff
+
+def percentile(samples, pct):
+    '''
+    Return the pct percentile of a list of samples (linear interpolation
+    between closest ranks)
+    '''
+    ordered = sorted(samples)
+
+    if not ordered:
+        return None
+
+    rank = (len(ordered) - 1) * (pct / 100.0)
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
 class Pinger(object):
     '''
-    A class to ping a host - a basic wrapper around a CLI ping command
+    A class to ping a host. By default, pings are sent from an ICMP socket
+    within this process (unprivileged datagram ICMP socket, falling back to a
+    raw socket). If neither can be opened, we fall back to running the CLI
+    ping command.
+
+    engine: "auto" (socket with CLI fallback), "socket" or "cli"
+
+    Pings are sent out of interface (with source_addr, its address) if given,
+    rather than following the default route (see sourcebind.py)
     '''
 
-    def __init__(self, platform="rpi", debug=False):
+    def __init__(self, platform="rpi", debug=False, engine="auto", interval=1.0, timeout=2.0,
+        interface=None, source_addr=None):
 
         self.platform = platform
         self.debug = debug
+        self.engine = engine
+        self.interface = interface
+        self.source_addr = source_addr
+
+        # time between probes & time to wait for last reply (secs)
+        self.interval = interval
+        self.timeout = timeout
 
         self.host = ''
         self.pkts_tx = ''
@@ -24,6 +80,12 @@ class Pinger(object):
         self.rtt_max = ''
         self.rtt_mdev = ''
 
+        # per-packet results (socket engine only)
+        self.rtt_samples = []
+        self.rtt_p50 = 'NA'
+        self.rtt_p95 = 'NA'
+        self.jitter = 'NA'
+
 
     def ping_host(self, host, count):
         '''
@@ -40,10 +102,278 @@ class Pinger(object):
             'rtt_min': self.rtt_min,
             'rtt_avg': self.rtt_max,
             'rtt_max': self.rtt_max,
-            'rtt_mdev': self.rtt_mdev}
+            'rtt_mdev': self.rtt_mdev,
+            'rtt_p50': self.rtt_p50,
+            'rtt_p95': self.rtt_p95,
+            'jitter': self.jitter,
+            'rtt_samples': self.rtt_samples}
+
+        The percentile, jitter & per-packet sample values are only available
+        from the socket engine ("NA" and an empty list from the CLI engine)
+        '''
+        import socket
+
+        self.host = host
+
+        self.rtt_samples = []
+        self.rtt_p50 = 'NA'
+        self.rtt_p95 = 'NA'
+        self.jitter = 'NA'
+
+        if self.engine == "cli":
+            return self.cli_ping_host(host, count)
+
+        try:
+            icmp_socket = self.open_icmp_socket()
+        except socket.error as error:
+            if self.engine == "socket":
+                if self.debug:
+                    print("Unable to open ICMP socket: " + str(error))
+                return False
+
+            if self.debug:
+                print("Unable to open ICMP socket, falling back to ping command: " + str(error))
 
+            return self.cli_ping_host(host, count)
+
+        try:
+            if not self.bind_icmp_socket(icmp_socket):
+                return False
+
+            return self.socket_ping_host(icmp_socket, host, count)
+        finally:
+            icmp_socket.close()
+
+    def open_icmp_socket(self):
+        '''
+        Open an unprivileged datagram ICMP socket (needs the group to be allowed
+        by net.ipv4.ping_group_range), or a raw ICMP socket if that is not
+        permitted (needs root or CAP_NET_RAW)
+        '''
+        import socket
+
+        try:
+            icmp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self.raw_socket = False
+        except socket.error:
+            icmp_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self.raw_socket = True
+
+        if self.debug:
+            print("Opened ICMP socket (raw=" + str(self.raw_socket) + ")")
+
+        return icmp_socket
+
+    def bind_icmp_socket(self, icmp_socket):
+        '''
+        Bind our ICMP socket to our interface (if we have one). Returns False
+        if it can't be bound.
+        '''
+        import socket
+        from sys import stderr
+        from sourcebind import bind_socket
+
+        try:
+            bound = bind_socket(icmp_socket, self.interface, self.source_addr)
+        except socket.error as error:
+            stderr.write("Error binding ping socket to " + str(self.interface) + ": " + str(error) + "\n")
+            return False
+
+        if self.debug and self.interface:
+            print("ICMP socket bound to " + self.interface + " by " + str(bound))
+
+        return True
+
+    def build_echo_request(self, ident, seq):
+        '''
+        Build an ICMP echo request packet with the send time in the payload
+        '''
+        import struct
+        import time
+
+        payload = struct.pack('!d', time.time())
+        payload += b'Q' * (ICMP_PAYLOAD_SIZE - len(payload))
+
+        header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+        checksum = icmp_checksum(header + payload)
+
+        return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, ident, seq) + payload
+
+    def parse_echo_reply(self, packet):
+        '''
+        Extract (ident, seq) from a received echo reply. Returns None if the
+        packet is not an echo reply. Packets from a raw socket still have their
+        IP header attached.
+        '''
+        import struct
+
+        packet = bytearray(packet)
+
+        if self.raw_socket:
+            packet = packet[(packet[0] & 0x0f) * 4:]
+
+        if len(packet) < 8:
+            return None
+
+        (icmp_type, code, checksum, ident, seq) = struct.unpack('!BBHHH', bytes(packet[:8]))
+
+        if icmp_type != ICMP_ECHO_REPLY:
+            return None
+
+        return (ident, seq)
+
+    def socket_ping_host(self, icmp_socket, host, count):
+        '''
+        Send count echo requests to host over a single ICMP socket (one every
+        interval seconds), collecting the RTT of every reply
+        '''
+        import random
+        import select
+        import socket
+        import time
+        from sys import stderr
+
+        try:
+            host_addr = socket.gethostbyname(host)
+        except Exception as error:
+            stderr.write("Error resolving ping host: " + str(error))
+            return False
+
+        # raw sockets see all ICMP traffic, so use our own identifier to pick
+        # out our replies. For datagram sockets the kernel sets the identifier
+        # & only hands us our own replies. (Random for each call, so that
+        # pings running at the same time in this process - or in another
+        # with the same pid in a container - don't take each other's replies.)
+        ident = random.randint(0, 0xffff)
+        seq_base = random.randint(0, 0xffff)
+
+        send_times = {}
+        rtt_samples = []
+
+        start_time = time.time()
+        next_send = start_time
+        sent = 0
+        deadline = None
+
+        while True:
+
+            now = time.time()
+
+            if sent < count and now >= next_send:
+                seq = (seq_base + sent) & 0xffff
+                try:
+                    icmp_socket.sendto(self.build_echo_request(ident, seq), (host_addr, 0))
+                except socket.error as error:
+                    stderr.write("Error sending ping: " + str(error))
+                    return False
+
+                send_times[seq] = time.time()
+                sent += 1
+                next_send += self.interval
+
+                if sent == count:
+                    deadline = time.time() + self.timeout
+
+            if sent == count and (len(rtt_samples) == count or time.time() >= deadline):
+                break
+
+            wait_until = deadline if sent == count else next_send
+            wait_time = max(wait_until - time.time(), 0)
+
+            readable = select.select([icmp_socket], [], [], wait_time)[0]
+
+            if not readable:
+                continue
+
+            (packet, addr) = icmp_socket.recvfrom(2048)
+            receive_time = time.time()
+
+            reply = self.parse_echo_reply(packet)
+
+            if reply is None or addr[0] != host_addr:
+                continue
+
+            (reply_ident, reply_seq) = reply
+
+            if self.raw_socket and reply_ident != ident:
+                continue
+
+            # ignore duplicates & replies to probes we didn't send
+            if reply_seq in send_times:
+                rtt_samples.append((receive_time - send_times.pop(reply_seq)) * 1000)
+
+        self.test_time = str(int((time.time() - start_time) * 1000))
+
+        return self.summarize_samples(sent, rtt_samples)
+
+    def summarize_samples(self, pkts_tx, rtt_samples):
+        '''
+        Work out loss & RTT statistics (as reported by the ping command, plus
+        percentiles & jitter) from the per-packet RTT samples (ms)
+        '''
+        import math
+
+        pkts_rx = len(rtt_samples)
+
+        self.pkts_tx = str(pkts_tx)
+        self.pkts_rx = str(pkts_rx)
+        self.pkt_loss = str(int((pkts_tx - pkts_rx) * 100 / pkts_tx))
+        self.rtt_samples = rtt_samples
+
+        if pkts_rx == 0:
+            self.rtt_min = "NA"
+            self.rtt_avg = "NA"
+            self.rtt_max = "NA"
+            self.rtt_mdev = "NA"
+        else:
+            mean = sum(rtt_samples) / pkts_rx
+            mean_sq = sum([sample * sample for sample in rtt_samples]) / pkts_rx
+
+            self.rtt_min = '%.3f' % min(rtt_samples)
+            self.rtt_avg = '%.3f' % mean
+            self.rtt_max = '%.3f' % max(rtt_samples)
+            self.rtt_mdev = '%.3f' % math.sqrt(max(mean_sq - mean * mean, 0))
+            self.rtt_p50 = '%.3f' % percentile(rtt_samples, 50)
+            self.rtt_p95 = '%.3f' % percentile(rtt_samples, 95)
+
+            # jitter: mean difference between consecutive RTT samples
+            if pkts_rx > 1:
+                diffs = [abs(rtt_samples[i] - rtt_samples[i - 1]) for i in range(1, pkts_rx)]
+                self.jitter = '%.3f' % (sum(diffs) / len(diffs))
+
+        if self.debug:
+            print("Packets transmitted: " + str(self.pkts_tx))
+            print("Packets received: " + str(self.pkts_rx))
+            print("Packet loss(%): " + str(self.pkt_loss))
+            print("RTT samples (ms): " + str(self.rtt_samples))
+            print("rtt_min/avg/max/mdev : " + "/".join([self.rtt_min, self.rtt_avg, self.rtt_max, self.rtt_mdev]))
+            print("rtt_p50/p95, jitter : " + "/".join([self.rtt_p50, self.rtt_p95]) + ", " + self.jitter)
+
+        return self.get_results()
+
+    def get_results(self):
+        '''
+        Results of the last ping test as a dictionary (see ping_host)
+        '''
+        return {
+            'host': self.host,
+            'pkts_tx': self.pkts_tx,
+            'pkts_rx': self.pkts_rx,
+            'pkt_loss': self.pkt_loss,
+            'test_time': self.test_time,
+            'rtt_min': self.rtt_min,
+            'rtt_max': self.rtt_max,
+            'rtt_avg': self.rtt_avg,
+            'rtt_mdev': self.rtt_mdev,
+            'rtt_p50': self.rtt_p50,
+            'rtt_p95': self.rtt_p95,
+            'jitter': self.jitter,
+            'rtt_samples': self.rtt_samples}
+
+    def cli_ping_host(self, host, count):
+        '''
+        Run a ping test using the CLI ping command (see ping_host)
         '''
-        import re
         import subprocess
         from sys import stderr
 
@@ -52,10 +382,15 @@ class Pinger(object):
         if self.debug:
             print("Pinging host: " + str(host) + " (count=" + str(count) +")")
 
+        ping_cmd = ["/bin/ping", "-q", "-c " + str(count), host]
+
+        # (ping binds to the interface itself, if it is allowed to)
+        if self.interface:
+            ping_cmd[1:1] = ["-I", self.interface]
+
         # Execute the ping
         try:
-            ping_output = (subprocess.check_output(["/bin/ping", "-q", "-c " \
-            + str(count), host])).splitlines()
+            ping_output = (subprocess.check_output(ping_cmd)).splitlines()
         except Exception as error:
             if self.debug:
                 print("Hit an error with ping: ")
@@ -71,7 +406,24 @@ class Pinger(object):
             print("Ping command output:")
             print(ping_output)
 
-        packets_summary_str = ping_output[3]
+        return self.parse_ping_output(ping_output)
+
+    def parse_ping_output(self, ping_output):
+        '''
+        Extract the summary results from the output lines of the CLI ping
+        command. The summary lines are located by content rather than position
+        as their position varies between ping versions & error conditions.
+        '''
+        import re
+
+        packets_summary_str = ''
+        perf_summary_str = ''
+
+        for line in ping_output:
+            if 'packets transmitted' in line:
+                packets_summary_str = line
+            elif re.search('^(rtt|round-trip)', line):
+                perf_summary_str = line
 
         # Extract packets transmitted
         pkts_tx_re = re.search('(\d+) packets transmitted', packets_summary_str)
@@ -107,11 +459,10 @@ class Pinger(object):
             print("Packet loss(%): " + str(self.pkt_loss))
             print("Test duration (mS): " + str(self.test_time))
 
-        perf_summary_str = ping_output[4]
         perf_data_re = re.search('= ([\d\.]+?)\/([\d\.]+?)\/([\d\.]+?)\/([\d\.]+)', \
         perf_summary_str)
 
-        if test_time_re is None:
+        if perf_data_re is None:
             self.rtt_min = "NA"
             self.rtt_avg = "NA"
             self.rtt_max = "NA"
@@ -128,16 +479,7 @@ class Pinger(object):
             print("rtt_max : " + str(self.rtt_max))
             print("rtt_mdev : " + str(self.rtt_mdev))
 
-        return {
-            'host': self.host,
-            'pkts_tx': self.pkts_tx,
-            'pkts_rx': self.pkts_rx,
-            'pkt_loss': self.pkt_loss,
-            'test_time': self.test_time,
-            'rtt_min': self.rtt_min,
-            'rtt_max': self.rtt_max,
-            'rtt_avg': self.rtt_avg,
-            'rtt_mdev': self.rtt_mdev}
+        return self.get_results()
 
     def get_host(self):
         ''' Get host name/address '''
@@ -174,3 +516,19 @@ class Pinger(object):
     def get_rtt_mdev(self):
         ''' Get the median round trip time observed during the test '''
         return self.rtt_mdev
+
+    def get_rtt_p50(self):
+        ''' Get the 50th percentile round trip time (socket engine only) '''
+        return self.rtt_p50
+
+    def get_rtt_p95(self):
+        ''' Get the 95th percentile round trip time (socket engine only) '''
+        return self.rtt_p95
+
+    def get_jitter(self):
+        ''' Get the mean RTT difference between consecutive packets (socket engine only) '''
+        return self.jitter
+
+    def get_rtt_samples(self):
+        ''' Get the list of per-packet round trip times in ms (socket engine only) '''
+        return self.rtt_samples
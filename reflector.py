@@ -0,0 +1,498 @@
+#!/usr/bin/python
+'''
+A self-hosted throughput test engine: a small reflector server to run on a
+wired host at the site, and the client used by the agent. This measures
+the WLAN (rather than the internet path that speedtest.net servers test):
+
+ - TCP goodput in each direction, over several parallel streams
+ - UDP throughput, loss & jitter at a target rate (packets are echoed back
+   by the reflector, so loss & jitter are for the round trip)
+
+To run the server (TCP & UDP on the same port number):
+
+    python reflector.py --port 5201
+
+To check the whole engine end-to-end over loopback (no outside network
+needed - exits with an assertion error if a check fails):
+
+    python reflector.py --self-test
+'''
+from __future__ import print_function
+
+# UDP test packets start with this, so that the reflector only echoes our
+# own packets
+UDP_MAGIC = b'WPRF'
+
+# UDP header: magic, sequence number, send time
+UDP_HEADER = '!4sId'
+
+BUFFER_SIZE = 65536
+
+class ReflectorServer(object):
+    '''
+    A class to serve TCP & UDP throughput tests. Each TCP connection starts
+    with a command line:
+
+        SEND <secs>\\n    we send data to the client for <secs> (download)
+        RECV\\n           we read data until the client closes its side,
+                         then reply with the byte count (upload)
+
+    UDP test packets are echoed straight back to the sender.
+    '''
+
+    def __init__(self, bind_addr='', port=5201, debug=False, max_duration=60):
+
+        import threading
+
+        self.bind_addr = bind_addr
+        self.port = port
+        self.debug = debug
+        self.max_duration = max_duration
+
+        self.tcp_socket = None
+        self.udp_socket = None
+        self.threads = []
+        self.stop_event = threading.Event()
+
+    def start(self):
+        '''
+        Open our sockets & start serving in background threads. Returns the
+        port we are listening on (useful if port 0 was requested).
+        '''
+        import socket
+        import threading
+
+        self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_socket.bind((self.bind_addr, self.port))
+        self.tcp_socket.listen(16)
+        self.tcp_socket.settimeout(0.5)
+
+        self.port = self.tcp_socket.getsockname()[1]
+
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.bind((self.bind_addr, self.port))
+        self.udp_socket.settimeout(0.5)
+
+        for target in [self.serve_tcp, self.serve_udp]:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+        if self.debug:
+            print("Reflector: listening on port " + str(self.port))
+
+        return self.port
+
+    def stop(self):
+
+        self.stop_event.set()
+
+        for thread in self.threads:
+            thread.join()
+
+        self.tcp_socket.close()
+        self.udp_socket.close()
+
+    def serve_forever(self):
+
+        self.start()
+
+        try:
+            while not self.stop_event.wait(1):
+                pass
+        finally:
+            self.stop()
+
+    def serve_tcp(self):
+
+        import socket
+        import threading
+
+        while not self.stop_event.is_set():
+            try:
+                (conn, address) = self.tcp_socket.accept()
+            except socket.timeout:
+                continue
+
+            thread = threading.Thread(target=self.handle_tcp, args=(conn, address))
+            thread.daemon = True
+            thread.start()
+
+    def handle_tcp(self, conn, address):
+
+        import time
+
+        try:
+            conn.settimeout(10)
+
+            command = b''
+
+            while not command.endswith(b'\n') and len(command) < 64:
+                data = conn.recv(1)
+                if not data:
+                    return
+                command += data
+
+            args = command.decode('ascii', 'replace').split()
+
+            if self.debug:
+                print("Reflector: " + str(address) + " " + " ".join(args))
+
+            if args[0] == 'SEND':
+                # send until time is up or the client goes away
+                deadline = time.time() + min(float(args[1]), self.max_duration)
+                data = b'\0' * BUFFER_SIZE
+
+                while time.time() < deadline and not self.stop_event.is_set():
+                    conn.sendall(data)
+
+            elif args[0] == 'RECV':
+                received = 0
+
+                while True:
+                    data = conn.recv(BUFFER_SIZE)
+                    if not data:
+                        break
+                    received += len(data)
+
+                conn.sendall((str(received) + '\n').encode('ascii'))
+        except Exception as ex:
+            if self.debug:
+                print("Reflector: connection from " + str(address) + " failed: " + str(ex))
+        finally:
+            conn.close()
+
+    def serve_udp(self):
+
+        import socket
+
+        while not self.stop_event.is_set():
+            try:
+                (data, address) = self.udp_socket.recvfrom(BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            except socket.error:
+                continue
+
+            if data.startswith(UDP_MAGIC):
+                try:
+                    self.udp_socket.sendto(data, address)
+                except socket.error:
+                    pass
+
+class ReflectorClient(object):
+    '''
+    A class to run throughput tests against a ReflectorServer. run() returns
+    a dictionary of results (rates in Mbps, loss in %, jitter in ms - "NA"
+    if a test failed):
+
+        lan_tcp_down, lan_tcp_up, lan_udp_rate, lan_udp_loss, lan_udp_jitter
+
+    Tests run over interface (with source_addr, its address) if given,
+    rather than following the default route (see sourcebind.py)
+    '''
+
+    def __init__(self, host, port=5201, logger=None, debug=False, streams=4, duration=5,
+        udp_rate=20, udp_packet_size=1200, timeout=5, interface=None, source_addr=None):
+
+        self.host = host
+        self.port = int(port)
+        self.logger = logger
+        self.debug = debug
+        self.streams = int(streams)
+        self.duration = float(duration)
+        self.udp_rate = float(udp_rate)
+        self.udp_packet_size = int(udp_packet_size)
+        self.timeout = float(timeout)
+        self.interface = interface
+        self.source_addr = source_addr
+
+    def connect(self, command):
+
+        from sourcebind import create_connection
+
+        conn = create_connection((self.host, self.port), self.timeout,
+            (self.source_addr, 0) if self.source_addr else None, self.interface)
+        conn.sendall((command + '\n').encode('ascii'))
+
+        return conn
+
+    def tcp_stream(self, direction, results, index):
+        '''
+        Run a single TCP stream, storing (bytes, start time, end time) in
+        results[index]
+        '''
+        import socket
+        import time
+
+        transferred = 0
+
+        if direction == 'down':
+            conn = self.connect('SEND ' + str(self.duration))
+            start_time = time.time()
+
+            try:
+                while True:
+                    data = conn.recv(BUFFER_SIZE)
+                    if not data:
+                        break
+                    transferred += len(data)
+            finally:
+                conn.close()
+        else:
+            conn = self.connect('RECV')
+            start_time = time.time()
+            data = b'\0' * BUFFER_SIZE
+
+            try:
+                while time.time() - start_time < self.duration:
+                    conn.sendall(data)
+
+                conn.shutdown(socket.SHUT_WR)
+
+                # the server tells us how much actually arrived
+                reply = b''
+                while not reply.endswith(b'\n'):
+                    chunk = conn.recv(64)
+                    if not chunk:
+                        break
+                    reply += chunk
+
+                transferred = int(reply.strip())
+            finally:
+                conn.close()
+
+        results[index] = (transferred, start_time, time.time())
+
+    def tcp_test(self, direction):
+        '''
+        TCP goodput (Mbps) over all streams, for 'down' or 'up'
+        '''
+        import threading
+
+        results = [None] * self.streams
+        errors = []
+
+        def stream_worker(index):
+            try:
+                self.tcp_stream(direction, results, index)
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=stream_worker, args=(index,)) for index in range(self.streams)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        if errors or None in results:
+            raise IOError("TCP " + direction + " test failed: " + str(errors[0] if errors else "no result"))
+
+        total_bytes = sum([result[0] for result in results])
+        elapsed = max([result[2] for result in results]) - min([result[1] for result in results])
+
+        return total_bytes * 8 / elapsed / 1e6
+
+    def udp_test(self):
+        '''
+        Send UDP packets to the reflector at our target rate & collect the
+        echoes. Returns (rate Mbps, loss %, jitter ms - None if fewer than two
+        packets came back).
+        '''
+        import socket
+        import struct
+        import threading
+        import time
+        from sourcebind import bind_socket
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        bind_socket(sock, self.interface, self.source_addr)
+        sock.connect((self.host, self.port))
+        sock.settimeout(0.2)
+
+        header_size = struct.calcsize(UDP_HEADER)
+        padding = b'\0' * max(self.udp_packet_size - header_size, 0)
+        interval = self.udp_packet_size * 8 / (self.udp_rate * 1e6)
+
+        sent = [0]
+        send_done = threading.Event()
+
+        def sender():
+            start_time = time.time()
+            seq = 0
+
+            # pace packets to our target rate (catching up if we fall behind)
+            while time.time() - start_time < self.duration:
+                next_send = start_time + seq * interval
+                delay = next_send - time.time()
+
+                if delay > 0:
+                    time.sleep(delay)
+
+                try:
+                    sock.send(struct.pack(UDP_HEADER, UDP_MAGIC, seq, time.time()) + padding)
+                except socket.error:
+                    pass
+
+                seq += 1
+
+            sent[0] = seq
+            send_done.set()
+
+        thread = threading.Thread(target=sender)
+        thread.start()
+
+        received = set()
+        received_bytes = 0
+        last_rtt = None
+        jitter = 0.0
+        last_receive = time.time()
+
+        # collect echoes until sending is done & nothing more has arrived for
+        # a while
+        while not send_done.is_set() or time.time() - last_receive < 0.5:
+            try:
+                data = sock.recv(BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            except socket.error:
+                continue
+
+            now = time.time()
+
+            if len(data) < header_size:
+                continue
+
+            (magic, seq, send_time) = struct.unpack(UDP_HEADER, data[:header_size])
+
+            if magic != UDP_MAGIC or seq in received:
+                continue
+
+            received.add(seq)
+            received_bytes += len(data)
+            last_receive = now
+
+            # interarrival jitter, as RFC 3550 (smoothed variation in transit
+            # time between successive packets)
+            rtt = now - send_time
+
+            if last_rtt is not None:
+                jitter += (abs(rtt - last_rtt) - jitter) / 16
+
+            last_rtt = rtt
+
+        thread.join()
+        sock.close()
+
+        if sent[0] == 0:
+            raise IOError("UDP test failed: no packets sent")
+
+        loss = (sent[0] - len(received)) * 100.0 / sent[0]
+
+        if len(received) < 2:
+            jitter = None
+        else:
+            jitter = jitter * 1000
+
+        return (received_bytes * 8 / self.duration / 1e6, loss, jitter)
+
+    def run(self):
+        '''
+        Run all tests & return a dictionary of results
+        '''
+        results = {'lan_tcp_down': "NA", 'lan_tcp_up': "NA", 'lan_udp_rate': "NA",
+            'lan_udp_loss': "NA", 'lan_udp_jitter': "NA"}
+
+        tests = [('lan_tcp_down', lambda: self.tcp_test('down')),
+            ('lan_tcp_up', lambda: self.tcp_test('up')),
+            ('lan_udp', self.udp_test)]
+
+        for (name, test) in tests:
+            try:
+                result = test()
+            except Exception as ex:
+                if self.logger:
+                    self.logger.log_error("Reflector test " + name + " against " + self.host + " failed: " + str(ex))
+                continue
+
+            if name == 'lan_udp':
+                results['lan_udp_rate'] = '%.2f' % result[0]
+                results['lan_udp_loss'] = '%.2f' % result[1]
+                if result[2] is not None:
+                    results['lan_udp_jitter'] = '%.3f' % result[2]
+                elif self.logger:
+                    self.logger.log_error("Reflector UDP test: no packets echoed back by " + self.host)
+            else:
+                results[name] = '%.2f' % result
+
+        if self.debug:
+            print("Reflector results: " + str(results))
+
+        return results
+
+class ErrorList(object):
+    ''' Logger that keeps error messages (for the self test) '''
+
+    def __init__(self):
+        self.errors = []
+
+    def log_error(self, err_msg):
+        self.errors.append(err_msg)
+
+def run_self_test(streams=2, duration=1, udp_rate=20, debug=False):
+    '''
+    Run a reflector on 127.0.0.1 (on a free port) & test against it with a
+    ReflectorClient, checking that every test produced a result. Returns
+    the client's results.
+    '''
+    server = ReflectorServer('127.0.0.1', 0, debug)
+    port = server.start()
+
+    logger = ErrorList()
+
+    try:
+        results = ReflectorClient('127.0.0.1', port, logger, debug, streams, duration, udp_rate).run()
+    finally:
+        server.stop()
+
+    assert not logger.errors, "Reflector tests failed: " + "; ".join(logger.errors)
+
+    for name in ['lan_tcp_down', 'lan_tcp_up', 'lan_udp_rate']:
+        assert results[name] != "NA" and float(results[name]) > 0, "No " + name + " goodput: " + str(results[name])
+
+    assert results['lan_udp_loss'] != "NA" and 0 <= float(results['lan_udp_loss']) <= 100, \
+        "Bad lan_udp_loss: " + str(results['lan_udp_loss'])
+    assert results['lan_udp_jitter'] != "NA" and float(results['lan_udp_jitter']) >= 0, \
+        "Bad lan_udp_jitter: " + str(results['lan_udp_jitter'])
+
+    return results
+
+def main():
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="WLANPi speedtest agent throughput reflector")
+    parser.add_argument('-b', '--bind', default='', help="address to listen on (default: all)")
+    parser.add_argument('-p', '--port', type=int, default=5201, help="TCP & UDP port to listen on")
+    parser.add_argument('--self-test', action='store_true', help="run a reflector & test against it over loopback")
+    parser.add_argument('--duration', type=float, default=1, help="secs each test runs for (--self-test)")
+    parser.add_argument('-d', '--debug', action='store_true', help="print debug messages")
+    args = parser.parse_args()
+
+    if args.self_test:
+        results = run_self_test(duration=args.duration, debug=args.debug)
+
+        for name in sorted(results.keys()):
+            print("%-16s %s" % (name, results[name]))
+
+        print("OK")
+        return
+
+    ReflectorServer(args.bind, args.port, args.debug).serve_forever()
+
+if __name__ == "__main__":
+    main()
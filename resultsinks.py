@@ -0,0 +1,588 @@
+'''
+Result sinks: the places that test results are sent to (Google sheet, local
+DB, a rotating file, an HTTP collector...).
+
+Every result is queued in a separate outbox for each sink & each sink is
+flushed in its own thread, so a slow or failing sink never holds up the
+others - its results just wait in its outbox until it recovers.
+'''
+from __future__ import print_function
+
+# result fields that make up a row of the daily worksheet (in column order)
+SHEET_ROW_FIELDS = ['date', 'ping_time', 'download_rate', 'upload_rate',
+    'ssid', 'bssid', 'freq', 'bit_rate', 'signal_level', 'ip_addr', 'location',
+    'server_name', 'ping_host1', 'pkts_tx1', 'percent_loss1', 'rtt_avg1',
+    'ping_host2', 'pkts_tx2', 'percent_loss2', 'rtt_avg2', 'ping_host3',
+    'pkts_tx3', 'percent_loss3', 'rtt_avg3']
+
+# sheet column holding the unique key of each result
+RESULT_KEY_COLUMN = 25
+
+# result fields added to the worksheet row after the result key (columns
+# added since result keys were introduced)
+SHEET_EXTRA_FIELDS = ['lan_tcp_down', 'lan_tcp_up', 'lan_udp_rate', 'lan_udp_loss',
+    'lan_udp_jitter', 'interface']
+
+# ping target result fields stored in the local DB (as columns of the same
+# name)
+DB_PING_FIELDS = ['ping_host1', 'percent_loss1', 'rtt_avg1', 'ping_host2',
+    'percent_loss2', 'rtt_avg2', 'ping_host3', 'percent_loss3', 'rtt_avg3']
+
+# result fields written by the file sink (after the result key)
+FILE_FIELDS = ['timestamp', 'hostname'] + SHEET_ROW_FIELDS + SHEET_EXTRA_FIELDS
+
+SINK_NAMES = ['gsheet', 'sqlite', 'file', 'http']
+
+def db_number(value):
+    '''
+    Numeric results are "NA" if unavailable - store these as NULL in the DB
+    '''
+    if value == "NA":
+        return None
+    return value
+
+class ResultSink(object):
+    '''
+    Base class for a result sink. Results are queued in the sink's outbox
+    with enqueue() & sent (oldest first, in batches) by flush(), which is run
+    in the sink's own thread & uses its own DB connection.
+
+    Sub-classes implement deliver(results) to send a batch of outbox results
+    (a list of dictionaries of: id, result_key, payload, attempts,
+    last_target), returning True if the batch was accepted - or override
+    flush() to send results some other way. describe() names where results
+    are being sent (just the sink name, unless overridden).
+    '''
+
+    name = 'sink'
+
+    def __init__(self, db_file, logger, debug=False, max_rows=0, max_age_days=0,
+        batch_size=500, retry_base=60, retry_max=3600):
+
+        import threading
+
+        self.db_file = db_file
+        self.logger = logger
+        self.debug = debug
+        self.max_rows = max_rows
+        self.max_age_days = max_age_days
+        self.batch_size = batch_size
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+
+        # held while a flush is in progress
+        self.busy = threading.Lock()
+
+        self.db_conn = None
+
+    def get_outbox(self, db_conn):
+        ''' Our outbox queue, via the given DB connection '''
+        from outbox import Outbox
+
+        return Outbox(db_conn, self.logger, self.max_rows, self.max_age_days,
+            self.debug, self.retry_base, self.retry_max, sink=self.name)
+
+    def get_connection(self):
+        '''
+        Our own DB connection for use while flushing (created on first use &
+        kept open until close())
+        '''
+        import sqlite3
+
+        if self.db_conn is None:
+            self.db_conn = sqlite3.connect(self.db_file, check_same_thread=False)
+
+        return self.db_conn
+
+    def close(self):
+        '''
+        Close our DB connection (left alone if a flush is still running)
+        '''
+        if self.db_conn is None or not self.busy.acquire(False):
+            return
+
+        try:
+            self.db_conn.close()
+            self.db_conn = None
+        finally:
+            self.busy.release()
+
+    def enqueue(self, db_conn, record, result_key):
+        '''
+        Queue a result (dictionary of result fields) for this sink. This is
+        called from the main thread with the caller's DB connection.
+        '''
+        return self.get_outbox(db_conn).enqueue(record, result_key)
+
+    def describe(self):
+        ''' Where results are being sent (recorded against each attempt) '''
+        return self.name
+
+    def flush(self):
+        '''
+        Send results waiting in our outbox. Results are only removed from the
+        outbox once they have been accepted - failures are retried later
+        with a backoff. Returns True if everything due was sent.
+        '''
+        outbox = self.get_outbox(self.get_connection())
+
+        pending_results = outbox.pending(self.batch_size)
+
+        if not pending_results:
+            return True
+
+        if self.debug:
+            print("Sink " + self.name + ": sending " + str(len(pending_results)) + " results")
+
+        result_ids = [result['id'] for result in pending_results]
+
+        outbox.mark_attempt(result_ids, self.describe())
+
+        try:
+            delivered = self.deliver(pending_results)
+            error = "Delivery to " + self.describe() + " failed"
+        except Exception as ex:
+            delivered = False
+            error = str(ex)
+
+        if delivered:
+            outbox.ack(result_ids)
+        else:
+            self.logger.log_error("Sink " + self.name + ": " + error + " (will retry later)")
+            outbox.nack(result_ids, error)
+
+        return delivered
+
+class GsheetSink(ResultSink):
+    '''
+    Append results to today's worksheet of our Google sheet. The Gsheet
+    object is passed in with set_gsheet() each test cycle (results just wait
+    in the outbox while we have no Google sheet connection).
+    '''
+
+    name = 'gsheet'
+
+    def __init__(self, db_file, logger, debug=False, **kwargs):
+
+        ResultSink.__init__(self, db_file, logger, debug, **kwargs)
+
+        self.gsheet = False
+
+    def set_gsheet(self, gsheet):
+        self.gsheet = gsheet
+
+    def sheet_row(self, result):
+        '''
+        Worksheet row for an outbox result (with the result key in column
+        RESULT_KEY_COLUMN). Results queued before result sinks were added are
+        already a list of row values.
+
+        Cycle phase timings (see phasetimer.py) follow SHEET_EXTRA_FIELDS if
+        the result has them.
+        '''
+        from phasetimer import PHASE_FIELDS
+
+        payload = result['payload']
+
+        if isinstance(payload, list):
+            return payload + [result['result_key']]
+
+        row = ([payload.get(field, "NA") for field in SHEET_ROW_FIELDS] + [result['result_key']] +
+            [payload.get(field, "NA") for field in SHEET_EXTRA_FIELDS])
+
+        if 'phase_total' in payload:
+            row += [payload.get(field, "NA") for field in PHASE_FIELDS]
+
+        return row
+
+    def flush(self):
+        '''
+        Upload results waiting in the outbox to today's worksheet in a single
+        batched append.
+
+        If we have tried to send a result before, we check the sheet we sent it
+        to for its key first, in case the earlier upload made it without us
+        hearing back.
+        '''
+        gsheet = self.gsheet
+
+        if not gsheet:
+            return False
+
+        outbox = self.get_outbox(self.get_connection())
+
+        pending_results = outbox.pending(self.batch_size)
+
+        if not pending_results:
+            return True
+
+        # check if we need to create new sheet (new day?)
+        gsheet.create_worksheet_if_needed()
+
+        sheet = gsheet.open_gspread_worksheet(gsheet.get_todays_worksheet_name())
+
+        if sheet == False:
+            return False
+
+        if self.debug:
+            print("Sink " + self.name + ": sending " + str(len(pending_results)) + " results")
+
+        # find any results from an earlier attempt that actually made it
+        uploaded_keys = set()
+
+        retry_targets = set([result['last_target'] for result in pending_results if result['attempts'] > 0 and result['last_target']])
+
+        for target in retry_targets:
+
+            target_sheet = sheet if target == sheet.title else gsheet.open_gspread_worksheet(target)
+
+            if target_sheet == False:
+                continue
+
+            try:
+                uploaded_keys.update(gsheet.api.call('col_values', target_sheet.col_values, RESULT_KEY_COLUMN))
+            except Exception as error:
+                gsheet.handle_api_error(error)
+                self.logger.log_error("Unable to check for previously uploaded results (will try again later): " + str(error))
+                return False
+
+        already_uploaded = [result['id'] for result in pending_results if result['result_key'] in uploaded_keys]
+
+        if already_uploaded:
+            if self.debug:
+                print(str(len(already_uploaded)) + " outbox results already uploaded")
+            outbox.ack(already_uploaded)
+
+        pending_results = [result for result in pending_results if result['result_key'] not in uploaded_keys]
+
+        if not pending_results:
+            return True
+
+        result_ids = [result['id'] for result in pending_results]
+        sheet_rows = [self.sheet_row(result) for result in pending_results]
+
+        outbox.mark_attempt(result_ids, sheet.title)
+
+        chunk_size = 500
+        append_results = gsheet.append_rows(sheet, sheet_rows, chunk_size)
+
+        # acknowledge the results in each chunk that made it, retry the rest later
+        for chunk_number in range(0, (len(result_ids) + chunk_size - 1) // chunk_size):
+
+            chunk_ids = result_ids[chunk_number * chunk_size:(chunk_number + 1) * chunk_size]
+
+            if chunk_number < len(append_results) and append_results[chunk_number]:
+                outbox.ack(chunk_ids)
+            else:
+                outbox.nack(chunk_ids, "Append to " + sheet.title + " failed")
+
+        return all(append_results)
+
+class SqliteSink(ResultSink):
+    '''
+    Store results in the speedtest_data table of our local DB (& add them
+    to the hourly/daily rollups in the same transaction)
+    '''
+
+    name = 'sqlite'
+
+    def describe(self):
+        return self.db_file
+
+    def deliver(self, results):
+
+        from rollups import update_rollups
+
+        rows = []
+
+        for result in results:
+            record = result['payload']
+
+            rows.append((record['timestamp'], record['cleartext_date'],
+                db_number(record['ping_time']), db_number(record['download_rate']),
+                db_number(record['upload_rate']), record['ssid'], record['bssid'],
+                db_number(record['freq']), db_number(record['bit_rate']),
+                db_number(record['signal_level']), record['ip_addr']) +
+                tuple([db_number(record.get(field, "NA")) for field in SHEET_EXTRA_FIELDS + DB_PING_FIELDS]))
+
+        extra_fields = SHEET_EXTRA_FIELDS + DB_PING_FIELDS
+
+        db_conn = self.get_connection()
+
+        with db_conn:
+            db_conn.executemany("insert into speedtest_data (timestamp, cleartext_date, ping_time, download_rate, upload_rate, ssid, bssid, freq, bit_rate, signal_level, ip_address, " +
+                ", ".join(extra_fields) + ") values (?,?,?,?,?,?,?,?,?,?,?," + ",".join(["?"] * len(extra_fields)) + ")", rows)
+
+            for result in results:
+                update_rollups(db_conn, result['payload'])
+
+        return True
+
+class FileSink(ResultSink):
+    '''
+    Append results to a local file as CSV or JSON lines (file_format: 'csv'
+    or 'jsonl'). The file is rotated once it reaches max_bytes, keeping
+    "backups" old files (<path>.1, <path>.2...).
+    '''
+
+    name = 'file'
+
+    def __init__(self, db_file, logger, debug=False, path='results.jsonl',
+        file_format='jsonl', max_bytes=1048576, backups=5, **kwargs):
+
+        ResultSink.__init__(self, db_file, logger, debug, **kwargs)
+
+        self.path = path
+        self.file_format = file_format
+        self.max_bytes = int(max_bytes)
+        self.backups = int(backups)
+
+    def describe(self):
+        return self.path
+
+    def rotate_if_needed(self):
+        '''
+        Rotate the file if it has reached its size limit
+        '''
+        import os
+
+        if self.max_bytes <= 0 or not os.path.exists(self.path) or os.path.getsize(self.path) < self.max_bytes:
+            return
+
+        if self.debug:
+            print("Sink " + self.name + ": rotating " + self.path)
+
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+
+        for backup_number in range(self.backups - 1, 0, -1):
+            backup_file = self.path + "." + str(backup_number)
+
+            if os.path.exists(backup_file):
+                os.rename(backup_file, self.path + "." + str(backup_number + 1))
+
+        os.rename(self.path, self.path + ".1")
+
+    def deliver(self, results):
+
+        import json
+        import os
+        import sys
+
+        self.rotate_if_needed()
+
+        if self.file_format == 'csv':
+            import csv
+
+            new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+
+            if sys.version_info[0] < 3:
+                file_obj = open(self.path, 'ab')
+            else:
+                file_obj = open(self.path, 'a', newline='')
+
+            def file_value(value):
+                # python 2 csv module only handles byte strings
+                if sys.version_info[0] < 3 and isinstance(value, unicode):
+                    return value.encode('utf-8')
+                return value
+
+            with file_obj:
+                writer = csv.writer(file_obj)
+
+                if new_file:
+                    writer.writerow(['result_key'] + FILE_FIELDS)
+
+                for result in results:
+                    writer.writerow([result['result_key']] + [file_value(result['payload'].get(field, "NA")) for field in FILE_FIELDS])
+        else:
+            with open(self.path, 'a') as file_obj:
+                for result in results:
+                    record = dict(result['payload'], result_key=result['result_key'])
+                    file_obj.write(json.dumps(record, sort_keys=True) + "\n")
+
+        return True
+
+class HttpPostSink(ResultSink):
+    '''
+    POST batches of results to an HTTP collector as gzipped JSON:
+
+        {"hostname": ..., "location": ..., "results": [{...}, ...]}
+
+    Each result carries its result_key so that the collector can discard
+    duplicates from retried posts. Any 2xx response means the batch was
+    accepted.
+    '''
+
+    name = 'http'
+
+    def __init__(self, db_file, logger, debug=False, url='', timeout=10, **kwargs):
+
+        ResultSink.__init__(self, db_file, logger, debug, **kwargs)
+
+        self.url = url
+        self.timeout = float(timeout)
+
+    def describe(self):
+        return self.url
+
+    def deliver(self, results):
+
+        import gzip
+        import io
+        import json
+        import socket
+
+        try:
+            from urllib2 import Request, urlopen, HTTPError
+        except ImportError:
+            from urllib.request import Request, urlopen
+            from urllib.error import HTTPError
+
+        records = [dict(result['payload'], result_key=result['result_key']) for result in results]
+
+        body = {'hostname': socket.gethostname(), 'location': records[-1].get('location', ''),
+            'results': records}
+
+        data = io.BytesIO()
+
+        with gzip.GzipFile(fileobj=data, mode='wb') as gzip_file:
+            gzip_file.write(json.dumps(body).encode('utf-8'))
+
+        request = Request(self.url, data.getvalue(), {'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip'})
+
+        try:
+            response = urlopen(request, timeout=self.timeout)
+            status = response.getcode()
+            response.close()
+        except HTTPError as ex:
+            status = ex.code
+
+        if self.debug:
+            print("Sink " + self.name + ": POST to " + self.url + " returned " + str(status))
+
+        return 200 <= status < 300
+
+class SinkPipeline(object):
+    '''
+    Fan results out to a set of result sinks. Each result is queued for
+    every sink, then all sinks are flushed concurrently (one thread per
+    sink). We wait up to "timeout" secs for the sinks to finish - any sink
+    still running after that carries on in the background.
+    '''
+
+    def __init__(self, sinks, logger, timeout=60, debug=False):
+
+        self.sinks = sinks
+        self.logger = logger
+        self.timeout = float(timeout)
+        self.debug = debug
+
+    def get_sink(self, name):
+        ''' Sink by name (None if not enabled) '''
+        for sink in self.sinks:
+            if sink.name == name:
+                return sink
+        return None
+
+    def flush_sink(self, sink, status):
+
+        try:
+            status[sink.name] = sink.flush()
+        except Exception as ex:
+            self.logger.log_error("Sink " + sink.name + ": unexpected error: " + str(ex))
+            status[sink.name] = False
+        finally:
+            sink.busy.release()
+
+    def publish(self, db_conn, record, result_key=None):
+        '''
+        Queue a result for all sinks & flush them. Returns a dictionary of
+        status per sink name: True (all sent), False (failed, queued for
+        retry) or None (still running/busy - results stay queued).
+        '''
+        import threading
+        import time
+        import uuid
+
+        # the same key is used for the result in every sink
+        if result_key is None:
+            result_key = uuid.uuid4().hex
+
+        for sink in self.sinks:
+            sink.enqueue(db_conn, record, result_key)
+
+        status = dict([(sink.name, None) for sink in self.sinks])
+        threads = []
+
+        for sink in self.sinks:
+
+            # a sink still working on an earlier flush (daemon mode) will pick
+            # up the new result on its next flush
+            if not sink.busy.acquire(False):
+                self.logger.log_error("Sink " + sink.name + ": still busy from previous cycle, result queued")
+                continue
+
+            thread = threading.Thread(target=self.flush_sink, args=(sink, status))
+            thread.daemon = True
+            thread.start()
+            threads.append((sink, thread))
+
+        deadline = time.time() + self.timeout
+
+        for (sink, thread) in threads:
+            thread.join(max(deadline - time.time(), 0))
+
+            if thread.is_alive():
+                self.logger.log_error("Sink " + sink.name + ": not finished after " + str(self.timeout) + " secs, continuing without it")
+
+        if self.debug:
+            print("Sink pipeline status: " + str(status))
+
+        return status
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+def create_sink_pipeline(config_vars, logger, debug=False):
+    '''
+    Create the result sinks enabled in our config (config_vars['sinks'])
+    '''
+    sink_classes = {'gsheet': GsheetSink, 'sqlite': SqliteSink, 'file': FileSink,
+        'http': HttpPostSink}
+
+    sinks = []
+
+    for name in config_vars['sinks']:
+
+        if name not in sink_classes:
+            logger.log_error("Unknown result sink in config: " + name)
+            continue
+
+        (retry_base, retry_max) = config_vars['sink_retry'][name]
+
+        kwargs = {'max_rows': config_vars['outbox_max_rows'],
+            'max_age_days': config_vars['outbox_max_age_days'],
+            'batch_size': config_vars['outbox_batch_size'],
+            'retry_base': retry_base, 'retry_max': retry_max}
+
+        if name == 'file':
+            kwargs.update({'path': config_vars['sink_file_path'],
+                'file_format': config_vars['sink_file_format'],
+                'max_bytes': config_vars['sink_file_max_bytes'],
+                'backups': config_vars['sink_file_backups']})
+
+        if name == 'http':
+            if not config_vars['sink_http_url']:
+                logger.log_error("HTTP result sink enabled, but no http_url configured")
+                continue
+
+            kwargs.update({'url': config_vars['sink_http_url'],
+                'timeout': config_vars['sink_http_timeout']})
+
+        sinks.append(sink_classes[name](config_vars['db_file'], logger, debug, **kwargs))
+
+    return SinkPipeline(sinks, logger, config_vars['sink_timeout'], debug)
@@ -0,0 +1,244 @@
+#!/usr/bin/python
+'''
+Hourly & daily rollups of our results, kept up to date as each result is
+stored in the local DB. Raw results are only kept for a few days, but the
+rollups (count, min, max, mean & approximate p50/p95 per SSID/BSSID for
+download, upload, speedtest latency & the RTT of each ping target) keep
+months of history in very little space - longer term queries read these
+rather than the raw results.
+
+Percentiles come from a sparse histogram with log-spaced buckets (each
+bucket HIST_GROWTH times wider than the last), so they are within a few %
+of the true value & histograms of different periods can just be added
+together.
+
+To query the rollups:
+
+    python rollups.py --db speedtest.db --metric download --days 90
+'''
+from __future__ import print_function
+
+# rollup tables & the length (secs) of their periods (periods are aligned
+# to UTC hours/days)
+ROLLUP_TABLES = {'hourly': ('rollup_hourly', 3600), 'daily': ('rollup_daily', 86400)}
+
+# (result field, metric name) of the results we roll up - ping target RTTs
+# are rolled up as "rtt:<target>"
+ROLLUP_FIELDS = [('download_rate', 'download'), ('upload_rate', 'upload'), ('ping_time', 'ping')]
+
+# relative width of histogram buckets
+HIST_GROWTH = 1.05
+
+def hist_bucket(value):
+    '''
+    Histogram bucket of a value (values of 0 or less share bucket "z")
+    '''
+    import math
+
+    if value <= 0:
+        return 'z'
+
+    return str(int(math.floor(math.log(value) / math.log(HIST_GROWTH))))
+
+def hist_bucket_value(bucket):
+    '''
+    Mid point of a histogram bucket
+    '''
+    if bucket == 'z':
+        return 0.0
+
+    return HIST_GROWTH ** (int(bucket) + 0.5)
+
+def hist_merge(hist, other):
+    ''' Add the counts of one histogram to another '''
+    for (bucket, count) in other.items():
+        hist[bucket] = hist.get(bucket, 0) + count
+
+    return hist
+
+def hist_percentile(hist, pct, min_value, max_value):
+    '''
+    Approximate percentile (pct = 0-100) of a histogram, clamped to the
+    min/max values seen
+    '''
+    total = sum(hist.values())
+
+    if not total:
+        return None
+
+    rank = pct / 100.0 * total
+    seen = 0
+
+    # buckets in value order ("z" first)
+    buckets = sorted(hist.keys(), key=lambda bucket: float('-inf') if bucket == 'z' else int(bucket))
+
+    for bucket in buckets:
+        seen += hist[bucket]
+
+        if seen >= rank:
+            break
+
+    return min(max(hist_bucket_value(bucket), min_value), max_value)
+
+def rollup_values(record):
+    '''
+    The values we roll up from a result: {metric: value} (results that are
+    "NA" are left out)
+    '''
+    values = {}
+
+    fields = list(ROLLUP_FIELDS)
+
+    for ping_number in range(1, 4):
+        target = record.get('ping_host' + str(ping_number), "NA")
+
+        if target not in ("NA", None, ''):
+            fields.append(('rtt_avg' + str(ping_number), 'rtt:' + target))
+
+    for (field, metric) in fields:
+        try:
+            values[metric] = float(record.get(field, "NA"))
+        except (TypeError, ValueError):
+            continue
+
+    return values
+
+def update_rollups(db_conn, record):
+    '''
+    Add a result to the hourly & daily rollups (run this in the same
+    transaction as storing the result)
+    '''
+    import json
+
+    values = rollup_values(record)
+
+    timestamp = int(record['timestamp'])
+    ssid = record.get('ssid') or ''
+    bssid = record.get('bssid') or ''
+
+    for (table, period) in ROLLUP_TABLES.values():
+
+        period_start = timestamp - timestamp % period
+
+        for (metric, value) in values.items():
+            row = db_conn.execute("select count, min, max, sum, histogram from " + table +
+                " where period_start = ? and ssid = ? and bssid = ? and metric = ?",
+                (period_start, ssid, bssid, metric)).fetchone()
+
+            if row is None:
+                (count, min_value, max_value, total, hist) = (0, value, value, 0.0, {})
+            else:
+                (count, min_value, max_value, total, hist) = (row[0], row[1], row[2], row[3], json.loads(row[4]))
+
+            bucket = hist_bucket(value)
+            hist[bucket] = hist.get(bucket, 0) + 1
+
+            db_conn.execute("insert or replace into " + table +
+                " (period_start, ssid, bssid, metric, count, min, max, sum, histogram) values (?,?,?,?,?,?,?,?,?)",
+                (period_start, ssid, bssid, metric, count + 1, min(min_value, value),
+                max(max_value, value), total + value, json.dumps(hist, sort_keys=True)))
+
+def summarize(rows):
+    '''
+    Combine rollup rows (count, min, max, sum, histogram JSON) into a
+    single summary: {count, min, max, mean, p50, p95}
+    '''
+    import json
+
+    count = 0
+    total = 0.0
+    min_value = None
+    max_value = None
+    hist = {}
+
+    for (row_count, row_min, row_max, row_sum, row_hist) in rows:
+        count += row_count
+        total += row_sum
+        min_value = row_min if min_value is None else min(min_value, row_min)
+        max_value = row_max if max_value is None else max(max_value, row_max)
+        hist_merge(hist, json.loads(row_hist))
+
+    if not count:
+        return None
+
+    return {'count': count, 'min': min_value, 'max': max_value, 'mean': total / count,
+        'p50': hist_percentile(hist, 50, min_value, max_value),
+        'p95': hist_percentile(hist, 95, min_value, max_value)}
+
+def query_rollups(db_conn, metric, start, end, granularity='daily', ssid=None, bssid=None):
+    '''
+    Summaries of a metric for each hourly/daily period from start to end
+    (timestamps), across all SSIDs/BSSIDs unless one is given. Returns a
+    list of (period_start, summary) in time order.
+    '''
+    (table, period) = ROLLUP_TABLES[granularity]
+
+    query = "select period_start, count, min, max, sum, histogram from " + table + " where metric = ? and period_start >= ? and period_start < ?"
+    args = [metric, start - start % period, end]
+
+    if ssid is not None:
+        query += " and ssid = ?"
+        args.append(ssid)
+
+    if bssid is not None:
+        query += " and bssid = ?"
+        args.append(bssid)
+
+    periods = {}
+
+    for row in db_conn.execute(query + " order by period_start", args).fetchall():
+        periods.setdefault(row[0], []).append(row[1:])
+
+    return [(period_start, summarize(periods[period_start])) for period_start in sorted(periods.keys())]
+
+def backfill_rollups(db_conn):
+    '''
+    Build rollups from the results already in speedtest_data (there are no
+    ping target RTTs in there, so those start from now)
+    '''
+    cursor = db_conn.execute("select timestamp, ssid, bssid, download_rate, upload_rate, ping_time from speedtest_data order by id")
+
+    for row in cursor.fetchall():
+        update_rollups(db_conn, {'timestamp': row[0], 'ssid': row[1], 'bssid': row[2],
+            'download_rate': row[3], 'upload_rate': row[4], 'ping_time': row[5]})
+
+def main():
+
+    import argparse
+    import csv
+    import datetime
+    import sqlite3
+    import sys
+    import time
+
+    parser = argparse.ArgumentParser(description="Query the speedtest agent's result rollups")
+    parser.add_argument('--db', default='speedtest.db', help="agent DB file")
+    parser.add_argument('-m', '--metric', default='download', help="download, upload, ping or rtt:<ping target>")
+    parser.add_argument('--days', type=float, default=30, help="how far back to go")
+    parser.add_argument('--hourly', action='store_true', help="hourly rather than daily periods")
+    parser.add_argument('--ssid', help="only this SSID")
+    parser.add_argument('--bssid', help="only this BSSID")
+    parser.add_argument('--list', action='store_true', help="list the metrics, SSIDs & BSSIDs we have rollups for")
+    args = parser.parse_args()
+
+    db_conn = sqlite3.connect(args.db)
+
+    if args.list:
+        for row in db_conn.execute("select metric, ssid, bssid, sum(count), min(period_start), max(period_start) from rollup_daily group by metric, ssid, bssid order by metric, ssid, bssid"):
+            print(",".join([str(value) for value in row]))
+        return
+
+    end = int(time.time())
+    start = int(end - args.days * 86400)
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(['period', 'count', 'min', 'max', 'mean', 'p50', 'p95'])
+
+    for (period_start, summary) in query_rollups(db_conn, args.metric, start, end + 1,
+        'hourly' if args.hourly else 'daily', args.ssid, args.bssid):
+
+        writer.writerow([datetime.datetime.utcfromtimestamp(period_start).strftime("%Y-%m-%d %H:%M"),
+            summary['count']] + ['%.2f' % summary[name] for name in ['min', 'max', 'mean', 'p50', 'p95']])
+
+if __name__ == "__main__":
+    main()
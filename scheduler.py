@@ -0,0 +1,316 @@
+'''
+Scheduling of test cycles: when to run them, what to run & making sure
+that they never overlap.
+
+ - jitter: each probe runs its cycles at its own fixed offset into the
+   interval (picked from its hostname), so that the probes on a site don't
+   all start their speedtests at the same second & skew each other's results
+ - run lock: a cycle only runs while holding an exclusive lock (flock) on
+   the lock file, so a slow run is never overlapped by the next one (from
+   cron or the daemon) - the later run is skipped
+ - adaptive intervals (daemon mode): throughput tests run less often while
+   their results are stable, & lightweight ping-only cycles run in between
+   them while ping loss or RTT is degraded
+
+Skipped & missed runs are counted in the schedule_stats table of the local
+DB (along with the full & ping-only cycles run).
+'''
+from __future__ import print_function
+
+# kinds of test cycle: full (speedtest, reflector & ping tests) or ping
+# tests only
+CYCLE_KINDS = ['full', 'ping']
+
+# events counted in the schedule_stats table
+SCHEDULE_EVENTS = ['full', 'ping', 'overlap', 'missed']
+
+def probe_offset(hostname, spread):
+    '''
+    This probe's offset (secs, 0 to spread) into each interval - the same
+    for every run of the probe, but spread evenly across probes
+    '''
+    import hashlib
+
+    if spread <= 0:
+        return 0.0
+
+    digest = hashlib.md5(hostname.encode('utf-8') if not isinstance(hostname, bytes) else hostname).hexdigest()
+
+    return int(digest[:8], 16) / float(0x100000000) * spread
+
+def record_schedule_event(db_file, event, logger=None, count=1):
+    '''
+    Count schedule events (see SCHEDULE_EVENTS) in the local DB
+    '''
+    import sqlite3
+    import time
+
+    if count <= 0:
+        return True
+
+    try:
+        db_conn = sqlite3.connect(db_file, timeout=30)
+
+        try:
+            with db_conn:
+                db_conn.execute("insert or ignore into schedule_stats (event, count, last_timestamp) values (?,0,0)", (event,))
+                db_conn.execute("update schedule_stats set count = count + ?, last_timestamp = ? where event = ?",
+                    (count, int(time.time()), event))
+        finally:
+            db_conn.close()
+    except Exception as ex:
+        if logger:
+            logger.log_error("Db execute error when trying to record schedule event: " + str(ex))
+        return False
+
+    return True
+
+class RunLock(object):
+    '''
+    A class to hold an exclusive lock (flock) on a lock file while a test
+    cycle runs. The lock is released by the kernel if we die, so a stale
+    lock file never blocks later runs.
+    '''
+
+    def __init__(self, lock_file, debug=False):
+
+        self.lock_file = lock_file
+        self.debug = debug
+
+        self.file_obj = None
+
+    def acquire(self):
+        '''
+        Take the lock if it is free. Returns False if another run holds it.
+        '''
+        import errno
+        import fcntl
+        import os
+        import sys
+
+        # (better to run unlocked than not at all)
+        try:
+            file_obj = open(self.lock_file, 'a+')
+        except (IOError, OSError) as ex:
+            sys.stderr.write("Unable to open run lock file " + self.lock_file + ": " + str(ex) + "\n")
+            return True
+
+        try:
+            fcntl.flock(file_obj.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as ex:
+            file_obj.close()
+
+            if ex.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                if self.debug:
+                    print("Run lock " + self.lock_file + " is held by another run")
+                return False
+            raise
+
+        # (who has the lock, for anyone looking)
+        file_obj.seek(0)
+        file_obj.truncate()
+        file_obj.write(str(os.getpid()) + "\n")
+        file_obj.flush()
+
+        self.file_obj = file_obj
+
+        return True
+
+    def release(self):
+
+        import fcntl
+
+        if self.file_obj is None:
+            return
+
+        fcntl.flock(self.file_obj.fileno(), fcntl.LOCK_UN)
+        self.file_obj.close()
+        self.file_obj = None
+
+class CycleScheduler(object):
+    '''
+    A class to decide when the daemon runs its next test cycle & which kind
+    (see CYCLE_KINDS).
+
+    Full cycles run every interval secs, at this probe's offset (from jitter
+    & hostname) into the interval. If adaptive, the interval is doubled (up
+    to max_interval) each time stable_runs full cycles in a row have
+    download & upload rates within stable_pct % of their recent average, &
+    is back to interval as soon as they aren't. While ping loss reaches
+    degraded_loss % (or average RTT is degraded_rtt_factor times its usual
+    level), ping-only cycles run every ping_interval secs in between.
+    '''
+
+    def __init__(self, interval, hostname='', jitter=0, adaptive=False, max_interval=3600,
+        ping_interval=60, stable_pct=10, stable_runs=3, degraded_loss=5, degraded_rtt_factor=2,
+        history=6, debug=False):
+
+        self.interval = int(interval)
+        self.offset = probe_offset(hostname, min(float(jitter), self.interval))
+        self.adaptive = adaptive
+        self.max_interval = max(int(max_interval), self.interval)
+        self.ping_interval = int(ping_interval)
+        self.stable_pct = float(stable_pct)
+        self.stable_runs = int(stable_runs)
+        self.degraded_loss = float(degraded_loss)
+        self.degraded_rtt_factor = float(degraded_rtt_factor)
+        self.history_size = int(history)
+        self.debug = debug
+
+        # current interval between full cycles
+        self.full_interval = self.interval
+        self.stable_count = 0
+        self.degraded = False
+
+        # recent full cycle rates & healthy ping RTTs
+        self.history = {'download_rate': [], 'upload_rate': [], 'rtt': []}
+
+        # when our last full cycle was due
+        self.last_full_due = None
+
+    def slot_time(self, now, interval):
+        '''
+        Our next slot after now for an interval: slots are aligned to
+        multiples of the interval (as a "*/5" cron entry is), plus our offset
+        '''
+        return (int(now - self.offset) // interval + 1) * interval + self.offset
+
+    def first_run_time(self, now):
+        '''
+        When to run our first cycle: straight away, but for our offset
+        (so that probes restarted together, e.g. after a power cut, don't
+        all test at once)
+        '''
+        return now + self.offset
+
+    def next_run(self, now):
+        '''
+        The next cycle to run after now: (time, kind)
+        '''
+        next_full = self.slot_time(now, self.interval)
+
+        # (a longer interval just skips slots, so we stay on our offset)
+        if self.last_full_due is not None:
+            while next_full < self.last_full_due + self.full_interval - self.interval / 2.0:
+                next_full += self.interval
+
+        if self.adaptive and self.degraded:
+            next_ping = self.slot_time(now, self.ping_interval)
+
+            if next_ping < next_full - self.ping_interval / 2.0:
+                return (next_ping, 'ping')
+
+        return (next_full, 'full')
+
+    def update(self, kind, records, due):
+        '''
+        Adapt our intervals to the results (records) of a cycle that was due
+        at due
+        '''
+        if kind == 'full':
+            self.last_full_due = due
+
+        if not self.adaptive or not records:
+            return
+
+        self.update_degraded(records)
+
+        if kind == 'full':
+            self.update_stable(records)
+
+        if self.debug:
+            print("Scheduler: full cycle interval " + str(self.full_interval) + " secs, " +
+                ("degraded (ping-only cycles every " + str(self.ping_interval) + " secs)" if self.degraded else "not degraded"))
+
+    def update_stable(self, records):
+
+        stable = True
+        tested = False
+
+        for field in ['download_rate', 'upload_rate']:
+            values = [record_value(record.get(field)) for record in records]
+            values = [value for value in values if value is not None]
+
+            if not values:
+                continue
+
+            tested = True
+
+            value = sum(values) / len(values)
+            history = self.history[field]
+
+            if len(history) < self.stable_runs:
+                stable = False
+            else:
+                mean = sum(history) / len(history)
+
+                if not mean or abs(value - mean) / mean * 100 > self.stable_pct:
+                    stable = False
+
+            history.append(value)
+            del history[:-self.history_size]
+
+        if not tested:
+            return
+
+        if stable and not self.degraded:
+            self.stable_count += 1
+
+            if self.stable_count >= self.stable_runs:
+                self.full_interval = min(self.full_interval * 2, self.max_interval)
+                self.stable_count = 0
+        else:
+            self.full_interval = self.interval
+            self.stable_count = 0
+
+    def update_degraded(self, records):
+
+        losses = []
+        rtts = []
+
+        for record in records:
+            for ping_number in range(1, 4):
+                if record.get('ping_host' + str(ping_number), "NA") == "NA":
+                    continue
+
+                loss = record_value(record.get('percent_loss' + str(ping_number)))
+                rtt = record_value(record.get('rtt_avg' + str(ping_number)))
+
+                if loss is not None:
+                    losses.append(loss)
+                if rtt is not None:
+                    rtts.append(rtt)
+
+        if not losses and not rtts:
+            return
+
+        history = self.history['rtt']
+
+        # (the median of recent healthy RTTs is their usual level)
+        usual_rtt = sorted(history)[len(history) // 2] if history else None
+        rtt = sum(rtts) / len(rtts) if rtts else None
+
+        degraded = bool(losses) and max(losses) >= self.degraded_loss
+
+        if rtt is not None and usual_rtt and rtt > usual_rtt * self.degraded_rtt_factor:
+            degraded = True
+
+        if not degraded and rtt is not None:
+            history.append(rtt)
+            del history[:-self.history_size]
+
+        if degraded and not self.degraded:
+            # (results are unlikely to be stable while the link is degraded)
+            self.full_interval = self.interval
+            self.stable_count = 0
+
+        self.degraded = degraded
+
+def record_value(value):
+    '''
+    Numeric value of a result field - None if it is "NA" (or not numeric)
+    '''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
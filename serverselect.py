@@ -0,0 +1,182 @@
+'''
+Speedtest server selection with an on-disk cache. Finding the best server
+means downloading the full speedtest.net server list & latency testing the
+closest servers, so we only do that when our cached selection has expired
+or stops working.
+'''
+from __future__ import print_function
+
+# latency (ms) reported by speedtest-cli when none of a server's latency
+# probes got a response
+FAILED_LATENCY = 1800000.0
+
+def server_matches(server, server_name):
+    '''
+    Does a speedtest server match a configured server name? This may be
+    the server host name (with or without port) or its server id.
+    '''
+    host = server.get('host', '')
+
+    return server_name in (host, host.split(':')[0], str(server.get('id', '')))
+
+class ServerSelector(object):
+    '''
+    A class to pick the speedtest server for a test, using a cached selection
+    (plus a short latency ranked shortlist of alternatives) where we can.
+
+    If a server_name is configured, that server is always used. Otherwise
+    the fastest of the closest servers is used. Discovery is only re-run when
+    the cache is older than cache_ttl secs, the configured server_name
+    changes or the cached servers are not responding.
+    '''
+
+    def __init__(self, cache_file, logger, debug=False, cache_ttl=86400, shortlist_size=3):
+
+        self.cache_file = cache_file
+        self.logger = logger
+        self.debug = debug
+        self.cache_ttl = cache_ttl
+        self.shortlist_size = shortlist_size
+
+        self.cached_at = 0
+
+    def load_cache(self, server_name):
+        '''
+        Our cached server shortlist (fastest first) - empty if there is no
+        cache, it has expired, or it was for a different server_name
+        '''
+        import json
+        import time
+
+        if not self.cache_file:
+            return []
+
+        try:
+            with open(self.cache_file) as cache_file_obj:
+                cache = json.load(cache_file_obj)
+        except Exception as ex:
+            if self.debug:
+                print("No usable speedtest server cache: " + str(ex))
+            return []
+
+        if cache.get('server_name') != server_name or cache.get('cached_at', 0) + self.cache_ttl < time.time():
+            if self.debug:
+                print("Speedtest server cache is stale - servers will be re-discovered")
+            return []
+
+        self.cached_at = cache['cached_at']
+
+        return cache.get('shortlist', [])
+
+    def save_cache(self, server_name, shortlist, cached_at=None):
+
+        import json
+        import time
+
+        if not self.cache_file:
+            return False
+
+        if cached_at is None:
+            cached_at = int(time.time())
+
+        try:
+            with open(self.cache_file, 'w') as cache_file_obj:
+                json.dump({'server_name': server_name, 'cached_at': cached_at,
+                    'shortlist': shortlist}, cache_file_obj)
+        except Exception as ex:
+            self.logger.log_error("Error writing speedtest server cache: " + str(ex))
+            return False
+
+        return True
+
+    def invalidate(self):
+        '''
+        Throw away our cached servers (e.g. a test against them failed)
+        '''
+        import os
+
+        if self.cache_file and os.path.exists(self.cache_file):
+            try:
+                os.remove(self.cache_file)
+            except Exception as ex:
+                self.logger.log_error("Error removing speedtest server cache: " + str(ex))
+
+    def probe(self, st, servers):
+        '''
+        Latency test a list of servers, selecting the fastest one for the
+        test. Returns the selected server, or None if none responded.
+        '''
+        try:
+            best = st.get_best_server(servers)
+        except Exception as ex:
+            if self.debug:
+                print("Speedtest server latency test failed: " + str(ex))
+            return None
+
+        if best.get('latency', 0) >= FAILED_LATENCY:
+            return None
+
+        return best
+
+    def discover(self, st, server_name):
+        '''
+        Pull down the server list & build a latency ranked shortlist: the
+        configured server, or the closest servers
+        '''
+        st.get_servers()
+
+        candidates = []
+
+        if server_name:
+            for servers in st.servers.values():
+                candidates.extend([server for server in servers if server_matches(server, server_name)])
+
+            if not candidates:
+                self.logger.log_error("Configured speedtest server not found: " + server_name + " (using closest server)")
+
+        if not candidates:
+            candidates = st.get_closest_servers(max(self.shortlist_size, 5))
+
+        # rank candidates by latency (one at a time, so we know each latency)
+        shortlist = [server for server in candidates if self.probe(st, [server])]
+
+        shortlist.sort(key=lambda server: server['latency'])
+
+        return shortlist[:self.shortlist_size]
+
+    def select(self, st, server_name=""):
+        '''
+        Select the server for a speedtest object. Returns True if we have a
+        working server.
+        '''
+        shortlist = self.load_cache(server_name)
+
+        # try our cached first choice, then the rest of the shortlist
+        if shortlist:
+            best = self.probe(st, shortlist[:1])
+
+            if best is None and len(shortlist) > 1:
+                best = self.probe(st, shortlist[1:])
+
+                if best is not None:
+                    # move the server that answered to the top of the list
+                    shortlist = [best] + [server for server in shortlist if server['host'] != best['host']]
+                    self.save_cache(server_name, shortlist, self.cached_at)
+
+            if best is not None:
+                if self.debug:
+                    print("Using cached speedtest server: " + best['host'])
+                return True
+
+            self.logger.log_error("Cached speedtest servers not responding - re-discovering servers")
+
+        shortlist = self.discover(st, server_name)
+
+        if not shortlist:
+            self.invalidate()
+            return False
+
+        self.save_cache(server_name, shortlist)
+
+        # select the fastest (the last server probed may not be)
+        return self.probe(st, shortlist[:1]) is not None
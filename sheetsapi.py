@@ -0,0 +1,217 @@
+'''
+A shared wrapper for Google Sheets API calls. Every call made by the agent
+goes through one SheetsApi object, which:
+
+ - paces calls with a token bucket sized to the Sheets per-user quota
+ - retries rate limited (429) & transient server (5xx) errors with an
+   exponential backoff (with jitter) - writes are only retried if they
+   were rate limited, as a 5xx can come back after a write was applied
+ - keeps per-call latency & quota counters, which are saved to the local DB
+'''
+from __future__ import print_function
+
+# HTTP status codes worth retrying
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+# HTTP status codes worth retrying for calls that aren't idempotent (writes)
+# - a rate limited request was never applied
+WRITE_RETRY_STATUS_CODES = [429]
+
+def api_error_status(ex):
+    '''
+    HTTP status code of a failed Google API call (None if not known)
+    '''
+    response = getattr(ex, 'response', None)
+    return getattr(response, 'status_code', None)
+
+class TokenBucket(object):
+    '''
+    A thread-safe token bucket: tokens are added at "rate" per sec up to
+    "capacity" (the burst size) & each call takes one token, waiting for one
+    to become available if the bucket is empty
+    '''
+
+    def __init__(self, rate, capacity):
+
+        import threading
+        import time
+
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.last_update = time.time()
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+
+    def acquire(self):
+        '''
+        Take a token, waiting if needed. Returns the time spent waiting (secs)
+        '''
+        import time
+
+        waited = 0.0
+
+        while True:
+            with self.lock:
+                self.refill(time.time())
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+
+                wait_time = (1 - self.tokens) / self.rate
+
+            time.sleep(wait_time)
+            waited += wait_time
+
+class SheetsApi(object):
+    '''
+    A class to make rate limited, retried & measured Google Sheets API calls:
+
+        api.call('get_all_values', worksheet.get_all_values)
+
+    The name identifies the call in our counters. The last error is raised
+    if a call fails (after any retries). Calls that change the sheet are
+    made with idempotent=False:
+
+        api.call('values_append', spreadsheet.values_append, ..., idempotent=False)
+
+    so that they are only retried if rate limited - any other failure is
+    left to the caller (e.g. a result sink's outbox, which checks what made
+    it to the sheet before retrying).
+    '''
+
+    def __init__(self, logger, debug=False, requests_per_minute=60, burst=10,
+        max_retries=5, backoff_base=1.0, backoff_max=32.0):
+
+        import threading
+
+        self.logger = logger
+        self.debug = debug
+
+        self.bucket = TokenBucket(requests_per_minute / 60.0, burst)
+
+        self.max_retries = int(max_retries)
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+
+        # counters per call name (since last saved)
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def backoff_time(self, attempt):
+        '''
+        Time to wait before retry number "attempt" (1 = first retry):
+        exponential backoff with "full jitter", so that probes that failed
+        together don't all retry together
+        '''
+        import random
+
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def record(self, name, latency, wait_time, status=None, retried=False):
+        '''
+        Update the counters for a call attempt
+        '''
+        with self.stats_lock:
+            call_stats = self.stats.setdefault(name, {'calls': 0, 'errors': 0,
+                'retries': 0, 'throttled': 0, 'latency_total': 0.0,
+                'latency_max': 0.0, 'wait_total': 0.0})
+
+            call_stats['calls'] += 1
+            call_stats['latency_total'] += latency
+            call_stats['latency_max'] = max(call_stats['latency_max'], latency)
+            call_stats['wait_total'] += wait_time
+
+            if status is not None:
+                call_stats['errors'] += 1
+
+            if status == 429:
+                call_stats['throttled'] += 1
+
+            if retried:
+                call_stats['retries'] += 1
+
+    def call(self, name, func, *args, **kwargs):
+        '''
+        Make an API call (func(*args, **kwargs)) & return its result
+        '''
+        import time
+
+        retry_status_codes = RETRY_STATUS_CODES if kwargs.pop('idempotent', True) else WRITE_RETRY_STATUS_CODES
+
+        attempt = 0
+
+        while True:
+            wait_time = self.bucket.acquire()
+
+            if self.debug and wait_time > 0:
+                print("Sheets API: waited " + '%.2f' % wait_time + " secs for quota before " + name)
+
+            start_time = time.time()
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception as ex:
+                status = api_error_status(ex)
+
+                # anything we don't understand (e.g. DNS failure) is treated as
+                # a failed request too, so that its latency is counted
+                if status is None:
+                    status = 0
+
+                retry = status in retry_status_codes and attempt < self.max_retries
+
+                self.record(name, time.time() - start_time, wait_time, status, retry)
+
+                if not retry:
+                    raise
+
+                attempt += 1
+                backoff = self.backoff_time(attempt)
+
+                if self.debug:
+                    print("Sheets API: " + name + " failed (" + str(status) + "), retry " + str(attempt) + " in " + '%.2f' % backoff + " secs")
+
+                time.sleep(backoff)
+                continue
+
+            self.record(name, time.time() - start_time, wait_time)
+
+            return result
+
+    def save_stats(self, db_conn):
+        '''
+        Add our counters to the daily totals in the api_call_stats table &
+        reset them
+        '''
+        import datetime
+
+        with self.stats_lock:
+            stats = self.stats
+            self.stats = {}
+
+        if not stats:
+            return True
+
+        day = datetime.date.today().isoformat()
+
+        try:
+            with db_conn:
+                for (name, call_stats) in stats.items():
+                    db_conn.execute("insert or ignore into api_call_stats (day, call) values (?,?)", (day, name))
+                    db_conn.execute("""update api_call_stats set calls = calls + ?, errors = errors + ?,
+                        retries = retries + ?, throttled = throttled + ?, latency_total = latency_total + ?,
+                        latency_max = max(latency_max, ?), wait_total = wait_total + ? where day = ? and call = ?""",
+                        (call_stats['calls'], call_stats['errors'], call_stats['retries'],
+                        call_stats['throttled'], call_stats['latency_total'], call_stats['latency_max'],
+                        call_stats['wait_total'], day, name))
+        except Exception as ex:
+            self.logger.log_error("Db execute error when trying to save API call stats: " + str(ex))
+            return False
+
+        return True
@@ -6,14 +6,34 @@ from __future__ import print_function
 class SimpleLogger(object):
     '''
     A class to perform very simple logging to an Sqlite DB
+
+    In buffered mode, a single DB connection (in WAL mode) is kept open and
+    messages are held in memory, then written in a single transaction when
+    flush_size messages are waiting, flush_interval secs after the first
+    waiting message, or at exit. Use log_fatal() for messages that must hit
+    the DB straight away (e.g. just before calling sys.exit())
     '''
 
-    def __init__(self, db_file, debug=False):
+    def __init__(self, db_file, debug=False, buffered=False, flush_size=20, flush_interval=30):
 
+        import atexit
+        import threading
 
         self.db_file = db_file
         self.debug = debug
 
+        self.buffered = buffered
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        self.buffer = []
+        self.db_conn = None
+        self.flush_timer = None
+        self.cancelled_timer = None
+        self.lock = threading.RLock()
+
+        if self.buffered:
+            atexit.register(self.close)
 
     def log_error(self, err_msg):
         '''
@@ -32,6 +52,9 @@ class SimpleLogger(object):
         if self.debug:
             print("Error : " + err_msg)
 
+        if self.buffered:
+            return self.buffer_error(err_msg)
+
         try:
             db_conn = sqlite3.connect(self.db_file)
         except Exception as exception_msg:
@@ -61,3 +84,107 @@ class SimpleLogger(object):
             return None
 
         return None
+
+    def log_fatal(self, err_msg):
+        '''
+        Log an error & make sure it (and anything else waiting in the buffer)
+        is written to the DB before returning - for use before an exit
+        '''
+        self.log_error(err_msg)
+        self.flush()
+
+    def buffer_error(self, err_msg):
+        '''
+        Add an error message to our buffer, flushing if it is full or starting
+        the flush timer if this is the first message waiting
+        '''
+        import datetime
+        import threading
+        import time
+
+        with self.lock:
+            self.buffer.append((int(time.time()), datetime.datetime.now(), err_msg))
+
+            if len(self.buffer) >= self.flush_size:
+                self.flush()
+            elif self.flush_timer is None:
+                self.flush_timer = threading.Timer(self.flush_interval, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+        return None
+
+    def get_connection(self):
+        '''
+        Our long-lived DB connection for buffered mode (opened on first use)
+        '''
+        import sqlite3
+
+        if self.db_conn is None:
+            # the flush timer runs in its own thread, so share the connection
+            # between threads (access is serialized by our lock)
+            self.db_conn = sqlite3.connect(self.db_file, check_same_thread=False)
+            self.db_conn.execute("pragma journal_mode=wal")
+            self.db_conn.execute("pragma synchronous=normal")
+
+        return self.db_conn
+
+    def flush(self):
+        '''
+        Write all buffered messages to the DB in a single transaction
+        '''
+        from sys import stderr
+
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.cancelled_timer = self.flush_timer
+                self.flush_timer = None
+
+            if not self.buffer:
+                return None
+
+            try:
+                db_conn = self.get_connection()
+                with db_conn:
+                    db_conn.executemany("insert into error_logs (timestamp, \
+                    cleartext_date, error_msg) values (?,?,?)", self.buffer)
+            except Exception as exception_msg:
+                stderr.write("Error flushing log messages to DB: " + str(exception_msg))
+
+                # don't hold on to messages forever if the DB is unusable
+                if len(self.buffer) > self.flush_size * 10:
+                    self.buffer = []
+
+                return None
+
+            self.buffer = []
+
+        return None
+
+    def close(self):
+        '''
+        Flush any buffered messages & close our DB connection
+        '''
+        import threading
+        from sys import stderr
+
+        self.flush()
+
+        # let the last cancelled timer thread finish so it isn't left running
+        # while the interpreter shuts down
+        flush_timer = self.cancelled_timer
+
+        if flush_timer is not None and flush_timer is not threading.current_thread():
+            flush_timer.join()
+
+        with self.lock:
+            if self.db_conn is not None:
+                try:
+                    self.db_conn.close()
+                except Exception as exception_msg:
+                    stderr.write("Error closing DB: " + str(exception_msg))
+
+                self.db_conn = None
+
+        return None
@@ -0,0 +1,137 @@
+'''
+Bind test traffic to a network interface, so that tests from a probe with
+several interfaces (e.g. wlan0 & eth0) go out of the interface being tested
+rather than following the default route.
+
+Sockets are bound with SO_BINDTODEVICE where we are allowed to (root,
+CAP_NET_RAW, or any user from Linux 5.7), otherwise to the interface's
+address - which only changes the interface used if the probe has policy
+routing for it (or the interface has the default route).
+'''
+
+# from <asm-generic/socket.h>
+SO_BINDTODEVICE = 25
+
+def bind_socket(sock, if_name=None, source_addr=None):
+    '''
+    Bind a socket (before it connects/sends) to an interface, or its source
+    address if we can't bind to the interface itself. Returns how it was
+    bound: 'device', 'address' or None (not bound).
+    '''
+    import socket
+
+    if if_name:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, (if_name + '\0').encode('ascii'))
+            return 'device'
+        except (socket.error, OSError):
+            pass
+
+    if source_addr and source_addr != "NA":
+        sock.bind((source_addr, 0))
+        return 'address'
+
+    return None
+
+def can_bind_device(if_name):
+    '''
+    Are we allowed to bind sockets to an interface (SO_BINDTODEVICE)?
+    '''
+    import socket
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    try:
+        return bind_socket(sock, if_name) == 'device'
+    finally:
+        sock.close()
+
+def create_connection(address, timeout=None, source_address=None, if_name=None):
+    '''
+    socket.create_connection(), with the socket bound to an interface (see
+    bind_socket) before it connects. source_address is a (host, port) tuple
+    as for socket.create_connection().
+    '''
+    import socket
+
+    (host, port) = address
+    error = None
+
+    for (family, socktype, proto, canonname, sockaddr) in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+        sock = None
+
+        try:
+            sock = socket.socket(family, socktype, proto)
+
+            if timeout is not None and timeout is not getattr(socket, '_GLOBAL_DEFAULT_TIMEOUT', None):
+                sock.settimeout(timeout)
+
+            # (the interface's address is an IPv4 address)
+            bind_socket(sock, if_name, source_address[0] if source_address and family == socket.AF_INET else None)
+
+            sock.connect(sockaddr)
+            return sock
+
+        except socket.error as ex:
+            error = ex
+
+            if sock is not None:
+                sock.close()
+
+    if error is not None:
+        raise error
+
+    raise socket.error("getaddrinfo returned an empty list")
+
+class BoundSocketModule(object):
+    '''
+    Stands in for the socket module in a module that makes its connections
+    with socket.create_connection() (e.g. speedtest-cli), so that they are
+    bound to an interface
+    '''
+
+    def __init__(self, if_name, source_addr=None):
+
+        import socket
+
+        self._socket = socket
+        self.if_name = if_name
+        self.source_addr = source_addr
+
+    def __getattr__(self, name):
+        return getattr(self._socket, name)
+
+    def create_connection(self, address, timeout=None, source_address=None):
+
+        if source_address is None and self.source_addr:
+            source_address = (self.source_addr, 0)
+
+        return create_connection(address, timeout, source_address, self.if_name)
+
+def bound_module(module, if_name, source_addr=None):
+    '''
+    Context manager to bind the connections that a module makes to an
+    interface while it is in use (only one interface at a time - the module
+    is shared by all threads):
+
+        with bound_module(speedtest, 'eth0', '192.168.1.10'):
+            st.download()
+    '''
+    import contextlib
+
+    @contextlib.contextmanager
+    def bound():
+        saved_socket = getattr(module, 'socket', None)
+
+        if not if_name or saved_socket is None:
+            yield
+            return
+
+        module.socket = BoundSocketModule(if_name, source_addr)
+
+        try:
+            yield
+        finally:
+            module.socket = saved_socket
+
+    return bound()
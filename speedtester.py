@@ -6,25 +6,62 @@ import time
 import datetime
 import sqlite3
 import subprocess
-from socket import gethostbyname
+from socket import gethostbyname, gethostname
 import speedtest
 import os
 import re
 import sys
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
-import ConfigParser
+try:
+    import ConfigParser
+except ImportError:
+    import configparser as ConfigParser
 import csv
 import os.path
+import argparse
 
 # our modules...
 from wirelessadapter import *
 from gsheet import *
 from simplelogger import *
 from pinger import *
+from agentdaemon import *
+from dbmigrate import *
+from resultsinks import *
+from sheetsapi import *
+from serverselect import *
+from throughput import *
+from reflector import *
+from phasetimer import *
+from metricsexporter import *
+from telemetry import *
+from linkevents import *
+from sourcebind import *
+from scheduler import *
 
 DEBUG = 0
 
+# How tests are scheduled across our interfaces: each cycle tests the next
+# interface in turn (alternate), or all of them one after another
+# (sequential), or runs throughput tests on the next interface in turn but
+# ping tests on all of them at the same time (concurrent_ping)
+INTERFACE_SCHEDULES = ['alternate', 'sequential', 'concurrent_ping']
+
+# When running as a daemon, we keep our SQLite connections open between test
+# cycles rather than opening & closing them on every operation
+PERSISTENT_DB = False
+DB_CONNECTIONS = {}
+
+def config_get_default(config, section, option, default):
+    '''
+    Read an optional config file item, returning a default if it is missing
+    (e.g. an older config.ini that pre-dates the option)
+    '''
+    if config.has_option(section, option):
+        return config.get(section, option)
+    return default
+
 def read_config(debug):
     '''
     Read in the config file variables
@@ -39,8 +76,11 @@ def read_config(debug):
     # db file name
     config_vars['db_file'] = config.get('General', 'db_file')
 
-    # create logging object
-    logger = SimpleLogger(config_vars['db_file'], debug)
+    # create logging object (buffered logging keeps one DB connection open &
+    # writes messages in batches)
+    log_buffering = config_get_default(config, 'General', 'log_buffering', 'on')
+    logger = SimpleLogger(config_vars['db_file'], debug,
+        buffered=log_buffering.strip().lower() in ('on', 'yes', 'true', '1'))
 
     # Cache file name for local results that fail upload
     config_vars['cache_file'] = config.get('General', 'cache_file')
@@ -48,9 +88,47 @@ def read_config(debug):
     # Speedtest server
     config_vars['server_name'] =  config.get('Server', 'server_name')
 
+    # Throughput test: parallel streams (0 = speedtest.net default), time
+    # budget per direction (secs) & adaptive transfer sizes (on/off) - these
+    # can also be set from the Config sheet
+    config_vars['speedtest_streams'] = int(config_get_default(config, 'Speedtest', 'streams', 0))
+    config_vars['speedtest_time_budget'] = float(config_get_default(config, 'Speedtest', 'time_budget', 15))
+    config_vars['speedtest_adaptive'] = config_get_default(config, 'Speedtest', 'adaptive', 'on')
+    config_vars['speedtest_stable_pct'] = float(config_get_default(config, 'Speedtest', 'stable_pct', 10))
+    config_vars['speedtest_max_rounds'] = int(config_get_default(config, 'Speedtest', 'max_rounds', 4))
+
+    # LAN throughput tests against our own reflector server (see reflector.py):
+    # on/off, server address & port, TCP streams, test duration per test
+    # (secs), UDP target rate (Mbps) & packet size (bytes)
+    config_vars['reflector_enabled'] = config_get_default(config, 'Reflector', 'enabled', 'off').lower() in ['on', 'yes', 'true', '1']
+    config_vars['reflector_host'] = config_get_default(config, 'Reflector', 'host', '')
+    config_vars['reflector_port'] = int(config_get_default(config, 'Reflector', 'port', 5201))
+    config_vars['reflector_streams'] = int(config_get_default(config, 'Reflector', 'streams', 4))
+    config_vars['reflector_duration'] = float(config_get_default(config, 'Reflector', 'duration', 5))
+    config_vars['reflector_udp_rate'] = float(config_get_default(config, 'Reflector', 'udp_rate', 20))
+    config_vars['reflector_udp_packet_size'] = int(config_get_default(config, 'Reflector', 'udp_packet_size', 1200))
+
+    # Cache of the selected speedtest server (& shortlist of alternatives),
+    # how long it is kept (secs) & how many alternatives are kept
+    config_vars['server_cache_file'] = config_get_default(config, 'Server', 'cache_file', '')
+    config_vars['server_cache_ttl'] = int(config_get_default(config, 'Server', 'cache_ttl', 86400))
+    config_vars['server_shortlist_size'] = int(config_get_default(config, 'Server', 'shortlist_size', 3))
+
     # WLAN interface name
     config_vars['wlan_if'] = config.get('General', 'wlan_if')
 
+    # Interfaces to test from (comma separated list, defaults to the WLAN
+    # interface), how tests are scheduled across them (alternate, sequential
+    # or concurrent_ping) & whether test traffic is bound to the interface
+    # under test (auto = only if there is more than one interface, on/off)
+    config_vars['interfaces'] = [if_name.strip() for if_name in config_get_default(config, 'Interfaces', 'interfaces', '').split(',') if if_name.strip()] or [config_vars['wlan_if']]
+    config_vars['interface_schedule'] = config_get_default(config, 'Interfaces', 'schedule', 'alternate').strip().lower()
+    config_vars['interface_bind'] = config_get_default(config, 'Interfaces', 'bind', 'auto').strip().lower()
+
+    if config_vars['interface_schedule'] not in INTERFACE_SCHEDULES:
+        logger.log_error("Unknown interface schedule '" + config_vars['interface_schedule'] + "', using alternate")
+        config_vars['interface_schedule'] = 'alternate'
+
     # Get platform architecture
     config_vars['platform'] = config.get('General', 'platform')
     
@@ -70,95 +148,137 @@ def read_config(debug):
     # Google sheet config parameters
     config_vars['spreadsheet_name'] = config.get('General', 'spreadsheet_name')
     config_vars['json_keyfile'] = config.get('General', 'json_keyfile')
+
+    # Cache of Google token & spreadsheet details (blank to disable) & how long (secs) to trust it
+    config_vars['gsheet_cache_file'] = config_get_default(config, 'General', 'gsheet_cache_file', '')
+    config_vars['gsheet_cache_ttl'] = int(config_get_default(config, 'General', 'gsheet_cache_ttl', 3600))
+
+    # Adapter info backend: 'kernel' (read from /proc, sysfs & ioctls) or 'cli' (iwconfig etc.)
+    config_vars['adapter_backend'] = config_get_default(config, 'General', 'adapter_backend', 'kernel')
+
+    # Ping engine: 'auto' (ICMP socket, falling back to ping command), 'socket' or 'cli'
+    config_vars['ping_engine'] = config_get_default(config, 'General', 'ping_engine', 'auto')
+
+    # Outbox budget for results waiting for upload (0 = no limit) & max results
+    # to upload per cycle
+    config_vars['outbox_max_rows'] = int(config_get_default(config, 'Outbox', 'max_rows', 0))
+    config_vars['outbox_max_age_days'] = float(config_get_default(config, 'Outbox', 'max_age_days', 0))
+    config_vars['outbox_batch_size'] = int(config_get_default(config, 'Outbox', 'batch_size', 500))
+
+    # Google Sheets API call pacing (per-user quota) & retries of rate
+    # limited/failed calls
+    config_vars['api_requests_per_minute'] = int(config_get_default(config, 'GoogleApi', 'requests_per_minute', 60))
+    config_vars['api_burst'] = int(config_get_default(config, 'GoogleApi', 'burst', 10))
+    config_vars['api_max_retries'] = int(config_get_default(config, 'GoogleApi', 'max_retries', 5))
+    config_vars['api_backoff_max'] = float(config_get_default(config, 'GoogleApi', 'backoff_max', 32))
+
+    # Result sinks to send results to (comma separated list of: gsheet,
+    # sqlite, file, http) & how long to wait for them each cycle (secs)
+    config_vars['sinks'] = [name.strip() for name in config_get_default(config, 'Sinks', 'enabled', 'gsheet, sqlite').split(',') if name.strip()]
+    config_vars['sink_timeout'] = float(config_get_default(config, 'Sinks', 'timeout', 60))
+
+    config_vars['sink_file_path'] = config_get_default(config, 'Sinks', 'file_path', 'results.jsonl')
+    config_vars['sink_file_format'] = config_get_default(config, 'Sinks', 'file_format', 'jsonl')
+    config_vars['sink_file_max_bytes'] = int(config_get_default(config, 'Sinks', 'file_max_bytes', 1048576))
+    config_vars['sink_file_backups'] = int(config_get_default(config, 'Sinks', 'file_backups', 5))
+
+    config_vars['sink_http_url'] = config_get_default(config, 'Sinks', 'http_url', '')
+    config_vars['sink_http_timeout'] = float(config_get_default(config, 'Sinks', 'http_timeout', 10))
+
+    # retry backoff (secs) for failed deliveries - can be set per sink
+    # (e.g. http_retry_base)
+    retry_base = int(config_get_default(config, 'Sinks', 'retry_base', 60))
+    retry_max = int(config_get_default(config, 'Sinks', 'retry_max', 3600))
+
+    config_vars['sink_retry'] = {}
+
+    for sink_name in SINK_NAMES:
+        config_vars['sink_retry'][sink_name] = (
+            int(config_get_default(config, 'Sinks', sink_name + '_retry_base', retry_base)),
+            int(config_get_default(config, 'Sinks', sink_name + '_retry_max', retry_max)))
+
+    # Send cycle phase timings with each result (on/off) & how long (days)
+    # to keep them in the local DB
+    config_vars['phase_timing_upload'] = config_get_default(config, 'Timing', 'upload', 'off').lower() in ['on', 'yes', 'true', '1']
+    config_vars['phase_timing_keep_days'] = int(config_get_default(config, 'Timing', 'keep_days', 7))
+
+    # How long (days) hourly & daily result rollups are kept
+    config_vars['rollup_hourly_keep_days'] = int(config_get_default(config, 'Rollups', 'hourly_keep_days', 31))
+    config_vars['rollup_daily_keep_days'] = int(config_get_default(config, 'Rollups', 'daily_keep_days', 730))
+
+    # Wireless telemetry sampled during each cycle: on/off, samples per sec,
+    # keep every sample (on/off) & how long (days) to keep it in the local DB
+    config_vars['telemetry_enabled'] = config_get_default(config, 'Telemetry', 'enabled', 'off').lower() in ['on', 'yes', 'true', '1']
+    config_vars['telemetry_rate'] = float(config_get_default(config, 'Telemetry', 'rate', 10))
+    config_vars['telemetry_store_series'] = config_get_default(config, 'Telemetry', 'store_series', 'off').lower() in ['on', 'yes', 'true', '1']
+    config_vars['telemetry_keep_days'] = int(config_get_default(config, 'Telemetry', 'keep_days', 7))
+    config_vars['telemetry_replay_file'] = config_get_default(config, 'Telemetry', 'replay_file', '')
+
+    # Link event listener (daemon mode only): on/off, secs the connection must
+    # stay down before we recover it, minimum secs between recoveries & how
+    # long (days) to keep link events in the local DB
+    config_vars['events_enabled'] = config_get_default(config, 'Events', 'enabled', 'off').lower() in ['on', 'yes', 'true', '1']
+    config_vars['events_recovery_delay'] = float(config_get_default(config, 'Events', 'recovery_delay', 10))
+    config_vars['events_recovery_holdoff'] = float(config_get_default(config, 'Events', 'recovery_holdoff', 120))
+    config_vars['events_keep_days'] = int(config_get_default(config, 'Events', 'keep_days', 30))
+    config_vars['events_replay_file'] = config_get_default(config, 'Events', 'replay_file', '')
+
+    # Prometheus/OpenMetrics exporter of our latest results (daemon mode
+    # only): on/off, address & port to serve metrics on
+    config_vars['exporter_enabled'] = config_get_default(config, 'Exporter', 'enabled', 'off').lower() in ['on', 'yes', 'true', '1']
+    config_vars['exporter_bind'] = config_get_default(config, 'Exporter', 'bind', '')
+    config_vars['exporter_port'] = int(config_get_default(config, 'Exporter', 'port', 9110))
+
+    # Interval between test cycles when running in daemon mode (secs)
+    config_vars['daemon_interval'] = int(config_get_default(config, 'Daemon', 'interval', 300))
+
+    # Scheduling: spread of this probe's start offset (secs), run lock file &
+    # (daemon mode) adaptive intervals: on/off, longest interval between
+    # throughput tests (secs), how stable their results must be (% & runs in
+    # a row) to stretch it, ping-only cycle interval (secs) while ping loss (%)
+    # or RTT (x usual) is degraded
+    config_vars['schedule_jitter'] = float(config_get_default(config, 'Schedule', 'jitter', 0))
+    config_vars['schedule_lock_file'] = config_get_default(config, 'Schedule', 'lock_file', '')
+    config_vars['schedule_adaptive'] = config_get_default(config, 'Schedule', 'adaptive', 'off').lower() in ['on', 'yes', 'true', '1']
+    config_vars['schedule_max_interval'] = int(config_get_default(config, 'Schedule', 'max_interval', 3600))
+    config_vars['schedule_stable_pct'] = float(config_get_default(config, 'Schedule', 'stable_pct', 10))
+    config_vars['schedule_stable_runs'] = int(config_get_default(config, 'Schedule', 'stable_runs', 3))
+    config_vars['schedule_ping_interval'] = int(config_get_default(config, 'Schedule', 'ping_interval', 60))
+    config_vars['schedule_degraded_loss'] = float(config_get_default(config, 'Schedule', 'degraded_loss', 5))
+    config_vars['schedule_degraded_rtt'] = float(config_get_default(config, 'Schedule', 'degraded_rtt', 2))
     
     return (config_vars, logger)
 
-def dump_result_local_db(data_list, db_file, logger, debug):
-
+def db_connect(db_file):
     '''
-    We had issues saving data to our google sheet, so we'll dump_result_local_db in a local sqlite db and try again later
-    
-    Fields: timestamp, ping_time, download_rate, upload_rate, ssid, bssid, freq, bit_rate, signal_level, ip_address, location, speedtest_server
-    
+    Return a connection to our local SQLite DB. In daemon mode the connection
+    is kept open & shared across test cycles.
     '''
-  
-    # dump to sqlite DB
-    try:
-        db_conn = sqlite3.connect(db_file)
-    except Exception as error:
-        logger.log_error("Db connection error when trying to dump local results: " + error.message)
-    
-    # add data to db
-    try:
-        db_conn.execute("insert into cached_results (timestamp, ping_time, download_rate, upload_rate, ssid, bssid, freq, bit_rate, signal_level, ip_address, location, speedtest_server,ping_host1,pkts_tx1,percent_loss1,rtt_avg1,ping_host2,pkts_tx2,percent_loss2,rtt_avg2,ping_host3,pkts_tx3,percent_loss3,rtt_avg3) values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", data_list)
-        db_conn.commit()
-    except Exception as error:
-        logger.log_error("Db execute error when trying to dump local results: " + error.message)
-    
-    # Tidy up cache entries - keep only last 20
-    try:
-        db_conn.execute("delete from cached_results where id not in (select id from cached_results order by id desc limit 20)")
-        db_conn.commit()
-    except Exception as error:
-        logger.log_error("Db execute error when trying to delete older cached results: " + error.message)
-        
-    # close db connection
-    db_conn.close()
+    if not PERSISTENT_DB:
+        return sqlite3.connect(db_file)
 
+    if db_file not in DB_CONNECTIONS:
+        DB_CONNECTIONS[db_file] = sqlite3.connect(db_file)
 
-def push_cached_results(sheet, cache_file, db_file, logger, debug):
-    
+    return DB_CONNECTIONS[db_file]
+
+def db_release(db_conn):
     '''
-    Try and push cached results to gsheet - if we have lots of data to write, have to be careful not to over-run Google API and get throttled (cached results limited to 20 in dump_result_local_db)
-    
+    Finished with a DB connection - close it unless we are keeping it warm
+    for the next test cycle
     '''
-    
-    # give us dictionary results
-    db_conn = sqlite3.connect(db_file)
-    
-    cursor = db_conn.cursor()
-    
-    try:
-        cursor.execute("select timestamp, ping_time, download_rate, upload_rate, ssid, bssid, freq, bit_rate, signal_level, ip_address, location, speedtest_server,ping_host1,pkts_tx1,percent_loss1,rtt_avg1,ping_host2,pkts_tx2,percent_loss2,rtt_avg2,ping_host3,pkts_tx3,percent_loss3,rtt_avg3 from cached_results")
-        if debug:
-            print("Checking to see if we have cached data to send to google sheet...")
-    except Exception as error:
-        logger.log_error("Db execute error when trying to select cached data: " + error.message)        
-    
-    # retrieve all cached data from db
-    cached_data = cursor.fetchall()
-    
-    # clear the cache table
-    try:
-        db_conn.execute("delete from cached_results")
-        db_conn.commit()
-    except Exception as error:
-        logger.log_error("Db execute error when trying to delete old cached data: " + error.message)
-    
-    # step through results & upload to sheet
-    for sheet_row_data in cached_data:
-        
-        if debug:
-            print("cached data row: ")
-            print(sheet_row_data)
-            
-        append_result = sheet.append_row(sheet_row_data)
-        
-        if debug:
-            print("Result of spreadsheet append operation from cache: " + str(append_result))
-        
-        if type(append_result) is not dict:     
-            logger.log_error("Append operation from cache appears to have failed (should be dict: " + str(append_result))
-            return False
-    
-    # close db connection
-    db_conn.close()
+    if not PERSISTENT_DB:
+        db_conn.close()
 
-    # all must have been OK, return True
-    return True
- 
+def db_close_all():
+    '''
+    Close any persistent DB connections (daemon shutdown)
+    '''
+    for db_file in list(DB_CONNECTIONS.keys()):
+        DB_CONNECTIONS.pop(db_file).close()
 
-def ooklaspeedtest(server_name=""):
+def ooklaspeedtest(server_name="", logger=None, agent_state=None, server_selector=None, throughput_tester=None, timer=None,
+    interface=None, source_addr=None, phase_interface=None):
 
     '''
     This function runs the actual speedtest and returns the result
@@ -203,34 +323,88 @@ def ooklaspeedtest(server_name=""):
                        'name': 'Dunedin',
                        'sponsor': 'Unifone NZ LTD',
                        'url': 'http://speedtest.unifone.net.nz/speedtest/upload.php'}]
-    '''
 
-    import sys
+    The server used is picked by server_selector (a ServerSelector), which
+    uses the configured server_name if there is one & caches its choice so
+    that the server list isn't downloaded on every run.
+
+    Download & upload rates are measured by throughput_tester (a
+    ThroughputTester) if supplied, otherwise with speedtest-cli defaults.
+
+    Server selection, download & upload are timed as phases of timer (a
+    PhaseTimer) if supplied - for phase_interface, if supplied.
+
+    All test traffic is sent out of interface (with source_addr, its
+    address) if supplied, rather than following the default route.
+
+    Returns False if the test failed (the error is logged).
+    '''
     
-    # perform Speedtest
-    st = speedtest.Speedtest()
-    st.get_best_server()
+    if agent_state is None:
+        agent_state = {}
+
+    if timer is None:
+        timer = PhaseTimer(DEBUG)
+
+    # perform Speedtest (taken out of the agent state while in use, so that a
+    # failed test doesn't leave us re-using a broken server next time)
+    st = agent_state.pop('speedtester', None)
+
+    # (a warm Speedtest object from the last cycle in daemon mode just has its
+    # server re-checked, rather than pulling down the whole server list again)
+    try:
+        with timer.phase('server_select', phase_interface), bound_module(speedtest, interface, source_addr):
+            if st is None:
+                if source_addr:
+                    st = speedtest.Speedtest(source_address=source_addr)
+                else:
+                    st = speedtest.Speedtest()
+
+            if server_selector is None:
+                st.get_best_server()
+            elif not server_selector.select(st, server_name):
+                logger.log_error("Unable to find a working speedtest server")
+                return False
+    except Exception as error:
+        logger.log_error("Speedtest server selection error: " + str(error))
+        return False
     
     try:
-        download_rate = '%.2f' % (st.download()/1024000)
+        with timer.phase('download', phase_interface), bound_module(speedtest, interface, source_addr):
+            if throughput_tester is None:
+                download_rate = '%.2f' % (st.download()/1024000)
+            else:
+                download_rate = '%.2f' % (throughput_tester.download(st)/1024000)
         
         if DEBUG:
             print("Download rate = " + str(download_rate) + " Mbps")
     except Exception as error:
-        logger.log_error("Download test error: " + error.message)
-        sys.exit()
+        # re-discover servers next time, in case it is our server at fault
+        if server_selector is not None:
+            server_selector.invalidate()
+        logger.log_error("Download test error: " + str(error))
+        return False
     
     try:
-        upload_rate = '%.2f' % (st.upload(pre_allocate=False)/1024000)
+        with timer.phase('upload', phase_interface), bound_module(speedtest, interface, source_addr):
+            if throughput_tester is None:
+                upload_rate = '%.2f' % (st.upload(pre_allocate=False)/1024000)
+            else:
+                upload_rate = '%.2f' % (throughput_tester.upload(st)/1024000)
         if DEBUG:
             print("Upload rate = " + str(upload_rate) + " Mbps")
     except Exception as error:
-        logger.log_error("Upload test error: " + error.message)
-        sys.exit()
+        if server_selector is not None:
+            server_selector.invalidate()
+        logger.log_error("Upload test error: " + str(error))
+        return False
 
     results_dict = st.results.dict()
     ping_time = int(results_dict['ping'])
     server_name = results_dict['server']['host']
+
+    # all good - keep Speedtest object for next time
+    agent_state['speedtester'] = st
     
     return {'ping_time': ping_time, 'download_rate': download_rate, 'upload_rate': upload_rate, 'server_name': server_name}
 
@@ -266,19 +440,46 @@ def check_config_updates(gsheet, worksheet_titles, config_vars):
         return False
         
     # read all values in to list of lists: [ [col1-row1, col2-row1], [col1-row2, col2-row2] 
-    rows = sheet.get_all_values()
+    try:
+        rows = gsheet.api.call('get_all_values', sheet.get_all_values)
+    except Exception as ex:
+        gsheet.handle_api_error(ex)
+        gsheet.logger_obj.log_error("Error reading config sheet: " + str(ex))
+        return False
     
     if DEBUG:
         print(rows)
     
-    allowed_fields = ['server_name', 'location', 'ping_1', 'ping_2', 'ping_3']
+    allowed_fields = ['server_name', 'location', 'ping_1', 'ping_2', 'ping_3',
+        'speedtest_streams', 'speedtest_time_budget', 'speedtest_adaptive']
+    
+    # fields that must be numbers: (type they are used as, check of the value
+    # range) - not applied if they aren't
+    numeric_fields = {
+        'speedtest_streams': (int, lambda value: value >= 0),
+        'speedtest_time_budget': (float, lambda value: value > 0),
+    }
     
     # Convert List of lists in to dictionary
     for row in rows:
         [section, parameter] = row[0].split(":")
+
+        value = row[1]
+        
+        if parameter in numeric_fields:
+            (converter, in_range) = numeric_fields[parameter]
+
+            try:
+                value = converter(value)
+            except ValueError:
+                value = None
+
+            if value is None or not in_range(value):
+                gsheet.logger_obj.log_error("Ignoring invalid Config sheet value for " + parameter + ": " + str(row[1]))
+                continue
         
         if parameter in allowed_fields:
-            config_vars[parameter]= row[1]
+            config_vars[parameter]= value
     
     if DEBUG:
         print(config_vars)
@@ -288,7 +489,10 @@ def check_config_updates(gsheet, worksheet_titles, config_vars):
 def update_console(gsheet, worksheet_titles, db_file, logger, DEBUG):
 
     '''
-    If we have any error messages, send them to the console sheet
+    If we have any error messages, send them to the console sheet. Only the
+    newest max_rows messages are sent (older ones would just be trimmed off
+    again), in one append, & the console is trimmed back to max_rows with a
+    single range delete.
       
     '''
     # max number of rows allowed in console
@@ -298,166 +502,602 @@ def update_console(gsheet, worksheet_titles, db_file, logger, DEBUG):
     if DEBUG:
             print("Checking if we have a console sheet...")
     
-    # FIXME: Only open sheet if we have error messages to send
     # Do we have a config sheet?
     if "Console" not in worksheet_titles:
         if DEBUG:
             print("No console sheet found - no logs will be reported")
         return False
     
-    if DEBUG:
-        print("Looks like we have a console sheet - attemping to open")
-    
-    # read config sheet
-    sheet = gsheet.open_gspread_worksheet("Console")
-    
-    if sheet == False:
-        return False
-    
     # read latest error logs from probe
-    db_conn = sqlite3.connect(db_file)
+    db_conn = db_connect(db_file)
     
     cursor = db_conn.cursor()
     
     try:
-        cursor.execute("select cleartext_date, error_msg from error_logs")
+        cursor.execute("select id, cleartext_date, error_msg from error_logs order by id desc limit ?", (max_rows,))
         if DEBUG:
             print("Checking to see if we have error logs to send to console sheet...")
     except Exception as error:
         print("Db execute error when trying to select error logs: " + error.message)
-        #logger.log_error("Db execute error when trying to select error logs: " + error.message)
-        #FIXME: Any point in carrying on here ? Should exit or return as wasting our time here...
+        db_release(db_conn)
+        return False
     
-    # retrieve all cached data from db
+    # retrieve the cached data from db (oldest first)
     error_log_data = cursor.fetchall()
+    error_log_data.reverse()
+
+    # Only open sheet if we have error messages to send
+    if not error_log_data:
+        if DEBUG:
+            print("No error logs to send to console sheet")
+        db_release(db_conn)
+        return True
+    
+    if DEBUG:
+        print("Looks like we have a console sheet - attemping to open")
     
-    # clear the log table
+    # read config sheet
+    sheet = gsheet.open_gspread_worksheet("Console")
+    
+    if sheet == False:
+        db_release(db_conn)
+        return False
+
+    error_log_ids = [row[0] for row in error_log_data]
+    error_log_rows = [row[1:] for row in error_log_data]
+
+    # upload to sheet in one batch
+    append_results = gsheet.append_rows(sheet, error_log_rows, chunk_size=max_rows)
+
+    if not all(append_results):
+        db_release(db_conn)
+        return False
+
+    # all sent - clear the log entries we sent (& any older ones we skipped)
     try:
-        db_conn.execute("delete from error_logs")
+        db_conn.execute("delete from error_logs where id <= ?", (max(error_log_ids),))
         db_conn.commit()
     except Exception as error:
         logger.log_error("Db execute error when trying to delete old error log data: " + error.message)
-        #FIXME: Any point in carrying on here ? Should exit or return as wasting our time here...
+
+    # close db connection
+    db_release(db_conn)
+
+    # find the last row of the console sheet from the range updated by our
+    # last append (e.g. Console!A51:B60)
+    updated_range = append_results[-1]['updates']['updatedRange']
     
-    last_row_number = 0
+    row_number_re = re.search('.*?\!A(\d+)(?:\:[A-Z]+(\d+))?', updated_range)
     
-    # step through results & upload to sheet
-    for sheet_row_data in error_log_data:
-        
-        if DEBUG:
-            print("cached data row: ")
-            print(sheet_row_data)
-            
-        append_result = sheet.append_row(sheet_row_data)
-        
-        if DEBUG:
-            print("Result of spreadsheet append operation from error log: " + str(append_result))
-        
-        if type(append_result) is not dict:     
-            logger.log_error("Append operation from error log appears to have failed (should be dict: " + str(append_result))
-            return False
+    last_row_number = 0
 
-        updated_range = append_result['updates']['updatedRange']
-        
-        row_number_re = re.search('.*?\!A(\d+)', updated_range)
-        
-        if row_number_re is None:
-            logger.log_error("Unable to extract last row number in error sheet")
-        else:
-            last_row_number = int(row_number_re.group(1))
-        
-        if DEBUG:
-            print("Last console sheet row: " + str(last_row_number))
+    if row_number_re is None:
+        logger.log_error("Unable to extract last row number in error sheet")
+    else:
+        last_row_number = int(row_number_re.group(2) or row_number_re.group(1))
+    
+    if DEBUG:
+        print("Last console sheet row: " + str(last_row_number))
             
     if last_row_number > max_rows:
-        # we need to do something here to remove rows in console sheet
-        
-        for i in range(last_row_number - max_rows):
-            sheet.delete_row(1)
-    
-    # close db connection
-    db_conn.close()
+        # remove oldest rows in console sheet
+        return gsheet.trim_worksheet_rows(sheet, last_row_number - max_rows)
 
     # all must have been OK, return True
     return True
 
+def check_ping_host(ping_host, adapter, logger):
+    '''
+    Clean up & sanity check a ping host entry from our config. Returns the
+    host to ping (with the "def.gw" keyword resolved to the default gateway)
+    or False if no valid host is configured.
+    '''
+
+    # Clean up the content to get rid of whitespace
+    ping_host = ping_host.strip()
+
+    # if not in correct format, make false & register error
+    if ping_host == '':
+        # blank entry ignore
+        return False
+    elif not re.match(r"\S+\.\S+", ping_host):
+        logger.log_error("Error with ping host format: \'" + str(ping_host) + "\'")
+        logger.log_error("Ping host must be IP address of resolvable hostname")
+        return False
+
+    # check for def.gw keyword
+    if ping_host == "def.gw":
+        ping_host = adapter.get_def_gw()
+
+    return ping_host
+
+def ping_test(ping_host, platform, engine, debug, interface=None, source_addr=None):
+    '''
+    Run a single ping test (initial ARP warm-up ping followed by the test
+    itself) & return the result from Pinger.ping_host
+    '''
+    ping_obj = Pinger(platform = platform, debug = debug, engine = engine,
+        interface = interface, source_addr = source_addr)
+
+    # initial ping to clear out arp
+    ping_obj.ping_host(ping_host, 1)
+
+    # ping test
+    return ping_obj.ping_host(ping_host, 10)
+
+def run_ping_tests(config_vars, adapter, platform, logger, debug, bind=False):
+    '''
+    Run the configured ping tests (ping_1, ping_2, ping_3). Each test runs in
+    its own thread, so the ping phase only takes as long as the slowest target.
+    If bind is set, pings are sent out of the adapter's interface.
+
+    Results are returned as a dictionary with numbered fields for each ping
+    test (e.g. ping_host1, pkts_tx1...) - fields are "NA" if a test was not
+    configured or failed.
+    '''
+    import threading
+
+    ping_fields = ['host', 'pkts_tx', 'pkts_rx', 'pkt_loss', 'test_time',
+        'rtt_min', 'rtt_avg', 'rtt_max', 'rtt_mdev']
+
+    # results field names (numbered per ping test) for each ping result item
+    result_field_names = {'host': 'ping_host', 'pkt_loss': 'percent_loss'}
+
+    results_dict = {}
+    ping_results = {}
+    threads = []
+
+    for ping_number in range(1, 4):
+
+        # pre-fill results with NA in case test not defined or fails
+        for field in ping_fields:
+            results_dict[result_field_names.get(field, field) + str(ping_number)] = "NA"
+
+        config_key = 'ping_' + str(ping_number)
+
+        if config_key not in config_vars.keys():
+            continue
+
+        ping_host = check_ping_host(config_vars[config_key], adapter, logger)
+
+        if not ping_host:
+            continue
+
+        def ping_worker(ping_number=ping_number, ping_host=ping_host):
+            ping_results[ping_number] = ping_test(ping_host, platform, config_vars['ping_engine'], debug,
+                adapter.wlan_if_name if bind else None, adapter.get_ipaddr() if bind else None)
+
+        thread = threading.Thread(target=ping_worker)
+        thread.start()
+        threads.append(thread)
+
+    # wait for all ping tests to complete
+    for thread in threads:
+        thread.join()
+
+    for ping_number in sorted(ping_results.keys()):
+
+        ping_result = ping_results[ping_number]
+
+        if ping_result:
+            for field in ping_fields:
+                results_dict[result_field_names.get(field, field) + str(ping_number)] = ping_result[field]
+
+        if debug:
+            print("Main: Ping" + str(ping_number) + " test results:")
+            print(ping_result)
+
+    return results_dict
+
+def bounce_error(adapter, logger, error_msg, debug=False):
+    '''
+    Log an error before bouncing the wlan interface, as we have an unrecoverable error with its network connection
+    '''
+    logger.log_fatal(error_msg)
+    adapter.bounce_wlan_interface()
+
+    return False
+
 def bounce_error_exit(adapter, logger, error_msg, debug=False): 
     '''
     Log an error before bouncing the wlan interface and then exiting as we have an unrecoverable error with the network connection
     '''
     import sys
     
-    logger.log_error(error_msg)
-    adapter.bounce_wlan_interface()
-    logger.log_error("Exiting...")
+    bounce_error(adapter, logger, error_msg, debug)
+    logger.log_fatal("Exiting...")
     sys.exit()   
     
-###############################################################################
-# Main
-###############################################################################
-    
-def main():
+def schedule_interfaces(config_vars, agent_state):
+    '''
+    Pick the interfaces to test from this cycle (see INTERFACE_SCHEDULES).
+    Returns (interfaces to run throughput tests from, interfaces to run ping
+    tests from) - every interface tested runs the ping tests.
+    '''
+    interfaces = config_vars['interfaces']
+    schedule = config_vars['interface_schedule']
 
-    # read in our local config file (content in dictionary: config_vars)
-    
-    (config_vars, logger) = read_config(DEBUG)
-    
-    wlan_if = config_vars['wlan_if']
-    platform = config_vars['platform']
-    json_keyfile = config_vars['json_keyfile']
-    spreadsheet_name = config_vars['spreadsheet_name']
-    cache_file = config_vars['cache_file']
-    db_file = config_vars['db_file']
-    
-    now = datetime.datetime.now()
-    current_timestamp = now.strftime("%Y-%m-%d %H:%M")
-        
-    # get wireless info
-    adapter = WirelessAdapter(wlan_if, logger, platform=platform, debug=DEBUG)   
+    if schedule == 'sequential' or len(interfaces) == 1:
+        return (interfaces, interfaces)
+
+    # (the daemon takes turns by cycle, one-shot runs from cron by the clock)
+    turn = agent_state.get('interface_turn')
+
+    if turn is None:
+        turn = int(time.time() // config_vars['daemon_interval'])
+
+    agent_state['interface_turn'] = turn + 1
+
+    current = [interfaces[turn % len(interfaces)]]
+
+    if schedule == 'concurrent_ping':
+        return (current, interfaces)
+
+    return (current, current)
+
+def check_interface(if_name, config_vars, logger):
+    '''
+    Check that an interface is ready to test from: a wireless interface must
+    be associated, with an IP address & default route (it is bounced if not),
+    any other interface just needs an IP address. Returns the interface's
+    WirelessAdapter, or False if it isn't ready.
+    '''
+    adapter = WirelessAdapter(if_name, logger, platform=config_vars['platform'], debug=DEBUG, backend=config_vars['adapter_backend'])
+
+    try:
+        wireless = if_name == config_vars['wlan_if'] or adapter.netinfo.is_wireless()
+    except (IOError, OSError):
+        wireless = False
+
+    if not wireless:
+        # (no wireless details for a wired interface)
+        adapter.ssid = adapter.bssid = adapter.freq = adapter.bit_rate = adapter.signal_level = "NA"
+
+        if adapter.get_adapter_ip() == False or adapter.get_ipaddr() == 'NA':
+            logger.log_error("Unable to test from " + if_name + ": no valid IP address")
+            return False
+
+        # (only needed for a "def.gw" ping target - wired interfaces often
+        # have no default route)
+        if "def.gw" in [config_vars.get('ping_' + str(ping_number), '').strip() for ping_number in range(1, 4)]:
+            adapter.get_route_info()
+
+        return adapter
 
     # if we have no network connection (i.e. no bssid), no point in proceeding...
     if adapter.get_wireless_info() == False:
         error_msg = "Unable to get wireless info due to failure with ifconfig command"
-        bounce_error_exit(adapter, logger, error_msg, DEBUG) # exit here
-        
+        return bounce_error(adapter, logger, error_msg, DEBUG)
+
     if adapter.get_bssid() == 'NA':
         error_msg = "Problem with wireless connection: not associated to network"
         error_msg = error_msg + "Attempting to recover by bouncing wireless interface..."
-        bounce_error_exit(adapter, logger, error_msg, DEBUG) # exit here
-    
+        return bounce_error(adapter, logger, error_msg, DEBUG)
+
     # if we have no IP address, no point in proceeding...
     if adapter.get_adapter_ip() == False:
         error_msg = "Unable to get wireless adapter IP info"
-        bounce_error_exit(adapter, logger, error_msg, DEBUG) # exit here
-    
+        return bounce_error(adapter, logger, error_msg, DEBUG)
+
     if adapter.get_route_info() == False:
         error_msg = "Unable to get wireless adapter route info"
-        bounce_error_exit(adapter, logger, error_msg, DEBUG) # exit here
-    
+        return bounce_error(adapter, logger, error_msg, DEBUG)
+
     if adapter.get_ipaddr() == 'NA':
         error_msg = "Problem with wireless connection: no valid IP address"
         error_msg = error_msg + "Attempting to recover by bouncing wireless interface..."
-        bounce_error_exit(adapter, logger, error_msg, DEBUG) # exit here
+        return bounce_error(adapter, logger, error_msg, DEBUG)
+
+    return adapter
+
+def interface_details(adapter):
+    '''
+    The result fields describing an interface (speedtest results are "NA"
+    until they have run)
+    '''
+    return {
+        'ping_time': "NA",
+        'download_rate': "NA",
+        'upload_rate': "NA",
+        'server_name': "NA",
+        'ssid': adapter.get_ssid(),
+        'bssid': adapter.get_bssid(),
+        'freq': adapter.get_freq(),
+        'bit_rate': adapter.get_bit_rate(),
+        'signal_level': adapter.get_signal_level(),
+        'ip_addr': adapter.get_ipaddr()
+    }
+
+def run_throughput_tests(config_vars, logger, agent_state, timer, adapter, bind, server_name):
+    '''
+    Run the speedtest (& reflector tests, if we have a reflector) from an
+    interface. Returns the results as a dictionary (without speedtest results
+    if the speedtest failed, so that they stay "NA" & the other interfaces
+    still get tested). Test traffic is sent out of the interface if bind is
+    set.
+
+    Each interface keeps its own warm Speedtest object & transfer size hints
+    in agent_state (its throughput may be quite different to the others').
+    '''
+    if_name = adapter.wlan_if_name
+    if_state = agent_state.setdefault('interface_state', {}).setdefault(if_name, {})
+
+    interface = if_name if bind else None
+    source_addr = adapter.get_ipaddr() if bind else None
+
+    # (with several interfaces, each is timed separately)
+    phase_interface = if_name if len(config_vars['interfaces']) > 1 else None
+
+    # run speedtest (against the configured server if there is one,
+    # otherwise the best nearby server)
+    server_selector = ServerSelector(config_vars['server_cache_file'], logger, DEBUG,
+        config_vars['server_cache_ttl'], config_vars['server_shortlist_size'])
+
+    throughput_tester = ThroughputTester(logger, DEBUG, int(config_vars['speedtest_streams']),
+        float(config_vars['speedtest_time_budget']), config_vars['speedtest_adaptive'].lower() in ['on', 'yes', 'true', '1'],
+        float(config_vars['speedtest_stable_pct']), int(config_vars['speedtest_max_rounds']),
+        if_state.setdefault('throughput_size_hints', {}))
+
+    speedtest_results = ooklaspeedtest(server_name, logger, if_state, server_selector, throughput_tester, timer,
+        interface, source_addr, phase_interface)
     
-    # final connectivity check: see if we can resolve an address 
-    # (network connection and DNS must be up)
-    try:
-        gethostbyname('oauth2.googleapis.com')
-    except Exception as ex:
-        error_msg_msg = "DNS seems to be failing, bouncing wireless interface..."
-        bounce_error_exit(adapter, logger, error_msg, DEBUG) # exit here
-        
+    if DEBUG:
+        print("Main: Speedtest results (" + if_name + "):")
+        print(speedtest_results)
+    
+    results_dict = {}
+    
+    # speedtest results
+    if speedtest_results:
+        results_dict['ping_time'] = speedtest_results['ping_time']
+        results_dict['download_rate'] = speedtest_results['download_rate']
+        results_dict['upload_rate'] = speedtest_results['upload_rate']
+        results_dict['server_name'] = speedtest_results['server_name']
+    
+    # run LAN throughput tests against our own reflector (if we have one)
+    if config_vars['reflector_enabled'] and config_vars['reflector_host']:
+        with timer.phase('reflector', phase_interface):
+            reflector_client = ReflectorClient(config_vars['reflector_host'], config_vars['reflector_port'],
+                logger, DEBUG, config_vars['reflector_streams'], config_vars['reflector_duration'],
+                config_vars['reflector_udp_rate'], config_vars['reflector_udp_packet_size'],
+                interface=interface, source_addr=source_addr)
+
+            results_dict.update(reflector_client.run())
+
+    return results_dict
+
+def run_concurrent(calls):
+    '''
+    Run functions at the same time, each in its own thread: calls is a
+    dictionary of {name: (function, args)}. Returns {name: return value}
+    (names whose function failed are left out).
+    '''
+    import threading
+
+    results = {}
+    threads = []
+
+    for (name, (func, args)) in calls.items():
+
+        def worker(name=name, func=func, args=args):
+            results[name] = func(*args)
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    return results
+
+###############################################################################
+# Test cycle
+###############################################################################
     
-    # create our Google sheets object
+def save_phase_timings(timer, config_vars, logger):
+
+    '''
+    Store the phase timings of a test cycle in the local DB (dropping any
+    older than phase_timing_keep_days) & show them in the debug output
+    '''
+
+    if DEBUG:
+        timer.report()
+
+    db_conn = db_connect(config_vars['db_file'])
+
+    if timer.save(db_conn, logger):
+        db_conn.execute("delete from cycle_phases where cycle_start <= cast(strftime('%s', date('now', ?)) as integer)",
+            ('-' + str(config_vars['phase_timing_keep_days']) + ' days',))
+        db_conn.commit()
+
+    db_release(db_conn)
+
+def start_telemetry(config_vars, logger, agent_state):
+
+    '''
+    Start sampling wireless telemetry in the background (if required) - the
+    sampler is kept in agent_state until stop_telemetry()
+    '''
+
+    if not config_vars['telemetry_enabled']:
+        return
+
+    from kernelnetinfo import KernelNetInfo
+
+    # (replayed readings are for testing off-device)
     try:
-        gsheet = Gsheet(json_keyfile, spreadsheet_name, logger, DEBUG)
+        if config_vars['telemetry_replay_file']:
+            source = ReplayReadingSource(config_vars['telemetry_replay_file'])
+        else:
+            source = KernelReadingSource(KernelNetInfo(config_vars['wlan_if'], debug=DEBUG))
     except Exception as ex:
-        logger.log_error("Error opening Google spreadsheet: " + str(ex))
-        gsheet = False
+        logger.log_error("Unable to start telemetry sampling: " + str(ex))
+        return
+
+    sampler = TelemetrySampler(source, config_vars['telemetry_rate'], logger, DEBUG)
+
+    sampler.start()
+
+    agent_state['telemetry_sampler'] = sampler
+
+def stop_telemetry(config_vars, logger, agent_state, cycle_start):
+
+    '''
+    Stop sampling wireless telemetry (if we are) & store a summary of the
+    samples in the local DB, dropping any older than telemetry_keep_days
+    '''
+
+    sampler = agent_state.pop('telemetry_sampler', None)
+
+    if sampler is None:
+        return
+
+    sampler.stop()
+
+    if DEBUG:
+        print("Telemetry: " + str(sampler.sample_count()) + " samples: " + str(sampler.summary()))
+
+    db_conn = db_connect(config_vars['db_file'])
+
+    if sampler.save(db_conn, cycle_start, config_vars['telemetry_store_series']):
+        db_conn.execute("delete from telemetry_runs where cycle_start <= cast(strftime('%s', date('now', ?)) as integer)",
+            ('-' + str(config_vars['telemetry_keep_days']) + ' days',))
+        db_conn.commit()
+
+    db_release(db_conn)
+
+def run_cycle(config_vars, logger, agent_state=None, kind='full'):
+
+    '''
+    Run a single test cycle: check the wireless connection, run the speedtest
+    & ping tests and post the results. A 'ping' cycle (see CYCLE_KINDS) just
+    runs the ping tests, from all of our interfaces. Returns the results.
+
+    agent_state is a dictionary of objects (Google sheet, Speedtest) that the
+    daemon keeps warm between cycles. A one-shot run just uses an empty one.
+
+    Each phase of the cycle is timed & the timings saved to the local DB,
+    even if the cycle is cut short by an error.
+    '''
+
+    if agent_state is None:
+        agent_state = {}
+
+    timer = PhaseTimer(DEBUG)
+
+    try:
+        return run_cycle_phases(config_vars, logger, agent_state, timer, kind)
+    finally:
+        # (if the cycle was cut short, the telemetry sampler is still running -
+        # what it has sampled so far may help show why)
+        stop_telemetry(config_vars, logger, agent_state, timer.started_at)
+
+        save_phase_timings(timer, config_vars, logger)
+
+        # refresh our exported metrics (if we are exporting)
+        exporter = agent_state.get('exporter')
+
+        if exporter:
+            db_conn = db_connect(config_vars['db_file'])
+            exporter.update_cycle(db_conn, timer.durations())
+            db_release(db_conn)
+
+def run_cycle_phases(config_vars, logger, agent_state, timer, kind='full'):
+
+    '''
+    The phases of a test cycle (see run_cycle), each timed with timer
+    '''
+
+    wlan_if = config_vars['wlan_if']
+    platform = config_vars['platform']
+    json_keyfile = config_vars['json_keyfile']
+    spreadsheet_name = config_vars['spreadsheet_name']
+    cache_file = config_vars['cache_file']
+    db_file = config_vars['db_file']
     
-    # modify config parameters based on config worksheet items (if exists)
-    if gsheet:
-        config_vars = check_config_updates(gsheet, gsheet.get_worksheet_titles(), config_vars)
+    now = datetime.datetime.now()
+    current_timestamp = now.strftime("%Y-%m-%d %H:%M")
+        
+    # interfaces to run throughput tests & ping tests from this cycle
+    if kind == 'ping':
+        (throughput_ifs, ping_ifs) = ([], config_vars['interfaces'])
+    else:
+        (throughput_ifs, ping_ifs) = schedule_interfaces(config_vars, agent_state)
+
+    with timer.phase('adapter'):
+        # check each interface is ready to test from (a wireless interface that
+        # isn't is bounced)
+        adapters = {}
+
+        for if_name in ping_ifs:
+            adapter = check_interface(if_name, config_vars, logger)
+
+            if adapter:
+                adapters[if_name] = adapter
+
+        # if we have no network connection at all, no point in proceeding...
+        if not adapters:
+            logger.log_fatal("Exiting...")
+            sys.exit()
+
+    # sample the wireless link in the background from here to the end of the
+    # ping tests
+    if wlan_if in adapters and kind == 'full':
+        start_telemetry(config_vars, logger, agent_state)
+
+    with timer.phase('dns'):
+        # final connectivity check: see if we can resolve an address 
+        # (network connection and DNS must be up)
+        try:
+            gethostbyname('oauth2.googleapis.com')
+        except Exception as ex:
+            if wlan_if not in adapters:
+                logger.log_fatal("DNS seems to be failing, exiting...")
+                sys.exit()
+
+            error_msg = "DNS seems to be failing, bouncing wireless interface..."
+            bounce_error_exit(adapters[wlan_if], logger, error_msg, DEBUG) # exit here
+
+    with timer.phase('gsheet'):
+        # all Google API calls share one rate limiter (kept between cycles in
+        # daemon mode, so that the quota is tracked across cycles)
+        sheets_api = agent_state.get('sheets_api')
+
+        if sheets_api is None:
+            sheets_api = SheetsApi(logger, DEBUG, config_vars['api_requests_per_minute'],
+                config_vars['api_burst'], config_vars['api_max_retries'],
+                backoff_max=config_vars['api_backoff_max'])
+            agent_state['sheets_api'] = sheets_api
+
+        # create our Google sheets object (or re-use the one from our last cycle)
+        gsheet = agent_state.get('gsheet', False)
+
+        if gsheet and not gsheet.refresh():
+            gsheet = False
+
+        if not gsheet:
+            try:
+                gsheet = Gsheet(json_keyfile, spreadsheet_name, logger, DEBUG,
+                    cache_file=config_vars['gsheet_cache_file'], cache_ttl=config_vars['gsheet_cache_ttl'],
+                    api=sheets_api)
+            except Exception as ex:
+                logger.log_error("Error opening Google spreadsheet: " + str(ex))
+                gsheet = False
+
+        agent_state['gsheet'] = gsheet
+
+    # modify config parameters based on config worksheet items (if exists) - 
+    # work on a copy so that the daemon's base config is left untouched
+    config_vars = dict(config_vars)
+
+    with timer.phase('config'):
+        if gsheet:
+            updated_config_vars = check_config_updates(gsheet, gsheet.get_worksheet_titles(), config_vars)
+
+            if updated_config_vars:
+                config_vars = updated_config_vars
     
     server_name = config_vars['server_name']
     location = config_vars['location']
@@ -466,314 +1106,307 @@ def main():
     server_name = server_name.strip()
     location = location.strip()
     
-    ###########################################################################
-    # FIXEME: Server name not currently used in Speedtest function.Need to fix 
-    # this and ensure that if no server passed, uses "best" (which is diff
-    # server every time)
-    ###########################################################################
-    
-    # run speedtest
-    speedtest_results = ooklaspeedtest(server_name)
-    
-    if DEBUG:
-        print("Main: Speedtest results:")
-        print(speedtest_results)
-    
-    # hold all results in one place
-    results_dict = {}
-    
-    # speedtest results
-    results_dict['ping_time'] = speedtest_results['ping_time']
-    results_dict['download_rate'] = speedtest_results['download_rate']
-    results_dict['upload_rate'] = speedtest_results['upload_rate']
-    results_dict['server_name'] = speedtest_results['server_name']
-    
-    results_dict['ssid'] = adapter.get_ssid()
-    results_dict['bssid'] = adapter.get_bssid()
-    results_dict['freq'] = adapter.get_freq()
-    results_dict['bit_rate'] = adapter.get_bit_rate()
-    results_dict['signal_level'] = adapter.get_signal_level()
-    results_dict['ip_addr'] = adapter.get_ipaddr()
-    
-    ####################################################################
-    # FIXME: Need to re-factor to remove repetitive code for ping tests 
-    #
-    # Create functions to pre-fill dict values with NA (use 
-    # dict2.update(dict2) feature to update results_dict
-    #
-    # Also, put ping process in to single function
-    #
-    ####################################################################
-    # check if we have ping 1 test defined & run test if exists
-    results_dict['ping_host1'] =  "NA"
-    results_dict['pkts_tx1'] =  "NA"
-    results_dict['pkts_rx1'] =  "NA"
-    results_dict['percent_loss1'] =  "NA"
-    results_dict['test)time1'] =  "NA"
-    results_dict['rtt_min1'] =  "NA"
-    results_dict['rtt_avg1'] =  "NA"
-    results_dict['rtt_max1'] =  "NA"
-    results_dict['rtt_mdev1'] =  "NA"
-    
-    ping_host1 = False
-    if 'ping_1' in config_vars.keys():
-        ping_host1 = config_vars['ping_1']
-        
-        # Clean up the content to get rid of whitespace
-        ping_host1 = ping_host1.strip()
-        
-        # if not in correct format, make false & register error
-        if ping_host1 == '':
-            # blank entry ignore
-            ping_host1 = False
-        elif not re.match(r"\S+\.\S+", ping_host1):            
-            logger.log_error("Error with ping host format: \'" + str(ping_host1) + "\'")
-            logger.log_error("Ping host must be IP address of resolvable hostname")
-            ping_host1 = False            
-        
-    if ping_host1:
-        
-        # check for def.gw keyword
-        if  ping_host1 == "def.gw":
-            ping_host1 = adapter.get_def_gw()
-    
-        # run 1st ping test
-        ping_obj1 = Pinger(platform = platform, debug = DEBUG)
-        
-        # initial ping to clear out arp
-        ping_obj1.ping_host(ping_host1, 1)
-        
-        # ping test
-        ping_result1 = ping_obj1.ping_host(ping_host1, 10)
-        
-        # ping1 results
-        if ping_result1:
-            results_dict['ping_host1'] =  ping_result1['host']
-            results_dict['pkts_tx1'] =  ping_result1['pkts_tx']
-            results_dict['pkts_rx1'] =  ping_result1['pkts_rx']
-            results_dict['percent_loss1'] =  ping_result1['pkt_loss']
-            results_dict['test)time1'] =  ping_result1['test_time']
-            results_dict['rtt_min1'] =  ping_result1['rtt_min']
-            results_dict['rtt_avg1'] =  ping_result1['rtt_avg']
-            results_dict['rtt_max1'] =  ping_result1['rtt_max']
-            results_dict['rtt_mdev1'] =  ping_result1['rtt_mdev']
-        
-        if DEBUG:
-            print("Main: Ping1 test results:")
-            print(ping_result1)
-    
-    # check if we have ping 2 test defined & run test if exists
-    results_dict['ping_host2'] =  "NA"
-    results_dict['pkts_tx2'] =  "NA"
-    results_dict['pkts_rx2'] =  "NA"
-    results_dict['percent_loss2'] =  "NA"
-    results_dict['test)time2'] =  "NA"
-    results_dict['rtt_min2'] =  "NA"
-    results_dict['rtt_avg2'] =  "NA"
-    results_dict['rtt_max2'] =  "NA"
-    results_dict['rtt_mdev2'] =  "NA"
-    
-    ping_host2 = False
-    if 'ping_2' in config_vars.keys():
-        ping_host2 = config_vars['ping_2']
-        
-        # Clean up the content to get rid of whitespace
-        ping_host2 = ping_host2.strip()
-        
-        # if not in correct format, make false & register error
-        if ping_host2 == '':
-            # blank entry ignore
-            ping_host2 = False
-        elif not re.match(r"\S+\.\S+", ping_host2):            
-            logger.log_error("Error with ping host format: \'" + str(ping_host2) + "\'")
-            logger.log_error("Ping host must be IP address of resolvable hostname")
-            ping_host2 = False            
-        
-    if ping_host2:
-        
-        # check for def.gw keyword
-        if  ping_host2 == "def.gw":
-            ping_host2 = adapter.get_def_gw()
-    
-        # run 2nd ping test
-        ping_obj2 = Pinger(platform = platform, debug = DEBUG)
-        
-        # initial ping to clear out arp
-        ping_obj2.ping_host(ping_host2, 1)
-        
-        # ping test
-        ping_result2 = ping_obj2.ping_host(ping_host2, 10)
-        
-        # ping2 results
-        if ping_result2:
-            results_dict['ping_host2'] =  ping_result2['host']
-            results_dict['pkts_tx2'] =  ping_result2['pkts_tx']
-            results_dict['pkts_rx2'] =  ping_result2['pkts_rx']
-            results_dict['percent_loss2'] =  ping_result2['pkt_loss']
-            results_dict['test)time2'] =  ping_result2['test_time']
-            results_dict['rtt_min2'] =  ping_result2['rtt_min']
-            results_dict['rtt_avg2'] =  ping_result2['rtt_avg']
-            results_dict['rtt_max2'] =  ping_result2['rtt_max']
-            results_dict['rtt_mdev2'] =  ping_result2['rtt_mdev']
-        
-        if DEBUG:
-            print("Main: Ping2 test results:")
-            print(ping_result2)
-
-    # check if we have ping 3 test defined & run test if exists
-    results_dict['ping_host3'] =  "NA"
-    results_dict['pkts_tx3'] =  "NA"
-    results_dict['pkts_rx3'] =  "NA"
-    results_dict['percent_loss3'] =  "NA"
-    results_dict['test)time3'] =  "NA"
-    results_dict['rtt_min3'] =  "NA"
-    results_dict['rtt_avg3'] =  "NA"
-    results_dict['rtt_max3'] =  "NA"
-    results_dict['rtt_mdev3'] =  "NA"
-            
-    ping_host3 = False
-    if 'ping_3' in config_vars.keys():
-        ping_host3 = config_vars['ping_3']
-        
-        # Clean up the content to get rid of whitespace
-        ping_host3 = ping_host3.strip()
-        
-        # if not in correct format, make false & register error
-        if ping_host3 == '':
-            # blank entry ignore
-            ping_host1 = False
-        elif not re.match(r"\S+\.\S+", ping_host3):            
-            logger.log_error("Error with ping host format: \'" + str(ping_host3) + "\'")
-            logger.log_error("Ping host must be IP address of resolvable hostname")
-            ping_host3 = False            
-        
-    if ping_host3:
-        
-        # check for def.gw keyword
-        if  ping_host3 == "def.gw":
-            ping_host3 = adapter.get_def_gw()
-    
-        # run 3rd ping test
-        ping_obj3 = Pinger(platform = platform, debug = DEBUG)
-        
-        # initial ping to clear out arp
-        ping_obj3.ping_host(ping_host3, 1)
-        
-        # ping test
-        ping_result3 = ping_obj3.ping_host(ping_host3, 10)
-        
-        # ping3 results
-        if ping_result3:
-            results_dict['ping_host3'] =  ping_result3['host']
-            results_dict['pkts_tx3'] =  ping_result3['pkts_tx']
-            results_dict['pkts_rx3'] =  ping_result3['pkts_rx']
-            results_dict['percent_loss3'] =  ping_result3['pkt_loss']
-            results_dict['test)time3'] =  ping_result3['test_time']
-            results_dict['rtt_min3'] =  ping_result3['rtt_min']
-            results_dict['rtt_avg3'] =  ping_result3['rtt_avg']
-            results_dict['rtt_max3'] =  ping_result3['rtt_max']
-            results_dict['rtt_mdev3'] =  ping_result3['rtt_mdev']
-        
+    # bind test traffic to the interface under test?
+    bind = (config_vars['interface_bind'] in ['on', 'yes', 'true', '1'] or
+        (config_vars['interface_bind'] == 'auto' and len(config_vars['interfaces']) > 1))
+
+    # hold all results in one place (per interface)
+    interface_results = {}
+
+    for if_name in ping_ifs:
+        if if_name in adapters:
+            interface_results[if_name] = interface_details(adapters[if_name])
+
+    for if_name in throughput_ifs:
+        if if_name not in adapters:
+            continue
+
+        interface_results[if_name].update(run_throughput_tests(config_vars, logger, agent_state, timer,
+            adapters[if_name], bind, server_name))
+
+    # run ping tests (all targets run concurrently - & all interfaces too, if
+    # scheduled that way)
+    with timer.phase('ping'):
+        ping_adapters = [adapters[if_name] for if_name in ping_ifs if if_name in adapters]
+
+        if config_vars['interface_schedule'] == 'concurrent_ping':
+            ping_results = run_concurrent(dict([(ping_adapter.wlan_if_name, (run_ping_tests,
+                (config_vars, ping_adapter, platform, logger, DEBUG, bind))) for ping_adapter in ping_adapters]))
+        else:
+            ping_results = dict([(ping_adapter.wlan_if_name,
+                run_ping_tests(config_vars, ping_adapter, platform, logger, DEBUG, bind)) for ping_adapter in ping_adapters])
+
+        for (if_name, results_dict) in ping_results.items():
+            interface_results[if_name].update(results_dict)
+
+    stop_telemetry(config_vars, logger, agent_state, timer.started_at)
+
+    # the complete results (one per interface), as sent to each of our result
+    # sinks
+    timestamp = int(time.time())
+    records = []
+
+    for if_name in ping_ifs:
+        if if_name not in interface_results:
+            continue
+
+        record = {
+            'timestamp': timestamp,
+            'date': current_timestamp,
+            'cleartext_date': str(now),
+            'hostname': gethostname(),
+            'location': location,
+            'interface': if_name
+        }
+
+        record.update(interface_results[if_name])
+
+        # timings of the phases so far go with the result if required (the
+        # rest of the cycle's phases are only kept locally)
+        if config_vars['phase_timing_upload']:
+            record.update(timer.result_fields(if_name))
+
         if DEBUG:
-            print("Main: Ping3 test results:")
-            print(ping_result3)
-   
-    sheet_row_data = [
-        current_timestamp,
-        results_dict['ping_time'],
-        results_dict['download_rate'],
-        results_dict['upload_rate'],
-        results_dict['ssid'], 
-        results_dict['bssid'],
-        results_dict['freq'],
-        results_dict['bit_rate'],
-        results_dict['signal_level'],
-        results_dict['ip_addr'],
-        location,
-        results_dict['server_name'],
-        results_dict['ping_host1'],
-        results_dict['pkts_tx1'],
-        results_dict['percent_loss1'],
-        results_dict['rtt_avg1'],
-        results_dict['ping_host2'],
-        results_dict['pkts_tx2'],
-        results_dict['percent_loss2'],
-        results_dict['rtt_avg2'],
-        results_dict['ping_host3'],
-        results_dict['pkts_tx3'],
-        results_dict['percent_loss3'],
-        results_dict['rtt_avg3']
-    ]
-    
-    if DEBUG:
-        print(sheet_row_data)
-    
-    # check if we need to create new sheet (new day?)
-    sheet = False
-    
-    if gsheet:
-        gsheet.create_worksheet_if_needed()
-    
-        # open the Google sheet and try to post results (cache locally if fails)
-        todays_worksheet_name = gsheet.get_todays_worksheet_name()
-        sheet = gsheet.open_gspread_worksheet(todays_worksheet_name)
-    
-    if sheet != False:
-    
-        # Let's check to see if we have any old cached results to push before we
-        # post latest result to gspread
+            print(record)
+
+        if agent_state.get('exporter'):
+            agent_state['exporter'].update_result(record)
 
-        push_cached_results(sheet, cache_file, db_file, logger, DEBUG)
+        records.append(record)
     
-        # post latest result to worksheet    
-        append_result = sheet.append_row(sheet_row_data)
+    with timer.phase('publish'):
+        # send the result to all of our sinks (Google sheet, local DB...) - each
+        # is queued in the sink's outbox until it has been accepted
+        pipeline = agent_state.get('sinks')
 
-        if DEBUG:
-            print("Result of spreadsheet append operation: " + str(append_result))
-            print("Append operation result type: " + str(type(append_result)))
-        
-        if type(append_result) is not dict:
-            logger.log_error("Append operation on sheet appears to have failed (should be dict: " + str(append_result))
-            # something went wrong with append operation - cache locally
-            dump_result_local_db(sheet_row_data, db_file, logger, DEBUG)
-            
-    else:
-        # something went wrong with sheet opening operation - cache result locally for next time
-        dump_result_local_db(sheet_row_data, db_file, logger, DEBUG)
-    
-    db_conn = sqlite3.connect(db_file)
-    
-    # Tidy up old data to keep db reasonable size
-    db_conn.execute("delete from speedtest_data where datetime(timestamp, 'unixepoch') <= date('now', '-7 days')")
-    db_conn.commit()
-    
-    cleartext_date = datetime.datetime.now()
-    
-    # add data to db
-    db_conn.execute("insert into speedtest_data (timestamp, cleartext_date, ping_time, download_rate, upload_rate, ssid, bssid, freq, bit_rate, signal_level, ip_address) values (?,?,?,?,?,?,?,?,?,?,?)", (
-        int(time.time()), 
-        cleartext_date,
-        results_dict['ping_time'],
-        results_dict['download_rate'],
-        results_dict['upload_rate'],
-        results_dict['ssid'], 
-        results_dict['bssid'],
-        results_dict['freq'],
-        results_dict['bit_rate'],
-        results_dict['signal_level'],
-        results_dict['ip_addr']))
-        
-    db_conn.commit()
+        if pipeline is None:
+            pipeline = create_sink_pipeline(config_vars, logger, DEBUG)
+            agent_state['sinks'] = pipeline
+
+        gsheet_sink = pipeline.get_sink('gsheet')
+
+        if gsheet_sink:
+            gsheet_sink.set_gsheet(gsheet)
+
+        db_conn = db_connect(db_file)
+
+        for record in records:
+            sink_status = pipeline.publish(db_conn, record)
+
+            if agent_state.get('exporter'):
+                agent_state['exporter'].update_sinks(sink_status)
+
+        if not PERSISTENT_DB:
+            pipeline.close()
+
+    with timer.phase('housekeeping'):
+        # Tidy up old data to keep db reasonable size
+        db_conn.execute("delete from speedtest_data where timestamp <= cast(strftime('%s', date('now', '-7 days')) as integer)")
+        db_conn.commit()
     
-    # Tidy up old logs
-    db_conn.execute("delete from error_logs where datetime(timestamp, 'unixepoch') <= date('now', '-2 days')")
-    db_conn.commit()
+        # Tidy up old logs
+        db_conn.execute("delete from error_logs where timestamp <= cast(strftime('%s', date('now', '-2 days')) as integer)")
+        db_conn.commit()
+
+        # Tidy up old rollups (kept much longer than the raw data)
+        db_conn.execute("delete from rollup_hourly where period_start <= cast(strftime('%s', date('now', ?)) as integer)",
+            ('-' + str(config_vars['rollup_hourly_keep_days']) + ' days',))
+        db_conn.execute("delete from rollup_daily where period_start <= cast(strftime('%s', date('now', ?)) as integer)",
+            ('-' + str(config_vars['rollup_daily_keep_days']) + ' days',))
+        db_conn.commit()
+
+        # Tidy up old link events
+        db_conn.execute("delete from link_events where timestamp <= cast(strftime('%s', date('now', ?)) as integer)",
+            ('-' + str(config_vars['events_keep_days']) + ' days',))
+        db_conn.commit()
         
-    # close db connection
-    db_conn.close()
+        # close db connection
+        db_release(db_conn)
+
+    with timer.phase('console'):
+        # send error messages to console (make sure any buffered messages are in
+        # the DB first)
+        logger.flush()
+
+        if gsheet:
+            update_console(gsheet, gsheet.get_worksheet_titles(), db_file, logger, DEBUG)
+
+    with timer.phase('api_stats'):
+        # keep our API call counters (latency, retries, rate limiting) locally
+        db_conn = db_connect(db_file)
+
+        sheets_api.save_stats(db_conn)
 
-    # send error messages to console
-    update_console(gsheet, gsheet.get_worksheet_titles(), db_file, logger, DEBUG)
+        db_conn.execute("delete from api_call_stats where day < date('now', '-30 days')")
+        db_conn.commit()
+
+        db_release(db_conn)
+
+    return records
+
+###############################################################################
+# Main
+###############################################################################
+
+def start_link_events(config_vars, logger, on_recovery):
+
+    '''
+    Start listening for link events (roams, disconnects, IP changes) on our
+    wireless interface - on_recovery is called if the connection stays down.
+    Returns the listener (None if we can't listen).
+    '''
+
+    from kernelnetinfo import KernelNetInfo
+
+    wlan_if = config_vars['wlan_if']
+
+    # (replayed events are for testing off-device)
+    try:
+        if config_vars['events_replay_file']:
+            source = FixtureEventSource(config_vars['events_replay_file'])
+        else:
+            source = NetlinkEventSource(wlan_if, DEBUG)
+    except Exception as ex:
+        logger.log_error("Unable to listen for link events on " + wlan_if + ": " + str(ex))
+        return None
+
+    # start from the current state of our connection (if we can read it)
+    bssid = None
+    ip_addr = None
+
+    try:
+        netinfo = KernelNetInfo(wlan_if, debug=DEBUG)
+        bssid = netinfo.get_bssid()
+        ip_addr = netinfo.get_ip_addr()
+    except (IOError, OSError):
+        pass
+
+    listener = LinkEventListener(source, wlan_if, logger, DEBUG, config_vars['db_file'],
+        on_recovery=on_recovery, recovery_delay=config_vars['events_recovery_delay'],
+        recovery_holdoff=config_vars['events_recovery_holdoff'],
+        bssid=None if bssid == "NA" else bssid, ip_addr=None if ip_addr == "NA" else ip_addr)
+
+    listener.start()
+
+    return listener
+
+def run_daemon(config_vars, logger):
+
+    '''
+    Run as a long-lived daemon: the Google sheet object, Speedtest object and
+    SQLite connections are kept warm between test cycles
+    '''
+
+    global PERSISTENT_DB
+    PERSISTENT_DB = True
+
+    agent_state = {}
+
+    # serve our latest results to Prometheus (if required)
+    if config_vars['exporter_enabled']:
+        exporter = MetricsExporter(config_vars['exporter_bind'], config_vars['exporter_port'], logger, DEBUG)
+
+        try:
+            exporter.start()
+            agent_state['exporter'] = exporter
+        except Exception as ex:
+            logger.log_error("Unable to start metrics exporter on port " + str(config_vars['exporter_port']) + ": " + str(ex))
+
+    # when to run each cycle & what kind (full or ping-only), spread across
+    # the probes on a site & adapted to our results (if required)
+    scheduler = CycleScheduler(config_vars['daemon_interval'], config_vars['hostname'],
+        config_vars['schedule_jitter'], config_vars['schedule_adaptive'], config_vars['schedule_max_interval'],
+        config_vars['schedule_ping_interval'], config_vars['schedule_stable_pct'],
+        config_vars['schedule_stable_runs'], config_vars['schedule_degraded_loss'],
+        config_vars['schedule_degraded_rtt'], debug=DEBUG)
+
+    run_lock = RunLock(config_vars['schedule_lock_file'], DEBUG) if config_vars['schedule_lock_file'] else None
+
+    def on_scheduled(run_time, kind):
+        if 'exporter' in agent_state:
+            agent_state['exporter'].update_schedule(scheduler, run_time, kind)
+
+    daemon = AgentDaemon(lambda kind: run_cycle(config_vars, logger, agent_state, kind),
+        config_vars['daemon_interval'], logger, debug=DEBUG, scheduler=scheduler, run_lock=run_lock,
+        on_event=lambda event, count: record_schedule_event(config_vars['db_file'], event, logger, count),
+        on_scheduled=on_scheduled)
+
+    daemon.install_signal_handlers()
+
+    # run a cycle (which recovers the connection) as soon as the connection
+    # goes down, rather than at the next scheduled cycle
+    if config_vars['events_enabled']:
+        listener = start_link_events(config_vars, logger, daemon.wake)
+
+        if listener:
+            agent_state['link_events'] = listener
+
+    try:
+        daemon.run()
+    finally:
+        if 'link_events' in agent_state:
+            agent_state['link_events'].stop()
+        if 'sinks' in agent_state:
+            agent_state['sinks'].close()
+        if 'exporter' in agent_state:
+            agent_state['exporter'].stop()
+        db_close_all()
+        logger.close()
+
+def run_scheduled_cycle(config_vars, logger):
+
+    '''
+    Run a single test cycle from cron: wait for this probe's offset into the
+    cron interval (so that the probes on a site don't all start at once),
+    then run the cycle - unless the last run is still going
+    '''
+
+    time.sleep(probe_offset(config_vars['hostname'], config_vars['schedule_jitter']))
+
+    run_lock = None
+
+    if config_vars['schedule_lock_file']:
+        run_lock = RunLock(config_vars['schedule_lock_file'], DEBUG)
+
+        if not run_lock.acquire():
+            logger.log_error("Another test cycle is still running, skipping this one")
+            record_schedule_event(config_vars['db_file'], 'overlap', logger)
+            return
+
+    record_schedule_event(config_vars['db_file'], 'full', logger)
+
+    try:
+        run_cycle(config_vars, logger)
+    finally:
+        if run_lock is not None:
+            run_lock.release()
+
+def main():
+
+    parser = argparse.ArgumentParser(description="WLANPi speedtest agent")
+    parser.add_argument('-d', '--daemon', action='store_true',
+        help="run continuously on an internal schedule instead of a single test cycle (e.g. from cron)")
+    args = parser.parse_args()
+
+    # read in our local config file (content in dictionary: config_vars)
+    (config_vars, logger) = read_config(DEBUG)
+
+    # make sure our local DB schema is up to date (no point in testing if we
+    # can't store our results)
+    if migrate_db(config_vars['db_file'], logger, DEBUG) is False:
+        logger.log_fatal("Unable to migrate local DB schema, exiting...")
+        logger.close()
+        sys.exit()
+
+    if args.daemon:
+        run_daemon(config_vars, logger)
+    else:
+        # (make sure buffered log messages are written & the logger's flush
+        # timer is stopped, even if the cycle bails out with sys.exit())
+        try:
+            run_scheduled_cycle(config_vars, logger)
+        finally:
+            logger.close()
     
 ###############################################################################
 # End main
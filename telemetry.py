@@ -0,0 +1,390 @@
+#!/usr/bin/python
+'''
+High rate sampling of wireless link telemetry (signal, noise, tx bit rate,
+rx/tx throughput & retry counters) for the whole of a test cycle, so that
+changes during a test (e.g. the bit rate dropping half way through the
+download) show up - rather than the single snapshot taken before the test.
+
+Samples are held in compact array-backed buffers (one array of doubles per
+field). Each run is stored as min/mean/max summaries, plus (optionally) the
+raw series, compressed.
+
+Raw readings can be recorded on a probe & replayed off-device:
+
+    python telemetry.py --record wlan0 --rate 10 --secs 30 > run.csv
+    python telemetry.py --replay run.csv
+'''
+from __future__ import print_function
+
+# raw readings taken from the kernel at each sample (counters are totals
+# since the interface came up)
+READING_FIELDS = ['time', 'level', 'noise', 'link', 'tx_bitrate', 'rx_bytes',
+    'tx_bytes', 'retry', 'beacon']
+
+# fields of each sample (secs since sampling started, dBm, dBm, link quality,
+# Mbps, Mbps, Mbps, counter, counter)
+SAMPLE_FIELDS = ['offset', 'signal', 'noise', 'link', 'tx_bitrate', 'rx_mbps',
+    'tx_mbps', 'retry', 'beacon']
+
+# sample fields summarized as min/mean/max
+SUMMARY_FIELDS = ['signal', 'noise', 'tx_bitrate', 'rx_mbps', 'tx_mbps']
+
+# sample fields that are counters (summarized as the increase over the run)
+COUNTER_FIELDS = ['retry', 'beacon']
+
+def reading_value(value):
+    '''
+    A kernel reading as a float - NaN if not available (e.g. noise is
+    reported as -256 by drivers that don't measure it)
+    '''
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+    if value <= -256:
+        return float('nan')
+
+    return value
+
+def array_bytes(values):
+    ''' Raw bytes of an array (tostring() on python 2) '''
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()
+
+def encode_series(buffers, fields):
+    '''
+    Compress sample buffers: the fields' values as float32 arrays, one after
+    the other, zlib compressed
+    '''
+    import array
+    import zlib
+
+    raw = b''.join([array_bytes(array.array('f', buffers[field])) for field in fields])
+
+    return zlib.compress(raw, 6)
+
+def decode_series(data, fields):
+    '''
+    Decompress a series from encode_series: {field: [values]}
+    '''
+    import array
+    import zlib
+
+    values = array.array('f')
+
+    raw = zlib.decompress(data)
+
+    if hasattr(values, 'frombytes'):
+        values.frombytes(raw)
+    else:
+        values.fromstring(raw)
+
+    count = len(values) // len(fields)
+
+    return dict([(field, values[index * count:(index + 1) * count].tolist()) for (index, field) in enumerate(fields)])
+
+class KernelReadingSource(object):
+    '''
+    Take readings from the kernel (see kernelnetinfo.py)
+    '''
+
+    def __init__(self, netinfo):
+        self.netinfo = netinfo
+
+    def read(self):
+        '''
+        A reading: {field: value} (see READING_FIELDS)
+        '''
+        import time
+
+        reading = {'time': time.time()}
+
+        stats = self.netinfo.get_wireless_stats() or {}
+
+        for field in ['level', 'noise', 'link', 'retry', 'beacon']:
+            reading[field] = stats.get(field, "NA")
+
+        try:
+            reading['tx_bitrate'] = self.netinfo.get_bit_rate()
+        except (IOError, OSError):
+            reading['tx_bitrate'] = "NA"
+
+        for field in ['rx_bytes', 'tx_bytes']:
+            try:
+                reading[field] = self.netinfo.get_interface_counter(field)
+            except (IOError, OSError, ValueError):
+                reading[field] = "NA"
+
+        return reading
+
+class ReplayReadingSource(object):
+    '''
+    Replay readings recorded with "telemetry.py --record" (a CSV file with a
+    header of READING_FIELDS), one reading each time we are read. Reading
+    times are as recorded (shifted to start now), so rates come out as they
+    were recorded. Once the recording runs out, it starts again from the top.
+    '''
+
+    def __init__(self, replay_file):
+
+        import csv
+
+        with open(replay_file) as replay_file_obj:
+            self.readings = list(csv.DictReader(replay_file_obj))
+
+        if not self.readings:
+            raise ValueError("No readings in " + replay_file)
+
+        self.index = 0
+        self.time_shift = None
+        self.loop_time = 0.0
+
+    def read(self):
+
+        import time
+
+        reading = dict(self.readings[self.index % len(self.readings)])
+
+        recorded_time = float(reading['time'])
+
+        if self.time_shift is None:
+            self.time_shift = time.time() - recorded_time
+
+        # (each time round the recording, carry on from where we left off)
+        if self.index and self.index % len(self.readings) == 0:
+            self.loop_time += float(self.readings[-1]['time']) - float(self.readings[0]['time'])
+
+        reading['time'] = recorded_time + self.time_shift + self.loop_time
+
+        self.index += 1
+
+        return reading
+
+class TelemetrySampler(object):
+    '''
+    A class to sample link telemetry from a reading source at rate (per sec)
+    in a background thread, between start() & stop(). At most max_samples
+    are kept (the oldest are dropped beyond that).
+    '''
+
+    def __init__(self, source, rate=10, logger=None, debug=False, max_samples=36000):
+
+        import array
+        import threading
+
+        self.source = source
+        self.rate = float(rate)
+        self.logger = logger
+        self.debug = debug
+        self.max_samples = int(max_samples)
+
+        self.buffers = dict([(field, array.array('d')) for field in SAMPLE_FIELDS])
+
+        self.started_at = None
+        self.last_reading = None
+        self.errors = 0
+
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def add_reading(self, reading):
+        '''
+        Turn a raw reading in to a sample & add it to our buffers
+        '''
+        nan = float('nan')
+
+        if self.started_at is None:
+            self.started_at = reading['time']
+
+        sample = {'offset': reading['time'] - self.started_at}
+
+        for (sample_field, reading_field) in [('signal', 'level'), ('noise', 'noise'), ('link', 'link'),
+            ('tx_bitrate', 'tx_bitrate'), ('retry', 'retry'), ('beacon', 'beacon')]:
+
+            sample[sample_field] = reading_value(reading.get(reading_field))
+
+        # throughput from the byte counters since the last reading
+        last = self.last_reading
+
+        for direction in ['rx', 'tx']:
+            sample[direction + '_mbps'] = nan
+
+            if last is None:
+                continue
+
+            elapsed = reading['time'] - last['time']
+            byte_count = reading_value(reading.get(direction + '_bytes')) - reading_value(last.get(direction + '_bytes'))
+
+            # (counters can wrap or reset if the interface bounces)
+            if elapsed > 0 and byte_count >= 0:
+                sample[direction + '_mbps'] = byte_count * 8 / elapsed / 1e6
+
+        self.last_reading = reading
+
+        for field in SAMPLE_FIELDS:
+            buffer = self.buffers[field]
+            buffer.append(sample[field])
+
+            if len(buffer) > self.max_samples:
+                del buffer[0]
+
+    def run(self):
+
+        import time
+
+        interval = 1.0 / self.rate
+        next_sample = time.time()
+
+        while not self.stop_event.is_set():
+            try:
+                self.add_reading(self.source.read())
+            except Exception as ex:
+                self.errors += 1
+
+                # (just the first, so a broken source doesn't flood the log)
+                if self.errors == 1 and self.logger:
+                    self.logger.log_error("Telemetry sampling error: " + str(ex))
+
+            # keep to our rate without drifting (skip samples if we fall behind)
+            next_sample += interval
+            now = time.time()
+
+            if next_sample < now:
+                next_sample = now
+
+            self.stop_event.wait(next_sample - now)
+
+    def start(self):
+
+        import threading
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Stop sampling (safe to call more than once)
+        '''
+        self.stop_event.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def sample_count(self):
+        return len(self.buffers['offset'])
+
+    def summary(self):
+        '''
+        Summary of the samples so far: {<field>_min/_mean/_max} for each of
+        SUMMARY_FIELDS (None if no values), {<field>_delta} for each of
+        COUNTER_FIELDS, samples & duration (secs)
+        '''
+        import math
+
+        summary = {'samples': self.sample_count(), 'duration': 0.0}
+
+        if summary['samples']:
+            summary['duration'] = self.buffers['offset'][-1]
+
+        for field in SUMMARY_FIELDS:
+            values = [value for value in self.buffers[field] if not math.isnan(value)]
+
+            if values:
+                summary[field + '_min'] = min(values)
+                summary[field + '_mean'] = sum(values) / len(values)
+                summary[field + '_max'] = max(values)
+            else:
+                summary[field + '_min'] = summary[field + '_mean'] = summary[field + '_max'] = None
+
+        for field in COUNTER_FIELDS:
+            values = [value for value in self.buffers[field] if not math.isnan(value)]
+            summary[field + '_delta'] = max(values[-1] - values[0], 0) if values else None
+
+        return summary
+
+    def series(self):
+        ''' Our samples, compressed (see encode_series) '''
+        return encode_series(self.buffers, SAMPLE_FIELDS)
+
+    def save(self, db_conn, cycle_start, store_series=False):
+        '''
+        Store a summary of our samples (& the compressed samples, if
+        required) in the telemetry_runs table
+        '''
+        import sqlite3
+
+        summary = self.summary()
+
+        columns = (['cycle_start', 'rate', 'samples', 'duration'] +
+            [field + suffix for field in SUMMARY_FIELDS for suffix in ['_min', '_mean', '_max']] +
+            [field + '_delta' for field in COUNTER_FIELDS])
+
+        values = [cycle_start, self.rate] + [summary[column] for column in columns[2:]]
+
+        if store_series:
+            columns += ['series_fields', 'series']
+            values += [",".join(SAMPLE_FIELDS), sqlite3.Binary(self.series())]
+
+        try:
+            with db_conn:
+                db_conn.execute("insert into telemetry_runs (" + ", ".join(columns) + ") values (" +
+                    ",".join(["?"] * len(columns)) + ")", values)
+        except Exception as ex:
+            if self.logger:
+                self.logger.log_error("Db execute error when trying to save telemetry: " + str(ex))
+            return False
+
+        return True
+
+def main():
+
+    import argparse
+    import csv
+    import sys
+    import time
+    from kernelnetinfo import KernelNetInfo
+
+    parser = argparse.ArgumentParser(description="Record or replay wireless link telemetry")
+    parser.add_argument('--record', metavar='IF_NAME', help="record raw readings from this interface (CSV to stdout)")
+    parser.add_argument('--replay', metavar='FILE', help="replay recorded readings & summarize them")
+    parser.add_argument('--rate', type=float, default=10, help="samples per sec")
+    parser.add_argument('--secs', type=float, default=30, help="how long to record/replay for")
+    args = parser.parse_args()
+
+    if args.record:
+        source = KernelReadingSource(KernelNetInfo(args.record))
+
+        writer = csv.DictWriter(sys.stdout, READING_FIELDS)
+        writer.writeheader()
+
+        end_time = time.time() + args.secs
+
+        while time.time() < end_time:
+            writer.writerow(source.read())
+            time.sleep(1.0 / args.rate)
+
+    elif args.replay:
+        sampler = TelemetrySampler(ReplayReadingSource(args.replay), args.rate)
+
+        sampler.start()
+        time.sleep(args.secs)
+        sampler.stop()
+
+        for (name, value) in sorted(sampler.summary().items()):
+            if value is None:
+                value = "NA"
+            elif isinstance(value, float):
+                value = '%.2f' % value
+
+            print("%-16s %s" % (name, value))
+
+        print("%-16s %d bytes" % ('series', len(sampler.series())))
+    else:
+        parser.error("one of --record or --replay is needed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+'''
+Time-bounded, adaptive throughput measurement on top of speedtest-cli.
+Rather than always using the fixed set of transfer sizes from the
+speedtest.net config, transfers are run in rounds of growing size until
+the measured rate settles, all within a fixed time budget per direction.
+'''
+from __future__ import print_function
+
+class ThroughputTester(object):
+    '''
+    A class to run download/upload tests with a speedtest.Speedtest object
+
+        streams:      number of parallel transfers (0 = speedtest.net default)
+        time_budget:  max secs for each direction
+        adaptive:     grow transfer sizes until the rate settles (otherwise a
+                      single speedtest-cli style run, cut off at time_budget)
+        stable_pct:   rate is settled once it changes less than this (%)
+                      between rounds
+        max_rounds:   max number of adaptive rounds per direction
+
+    size_hints is a dictionary to remember the transfer size that the rate
+    settled at (per direction), so that the next test can start close to it
+    rather than working up from the smallest size again (the daemon keeps
+    it between cycles).
+    '''
+
+    def __init__(self, logger, debug=False, streams=0, time_budget=15, adaptive=True,
+        stable_pct=10, max_rounds=4, size_hints=None):
+
+        self.logger = logger
+        self.debug = debug
+        self.streams = int(streams)
+        self.time_budget = float(time_budget)
+        self.adaptive = adaptive
+        self.stable_pct = float(stable_pct)
+        self.max_rounds = int(max_rounds)
+
+        if size_hints is None:
+            size_hints = {}
+
+        self.size_hints = size_hints
+
+    def run_transfer(self, st, direction, sizes, count, length):
+        '''
+        Run one speedtest-cli transfer: count transfers of each size in sizes,
+        cut off after length secs. Returns the rate (bits/sec).
+        '''
+        st.config['sizes'][direction] = sizes
+        st.config['counts'][direction] = count
+        st.config['length'][direction] = length
+
+        threads = self.streams or None
+
+        if direction == 'download':
+            return st.download(threads=threads)
+
+        st.config['upload_max'] = count * len(sizes)
+
+        return st.upload(pre_allocate=False, threads=threads)
+
+    def measure(self, st, direction):
+        '''
+        Measure throughput in one direction ('download' or 'upload').
+        Returns the rate (bits/sec).
+        '''
+        import copy
+
+        # keep the speedtest.net settings intact for the next test
+        saved_config = dict([(key, copy.deepcopy(st.config[key])) for key in ['sizes', 'counts', 'length', 'upload_max']])
+
+        try:
+            if not self.adaptive:
+                return self.run_transfer(st, direction, saved_config['sizes'][direction],
+                    saved_config['counts'][direction], self.time_budget)
+
+            return self.measure_adaptive(st, direction, saved_config)
+        finally:
+            st.config.update(saved_config)
+
+    def measure_adaptive(self, st, direction, saved_config):
+
+        import time
+
+        sizes = saved_config['sizes'][direction]
+        streams = self.streams or st.config['threads'][direction]
+
+        # two transfers per stream each round, so that every stream is busy
+        # for the whole round
+        count = 2 * streams
+
+        # start a step below the size the rate settled at last time
+        size_index = max(0, min(self.size_hints.get(direction, 0) - 1, len(sizes) - 1))
+
+        start_time = time.time()
+        rate = 0
+        last_rate = None
+
+        for round_number in range(1, self.max_rounds + 1):
+
+            remaining = self.time_budget - (time.time() - start_time)
+
+            if remaining < 1:
+                break
+
+            round_start = time.time()
+            rate = self.run_transfer(st, direction, [sizes[size_index]], count, remaining)
+            round_time = time.time() - round_start
+
+            if self.debug:
+                print("Throughput " + direction + " round " + str(round_number) + ": size " + str(sizes[size_index]) +
+                    " x " + str(count) + ", " + '%.2f' % (rate / 1e6) + " Mbps in " + '%.1f' % round_time + " secs")
+
+            self.size_hints[direction] = size_index
+
+            # settled?
+            if last_rate and abs(rate - last_rate) * 100.0 / last_rate <= self.stable_pct:
+                break
+
+            # transfers were cut off by the time budget - can't go any bigger
+            if round_time >= remaining * 0.9 or size_index == len(sizes) - 1:
+                break
+
+            last_rate = rate
+            size_index += 1
+
+        return rate
+
+    def download(self, st):
+        return self.measure(st, 'download')
+
+    def upload(self, st):
+        return self.measure(st, 'upload')
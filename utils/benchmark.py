@@ -0,0 +1,456 @@
+#!/usr/bin/python
+'''
+Benchmark the agent's parsing, storage & upload hot paths, driven by the
+recorded fixtures in utils/fixtures (no network or wireless adapter needed -
+Google sheets calls go to a fake Sheets client).
+
+For each operation, reports the latency per call (mean/min/p95 ms), peak
+memory allocated by one call (KB, needs python 3 tracemalloc) & the number
+of Google API calls made per call. Use --save to append the results to a
+JSON lines file, so that changes can be compared over time:
+
+    cd utils
+    python benchmark.py --iterations 200 --save benchmark_history.jsonl
+'''
+from __future__ import print_function
+
+import os
+import sys
+
+UTILS_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(UTILS_DIR, 'fixtures')
+
+# agent modules live in the directory above us
+sys.path.insert(0, os.path.dirname(UTILS_DIR))
+
+# Google API calls made via the fake Sheets client (call name: count)
+API_CALLS = {}
+
+def count_api_call(name):
+    API_CALLS[name] = API_CALLS.get(name, 0) + 1
+
+def read_fixture(path):
+    with open(os.path.join(FIXTURE_DIR, path)) as fixture_file:
+        return fixture_file.read()
+
+class NullLogger(object):
+    ''' Logger that discards messages '''
+
+    def log_error(self, err_msg):
+        pass
+
+    def log_fatal(self, err_msg):
+        pass
+
+    def flush(self):
+        pass
+
+class FakeWorksheet(object):
+    '''
+    Worksheet of the fake Sheets client - keeps appended rows in memory
+    '''
+
+    def __init__(self, spreadsheet, properties):
+
+        self.spreadsheet = spreadsheet
+        self.title = properties['title']
+        self.id = properties['sheetId']
+
+        # rows are held by the spreadsheet (values are appended through it)
+        spreadsheet.rows.setdefault(self.title, [])
+
+    def append_row(self, values):
+        count_api_call('append_row')
+        self.spreadsheet.rows[self.title].append(list(values))
+        return {'updates': {'updatedRange': self.title + '!A1:Z1'}}
+
+    def col_values(self, col):
+        count_api_call('col_values')
+        return [row[col - 1] for row in self.spreadsheet.rows[self.title] if len(row) >= col]
+
+    def get_all_values(self):
+        count_api_call('get_all_values')
+        return self.spreadsheet.rows[self.title]
+
+class FakeSpreadsheet(object):
+    '''
+    Spreadsheet of the fake Sheets client
+    '''
+
+    def __init__(self, titles):
+
+        self.id = 'fake-spreadsheet-key'
+        self.rows = {}
+        self.sheets = {}
+
+        for title in titles:
+            self.add_sheet(title)
+
+    def add_sheet(self, title):
+
+        self.sheets[title] = FakeWorksheet(self, {'title': title, 'sheetId': len(self.sheets) + 1})
+        return self.sheets[title]
+
+    def worksheets(self):
+        count_api_call('worksheets')
+        return list(self.sheets.values())
+
+    def worksheet(self, title):
+        count_api_call('worksheet')
+        return self.sheets[title]
+
+    def get_worksheet_by_id(self, sheet_id):
+        count_api_call('get_worksheet_by_id')
+        return [sheet for sheet in self.sheets.values() if sheet.id == sheet_id][0]
+
+    def add_worksheet(self, title, rows, cols):
+        count_api_call('add_worksheet')
+        return self.add_sheet(title)
+
+    def values_append(self, range_name, params, body):
+        count_api_call('values_append')
+
+        title = range_name.split('!')[0].strip("'")
+        first_row = len(self.rows[title]) + 1
+
+        self.rows[title].extend(body['values'])
+
+        return {'updates': {'updatedRange': title + '!A' + str(first_row) + ':Z' + str(len(self.rows[title]))}}
+
+    def batch_update(self, body):
+        count_api_call('batch_update')
+
+        for request in body['requests']:
+            delete_range = request['deleteDimension']['range']
+
+            for (title, sheet) in self.sheets.items():
+                if sheet.id == delete_range['sheetId']:
+                    del self.rows[title][delete_range['startIndex']:delete_range['endIndex']]
+
+        return {}
+
+class FakeClient(object):
+
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def open(self, name):
+        count_api_call('open')
+        return self.spreadsheet
+
+    def open_by_key(self, key):
+        count_api_call('open_by_key')
+        return self.spreadsheet
+
+    def login(self):
+        count_api_call('login')
+
+class FakeCredentials(object):
+
+    access_token = None
+    token_expiry = None
+    access_token_expired = False
+
+    @classmethod
+    def from_json_keyfile_name(cls, json_keyfile, scope):
+        return cls()
+
+def install_fake_sheets_client(spreadsheet):
+    '''
+    Make the agent's gspread/oauth2client imports use our fake Sheets client
+    '''
+    import types
+
+    gspread = types.ModuleType('gspread')
+    gspread.authorize = lambda credentials: FakeClient(spreadsheet)
+
+    oauth2client = types.ModuleType('oauth2client')
+    service_account = types.ModuleType('oauth2client.service_account')
+    service_account.ServiceAccountCredentials = FakeCredentials
+    oauth2client.service_account = service_account
+
+    sys.modules.update({'gspread': gspread, 'oauth2client': oauth2client,
+        'oauth2client.service_account': service_account})
+
+class Benchmark(object):
+    '''
+    A class to time a set of operations
+    '''
+
+    def __init__(self, iterations=100, debug=False):
+
+        self.iterations = iterations
+        self.debug = debug
+        self.results = []
+
+    def measure_alloc(self, func):
+        '''
+        Peak memory allocated by one call (KB) - "NA" without tracemalloc
+        '''
+        try:
+            import tracemalloc
+        except ImportError:
+            return "NA"
+
+        tracemalloc.start()
+
+        try:
+            func()
+            (current, peak) = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        return '%.1f' % (peak / 1024.0)
+
+    def run(self, name, func, setup=None):
+        '''
+        Time func over our iterations (setup, if given, is run untimed before
+        each call)
+        '''
+        import timeit
+
+        # warm up (imports, caches...)
+        if setup:
+            setup()
+        func()
+
+        timings = []
+        api_calls_before = sum(API_CALLS.values())
+
+        for iteration in range(self.iterations):
+            if setup:
+                setup()
+
+            start_time = timeit.default_timer()
+            func()
+            timings.append(timeit.default_timer() - start_time)
+
+        api_calls = sum(API_CALLS.values()) - api_calls_before
+
+        if setup:
+            setup()
+
+        timings.sort()
+
+        result = {'name': name, 'iterations': self.iterations,
+            'mean_ms': sum(timings) * 1000 / len(timings),
+            'min_ms': timings[0] * 1000,
+            'p95_ms': timings[int(len(timings) * 0.95) - 1 if len(timings) > 1 else 0] * 1000,
+            'alloc_kb': self.measure_alloc(func),
+            'api_calls': float(api_calls) / self.iterations}
+
+        self.results.append(result)
+
+        if self.debug:
+            print(result)
+
+        return result
+
+    def report(self):
+
+        print('%-28s %10s %10s %10s %10s %9s' % ('operation', 'mean ms', 'min ms', 'p95 ms', 'alloc KB', 'API calls'))
+
+        for result in self.results:
+            print('%-28s %10.3f %10.3f %10.3f %10s %9.1f' % (result['name'], result['mean_ms'],
+                result['min_ms'], result['p95_ms'], result['alloc_kb'], result['api_calls']))
+
+    def save(self, history_file):
+        '''
+        Append our results to a JSON lines history file
+        '''
+        import json
+        import platform
+        import time
+
+        with open(history_file, 'a') as history_file_obj:
+            history_file_obj.write(json.dumps({'time': int(time.time()),
+                'python': platform.python_version(), 'results': self.results}) + "\n")
+
+def bench_parsing(bench):
+    '''
+    Ping output & wireless adapter (CLI output & kernel fixture) parsing
+    '''
+    import subprocess
+    from pinger import Pinger
+    from wirelessadapter import WirelessAdapter
+    from kernelnetinfo import FixtureNetInfo
+
+    pinger = Pinger('wlanpi')
+
+    for fixture in ['iputils_ok', 'iputils_loss', 'busybox_ok']:
+        lines = read_fixture(os.path.join('ping', fixture + '.txt')).splitlines()
+        bench.run('ping_parse_' + fixture, lambda: pinger.parse_ping_output(lines))
+
+    # replay recorded command output in place of iwconfig/ifconfig/route
+    cli_output = {'iwconfig': read_fixture('cli/iwconfig_associated.txt'),
+        'ifconfig': read_fixture('cli/ifconfig.txt'),
+        'route': read_fixture('cli/route.txt')}
+
+    def fake_check_output(command, **kwargs):
+        for (name, output) in cli_output.items():
+            if name in command:
+                return output
+        raise OSError("No fixture for command: " + str(command))
+
+    adapter = WirelessAdapter('wlan0', NullLogger(), platform='wlanpi', backend='cli')
+
+    real_check_output = subprocess.check_output
+    subprocess.check_output = fake_check_output
+
+    try:
+        bench.run('adapter_cli_iwconfig', adapter.get_wireless_info)
+        bench.run('adapter_cli_ifconfig', adapter.get_adapter_ip)
+        bench.run('adapter_cli_route', adapter.get_route_info)
+    finally:
+        subprocess.check_output = real_check_output
+
+    netinfo = FixtureNetInfo('wlan0', os.path.join(FIXTURE_DIR, 'netinfo', 'associated'))
+    adapter = WirelessAdapter('wlan0', NullLogger(), platform='wlanpi', netinfo=netinfo)
+
+    def kernel_adapter_info():
+        adapter.get_wireless_info()
+        adapter.get_adapter_ip()
+        adapter.get_route_info()
+
+    bench.run('adapter_kernel_fixture', kernel_adapter_info)
+
+def bench_storage(bench, db_file):
+    '''
+    Local DB writes: results, outbox & error logs
+    '''
+    import json
+    import sqlite3
+    from resultsinks import SqliteSink
+    from outbox import Outbox
+    from simplelogger import SimpleLogger
+
+    records = json.loads(read_fixture('results/records.json'))
+    error_msgs = read_fixture('results/error_logs.txt').splitlines()
+
+    sink = SqliteSink(db_file, NullLogger())
+    results = [{'id': 0, 'result_key': 'key' + str(index), 'payload': record} for (index, record) in enumerate(records * 10)]
+
+    bench.run('sqlite_sink_insert_1', lambda: sink.deliver(results[:1]))
+    bench.run('sqlite_sink_insert_' + str(len(results)), lambda: sink.deliver(results))
+
+    sink.close()
+
+    db_conn = sqlite3.connect(db_file)
+    outbox = Outbox(db_conn, NullLogger(), sink='bench')
+
+    def outbox_round_trip():
+        outbox.enqueue(records[0])
+        outbox.ack([result['id'] for result in outbox.pending()])
+
+    bench.run('outbox_enqueue_ack', outbox_round_trip)
+
+    db_conn.close()
+
+    logger = SimpleLogger(db_file)
+    bench.run('logger_log_error', lambda: logger.log_error(error_msgs[0]))
+
+    buffered_logger = SimpleLogger(db_file, buffered=True, flush_size=len(error_msgs))
+
+    def buffered_log_errors():
+        for error_msg in error_msgs:
+            buffered_logger.log_error(error_msg)
+
+    bench.run('logger_buffered_x' + str(len(error_msgs)), buffered_log_errors)
+
+    buffered_logger.close()
+
+def bench_upload(bench, db_file):
+    '''
+    Google sheet uploads (result sink & console) via the fake Sheets client
+    '''
+    import json
+    import sqlite3
+    import time
+
+    spreadsheet = FakeSpreadsheet(['Console', time.strftime("%d-%b-%Y")])
+    install_fake_sheets_client(spreadsheet)
+
+    from gsheet import Gsheet
+    from resultsinks import GsheetSink
+    from sheetsapi import SheetsApi
+
+    logger = NullLogger()
+
+    # no quota pacing - we want to time our own code, not the token bucket
+    api = SheetsApi(logger, requests_per_minute=6000000, burst=100000)
+    gsheet = Gsheet('client_secret.json', 'Benchmark', logger, api=api)
+
+    records = json.loads(read_fixture('results/records.json'))
+    error_msgs = read_fixture('results/error_logs.txt').splitlines()
+
+    sink = GsheetSink(db_file, logger)
+    sink.set_gsheet(gsheet)
+
+    db_conn = sqlite3.connect(db_file)
+
+    def queue_result():
+        sink.enqueue(db_conn, records[0], None)
+
+    bench.run('gsheet_sink_flush_1', sink.flush, queue_result)
+
+    def queue_backlog():
+        for record in records * 10:
+            sink.enqueue(db_conn, record, None)
+
+    bench.run('gsheet_sink_flush_' + str(len(records) * 10), sink.flush, queue_backlog)
+
+    sink.close()
+
+    # update_console lives in the main agent script, which needs the
+    # speedtest-cli module
+    try:
+        import speedtester
+    except ImportError as ex:
+        print("Skipping update_console benchmark (" + str(ex) + ")")
+        db_conn.close()
+        return
+
+    def queue_error_logs():
+        db_conn.executemany("insert into error_logs (timestamp, cleartext_date, error_msg) values (?,?,?)",
+            [(int(time.time()), '2026-10-18 09:00:00', error_msg) for error_msg in error_msgs])
+        db_conn.commit()
+
+    bench.run('update_console', lambda: speedtester.update_console(gsheet, gsheet.worksheet_titles,
+        db_file, logger, False), queue_error_logs)
+
+    db_conn.close()
+
+def main():
+
+    import argparse
+    import shutil
+    import tempfile
+    from dbmigrate import migrate_db
+
+    parser = argparse.ArgumentParser(description="Benchmark the speedtest agent's hot paths")
+    parser.add_argument('-n', '--iterations', type=int, default=100, help="calls per operation")
+    parser.add_argument('-s', '--save', help="append results to this JSON lines history file")
+    parser.add_argument('-d', '--debug', action='store_true', help="print each result as it is measured")
+    args = parser.parse_args()
+
+    bench = Benchmark(args.iterations, args.debug)
+
+    temp_dir = tempfile.mkdtemp()
+
+    try:
+        db_file = os.path.join(temp_dir, 'benchmark.db')
+        migrate_db(db_file, NullLogger())
+
+        bench_parsing(bench)
+        bench_storage(bench, db_file)
+        bench_upload(bench, db_file)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    bench.report()
+
+    if args.save:
+        bench.save(args.save)
+
+if __name__ == "__main__":
+    main()
@@ -1 +1 @@
-sqlite3 -header -csv ../speedtest.db "select * from cached_results"
\ No newline at end of file
+sqlite3 -header -csv ../speedtest.db "select * from outbox"
\ No newline at end of file
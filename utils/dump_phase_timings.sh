@@ -0,0 +1 @@
+sqlite3 -header -csv ../speedtest.db "select cycle_start, datetime(cycle_start, 'unixepoch', 'localtime') as cycle_date, seq, phase, duration from cycle_phases order by cycle_start, seq"
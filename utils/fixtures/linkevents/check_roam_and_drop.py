@@ -0,0 +1,118 @@
+#!/usr/bin/python
+'''
+Check link event decoding against the recorded roam_and_drop.txt fixture:
+the raw netlink events are fed through a LinkEventListener (on a simulated
+clock - no replay delays or listener thread) & the link events it stores
+must be, in order:
+
+    connect, ip_change, roam, disconnect, ip_lost, connect, ip_change,
+    disconnect, link_down, ip_lost, recovery
+
+To run (exits with an assertion error if a check fails):
+
+    python utils/fixtures/linkevents/check_roam_and_drop.py
+'''
+from __future__ import print_function
+
+import os
+import sys
+
+FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# agent modules live at the top of the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(FIXTURE_DIR))))
+
+EXPECTED_EVENTS = ['connect', 'ip_change', 'roam', 'disconnect', 'ip_lost', 'connect', 'ip_change',
+    'disconnect', 'link_down', 'ip_lost', 'recovery']
+
+class NullLogger(object):
+    ''' Logger that discards messages '''
+
+    def log_error(self, err_msg):
+        pass
+
+def replay(fixture_file, db_file, recovery_delay, debug=False):
+    '''
+    Feed a fixture's raw events through a listener, checking for recovery
+    as time passes. Returns (the listener's link events, recoveries)
+    '''
+    from linkevents import FixtureEventSource, LinkEventListener
+
+    source = FixtureEventSource(fixture_file)
+
+    events = []
+    recoveries = []
+
+    listener = LinkEventListener(source, 'wlan0', NullLogger(), debug, db_file, on_event=events.append,
+        on_recovery=lambda: recoveries.append(True), recovery_delay=recovery_delay)
+
+    now = source.started_at
+
+    for (offset, protocol, data) in source.events:
+        now = source.started_at + offset
+
+        recovery_event = listener.check_recovery(now)
+
+        if recovery_event is not None:
+            listener.dispatch(recovery_event)
+
+        for event in listener.handle_message(now, protocol, data):
+            listener.dispatch(event)
+
+    # (the connection stays down after the last event)
+    recovery_event = listener.check_recovery(now + recovery_delay)
+
+    if recovery_event is not None:
+        listener.dispatch(recovery_event)
+
+    listener.db_conn.close()
+
+    return (events, recoveries)
+
+def main():
+
+    import argparse
+    import shutil
+    import sqlite3
+    import tempfile
+    from dbmigrate import migrate_db
+
+    parser = argparse.ArgumentParser(description="Check link events decoded from the roam_and_drop fixture")
+    parser.add_argument('--recovery-delay', type=float, default=10, help="secs a connection must stay down before recovering")
+    parser.add_argument('-d', '--debug', action='store_true', help="print each link event")
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+
+    try:
+        db_file = os.path.join(temp_dir, 'linkevents.db')
+        migrate_db(db_file, NullLogger())
+
+        (events, recoveries) = replay(os.path.join(FIXTURE_DIR, 'roam_and_drop.txt'), db_file,
+            args.recovery_delay, args.debug)
+
+        db_conn = sqlite3.connect(db_file)
+        stored = db_conn.execute("select event, typeof(timestamp), bssid, prev_bssid from link_events order by id").fetchall()
+        db_conn.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+    event_names = [event['event'] for event in events]
+
+    assert event_names == EXPECTED_EVENTS, "Unexpected link events: " + ", ".join(event_names)
+    assert [row[0] for row in stored] == EXPECTED_EVENTS, "Unexpected stored link events: " + str(stored)
+
+    # timestamps are stored as whole secs, like the rest of the DB
+    assert set([row[1] for row in stored]) == set(['integer']), "Link event timestamps not stored as integers: " + str(stored)
+
+    # roam from the first AP to the second, which later drops us
+    assert stored[2][2:] == ('11:22:33:44:55:66', 'AA:BB:CC:DD:EE:FF'), "Unexpected roam: " + str(stored[2])
+    assert stored[7][3] == '11:22:33:44:55:66', "Unexpected final disconnect: " + str(stored[7])
+
+    assert len(recoveries) == 1, "Recovery should be triggered once, not " + str(len(recoveries)) + " times"
+    assert events[-1]['detail'] == 'disconnect,ip_lost,link_down', "Unexpected recovery detail: " + events[-1]['detail']
+
+    print("OK: " + str(len(events)) + " link events (" + ", ".join(event_names) + ")")
+
+if __name__ == "__main__":
+    main()
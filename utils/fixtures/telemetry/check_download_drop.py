@@ -0,0 +1,185 @@
+#!/usr/bin/python
+'''
+Check telemetry sampling against the recorded download_drop.csv fixture (a
+download at ~300 Mbps that drops to ~40 Mbps six secs in, as the signal &
+tx bit rate fall): the readings are fed straight in to a TelemetrySampler
+(no sampling thread or sleeps) & checked for:
+
+ - the rx_mbps drop (every sample before it fast, every one after it slow)
+ - min/mean/max summaries & counter deltas that match the readings, as
+   stored in the telemetry_runs table
+ - the stored series decoding back to the samples (encode_series /
+   decode_series round trip)
+
+To run (exits with an assertion error if a check fails):
+
+    python utils/fixtures/telemetry/check_download_drop.py
+'''
+from __future__ import print_function
+
+import os
+import sys
+
+FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# agent modules live at the top of the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(FIXTURE_DIR))))
+
+# sample at which the download rate drops (6 secs in at 10 samples/sec)
+DROP_SAMPLE = 60
+
+# every sample before the drop is above FAST_MBPS, every one after it below
+# SLOW_MBPS
+FAST_MBPS = 250
+SLOW_MBPS = 50
+
+class NullLogger(object):
+    ''' Logger that discards messages '''
+
+    def log_error(self, err_msg):
+        pass
+
+def read_readings(fixture_file):
+    '''
+    Readings from a recorded CSV file, with numeric times
+    '''
+    import csv
+
+    with open(fixture_file) as fixture_file_obj:
+        readings = list(csv.DictReader(fixture_file_obj))
+
+    for reading in readings:
+        reading['time'] = float(reading['time'])
+
+    return readings
+
+def expected_rx_mbps(readings):
+    '''
+    rx rate (Mbps) between each pair of readings, worked out from the
+    recorded byte counters
+    '''
+    return [(float(reading['rx_bytes']) - float(last['rx_bytes'])) * 8 / (reading['time'] - last['time']) / 1e6
+        for (last, reading) in zip(readings[:-1], readings[1:])]
+
+def is_close(value, expected, tolerance=1e-6):
+    return abs(value - expected) <= tolerance * max(abs(expected), 1.0)
+
+def check_summary(summary, field, values):
+    '''
+    Check the min/mean/max summary of a field against its expected values
+    '''
+    for (suffix, expected) in [('_min', min(values)), ('_mean', sum(values) / len(values)), ('_max', max(values))]:
+        assert is_close(summary[field + suffix], expected), \
+            "Unexpected " + field + suffix + ": " + str(summary[field + suffix]) + " (should be " + str(expected) + ")"
+
+def check_series(series, buffers, fields):
+    '''
+    Check that a compressed series decodes back to the sample buffers (to
+    float32 precision)
+    '''
+    import math
+    from telemetry import decode_series
+
+    decoded = decode_series(series, fields)
+
+    assert sorted(decoded.keys()) == sorted(fields), "Unexpected series fields: " + str(sorted(decoded.keys()))
+
+    for field in fields:
+        assert len(decoded[field]) == len(buffers[field]), \
+            "Series " + field + " has " + str(len(decoded[field])) + " values, not " + str(len(buffers[field]))
+
+        for (value, expected) in zip(decoded[field], buffers[field]):
+            if math.isnan(expected):
+                assert math.isnan(value), "Series " + field + " value should be NaN, not " + str(value)
+            else:
+                assert is_close(value, expected, 1e-6), \
+                    "Series " + field + " value " + str(value) + " should be " + str(expected)
+
+def main():
+
+    import argparse
+    import math
+    import shutil
+    import sqlite3
+    import tempfile
+    from dbmigrate import migrate_db
+    from telemetry import TelemetrySampler, SAMPLE_FIELDS, encode_series
+
+    parser = argparse.ArgumentParser(description="Check telemetry sampled from the download_drop fixture")
+    parser.add_argument('-d', '--debug', action='store_true', help="print the summary")
+    args = parser.parse_args()
+
+    readings = read_readings(os.path.join(FIXTURE_DIR, 'download_drop.csv'))
+
+    sampler = TelemetrySampler(None, logger=NullLogger(), debug=args.debug)
+
+    for reading in readings:
+        sampler.add_reading(reading)
+
+    assert sampler.sample_count() == len(readings), "Unexpected sample count: " + str(sampler.sample_count())
+
+    # the first sample has no rx rate (no earlier reading to compare with)
+    rx_mbps = list(sampler.buffers['rx_mbps'])
+
+    assert math.isnan(rx_mbps[0]), "First sample should have no rx rate, not " + str(rx_mbps[0])
+
+    rates = rx_mbps[1:]
+    expected_rates = expected_rx_mbps(readings)
+
+    for (rate, expected) in zip(rates, expected_rates):
+        assert is_close(rate, expected), "Unexpected rx rate: " + str(rate) + " (should be " + str(expected) + ")"
+
+    before = rx_mbps[1:DROP_SAMPLE]
+    after = rx_mbps[DROP_SAMPLE:]
+
+    assert min(before) > FAST_MBPS, "rx rate before the drop should stay above " + str(FAST_MBPS) + " Mbps: " + str(min(before))
+    assert max(after) < SLOW_MBPS, "rx rate after the drop should stay below " + str(SLOW_MBPS) + " Mbps: " + str(max(after))
+    assert is_close(sampler.buffers['offset'][DROP_SAMPLE], readings[DROP_SAMPLE]['time'] - readings[0]['time']), \
+        "Unexpected drop time: " + str(sampler.buffers['offset'][DROP_SAMPLE])
+
+    # summaries, as stored
+    temp_dir = tempfile.mkdtemp()
+
+    try:
+        db_file = os.path.join(temp_dir, 'telemetry.db')
+        migrate_db(db_file, NullLogger())
+
+        db_conn = sqlite3.connect(db_file)
+        db_conn.row_factory = sqlite3.Row
+
+        assert sampler.save(db_conn, int(readings[0]['time']), store_series=True), "Unable to save telemetry"
+
+        stored = dict(db_conn.execute("select * from telemetry_runs").fetchone())
+        db_conn.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+    if args.debug:
+        for (name, value) in sorted(stored.items()):
+            if name != 'series':
+                print("%-16s %s" % (name, value))
+
+    assert stored['samples'] == len(readings), "Unexpected stored sample count: " + str(stored['samples'])
+    assert is_close(stored['duration'], readings[-1]['time'] - readings[0]['time']), "Unexpected duration: " + str(stored['duration'])
+
+    check_summary(stored, 'rx_mbps', expected_rates)
+
+    for (field, reading_field) in [('signal', 'level'), ('noise', 'noise'), ('tx_bitrate', 'tx_bitrate')]:
+        check_summary(stored, field, [float(reading[reading_field]) for reading in readings])
+
+    for field in ['retry', 'beacon']:
+        expected = float(readings[-1][field]) - float(readings[0][field])
+        assert stored[field + '_delta'] == expected, \
+            "Unexpected " + field + "_delta: " + str(stored[field + '_delta']) + " (should be " + str(expected) + ")"
+
+    # compressed series (as stored & straight from the buffers)
+    assert stored['series_fields'] == ",".join(SAMPLE_FIELDS), "Unexpected series fields: " + stored['series_fields']
+
+    check_series(bytes(stored['series']), sampler.buffers, SAMPLE_FIELDS)
+    check_series(encode_series(sampler.buffers, SAMPLE_FIELDS), sampler.buffers, SAMPLE_FIELDS)
+
+    print("OK: " + str(len(readings)) + " samples, rx " + '%.1f' % (sum(before) / len(before)) + " Mbps dropping to " +
+        '%.1f' % (sum(after) / len(after)) + " Mbps after " + '%.1f' % sampler.buffers['offset'][DROP_SAMPLE] + " secs")
+
+if __name__ == "__main__":
+    main()
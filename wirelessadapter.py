@@ -3,16 +3,28 @@ class WirelessAdapter(object):
 
     '''
     A class to monitor and manipulate the wireless adapter for the WLANPerfAgent
+
+    backend: "kernel" reads adapter info directly from kernel interfaces (see
+    kernelnetinfo.py), "cli" parses the output of iwconfig/ifconfig/route.
+    netinfo: optional KernelNetInfo object to use with the kernel backend
+    (e.g. a FixtureNetInfo to replay recorded adapter state)
     '''
 
-    def __init__(self, wlan_if_name, logger, platform="rpi", debug=False):
+    def __init__(self, wlan_if_name, logger, platform="rpi", debug=False, backend="kernel", netinfo=None):
     
         import sys
+        from kernelnetinfo import KernelNetInfo
         
         self.wlan_if_name = wlan_if_name
         self.logger = logger
         self.platform = platform
         self.debug = debug
+        self.backend = backend
+
+        if netinfo is None:
+            netinfo = KernelNetInfo(wlan_if_name, debug=debug)
+
+        self.netinfo = netinfo
         
         self.ssid = ''
         self.bssid = ''
@@ -44,6 +56,9 @@ class WirelessAdapter(object):
         '''
         import re
         import subprocess
+
+        if self.backend == "kernel":
+            return self.kernel_get_wireless_info()
         
         # Get wireless interface IP address info
         try:
@@ -128,6 +143,9 @@ class WirelessAdapter(object):
         
         import re
         import subprocess
+
+        if self.backend == "kernel":
+            return self.kernel_get_adapter_ip()
         
         # Get interface info
         try:            
@@ -175,6 +193,9 @@ class WirelessAdapter(object):
     
         import re
         import subprocess
+
+        if self.backend == "kernel":
+            return self.kernel_get_route_info()
         
         # Get route info (used too figure out default gateway)
         try:
@@ -204,6 +225,103 @@ class WirelessAdapter(object):
         if self.debug:
             print("Default GW = " + self.def_gw)        
 
+    def kernel_error(self, error_descr, ex):
+
+        if self.debug:
+            print(error_descr)
+            print(ex)
+
+        self.logger.log_error(error_descr)
+        self.logger.log_error(ex)
+        self.logger.log_error("Returning error...")
+
+    def kernel_get_wireless_info(self):
+        '''
+        Kernel backend for get_wireless_info: signal level from
+        /proc/net/wireless, association state from sysfs and SSID, BSSID,
+        frequency & bit rate from wireless extension ioctls
+        '''
+
+        try:
+            wireless_stats = self.netinfo.get_wireless_stats()
+
+            if wireless_stats is None:
+                raise IOError(19, self.wlan_if_name + " is not a wireless interface")
+
+            operstate = self.netinfo.get_operstate()
+
+            self.ssid = self.netinfo.get_ssid()
+            self.bssid = self.netinfo.get_bssid()
+            self.freq = self.netinfo.get_freq()
+            self.bit_rate = self.netinfo.get_bit_rate()
+        except (IOError, OSError) as ex:
+            self.kernel_error("Issue getting wireless interface info from kernel", ex)
+            return False
+
+        # no valid association unless the interface is operationally up
+        if operstate not in ('up', 'unknown'):
+            self.bssid = "NA"
+
+        # (/proc/net/wireless keeps a stale level while we are not associated)
+        if self.bssid == "NA":
+            self.signal_level = "NA"
+        else:
+            self.signal_level = wireless_stats.get('level', "NA")
+
+        if self.debug:
+            print("Wireless interface stats: " + str(wireless_stats))
+            print("Operational state = " + operstate)
+            print("SSID = " + self.ssid)
+            print("BSSID = " + self.bssid)
+            print("Frequency = " + self.freq)
+            print("Bit rate: " + self.bit_rate)
+            print("Signal level = " + self.signal_level)
+
+        return [self.ssid, self.bssid, self.freq, self.bit_rate, self.signal_level]
+
+    def kernel_get_adapter_ip(self):
+        '''
+        Kernel backend for get_adapter_ip (SIOCGIFADDR ioctl)
+        '''
+        import re
+
+        try:
+            self.ip_addr = self.netinfo.get_ip_addr()
+        except (IOError, OSError) as ex:
+            self.kernel_error("Issue getting interface IP address from kernel", ex)
+            return False
+
+        # Check to see if IP address is APIPA (169.254.x.x)
+        if re.match('169\.254', self.ip_addr):
+            self.ip_addr = "NA"
+
+        if self.debug:
+            print("IP Address = " + self.ip_addr)
+
+        return self.ip_addr
+
+    def kernel_get_route_info(self):
+        '''
+        Kernel backend for get_route_info (default route from /proc/net/route)
+        '''
+        try:
+            def_gw = self.netinfo.get_def_gw()
+        except (IOError, OSError) as ex:
+            self.kernel_error("Issue getting default gateway info from kernel", ex)
+            return False
+
+        if def_gw is None:
+            self.kernel_error("Issue getting default gateway info from kernel",
+                "No default route via " + self.wlan_if_name)
+            return False
+
+        self.def_gw = def_gw
+
+        if self.debug:
+            print("Default GW = " + self.def_gw)
+
+        return self.def_gw
+
     def bounce_wlan_interface(self):
     
         '''